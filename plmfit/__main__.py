@@ -30,6 +30,14 @@ def run_blosum(args, logger):
     from plmfit.functions import blosum
     blosum(args, logger)
 
+def run_score(args, logger):
+    from plmfit.functions import score
+    score(args, logger)
+
+def run_generate(args, logger):
+    from plmfit.functions import generate
+    generate(args, logger)
+
 def run_predict(args, logger):
     raise NotImplementedError("Function not supported (yet)")
 
@@ -68,6 +76,32 @@ def main():
     parser.add_argument('--weights', default=None)
     parser.add_argument('--sampler', default="False")
     parser.add_argument('--split_size', default=0, type=int)
+    parser.add_argument('--max_tokens', default=4096, type=int,
+                        help="Token budget per batch (batch size x padded length) when extracting embeddings")
+    parser.add_argument('--embeddings_dtype', default='float32', choices=['float16', 'float32'],
+                        help="Storage precision of the extracted embeddings")
+    parser.add_argument('--prefix_cache', default="False",
+                        help="Run the prefix shared by all the sequences only once when extracting ProGen embeddings or scoring log-likelihoods")
+    parser.add_argument('--head_farm', default="False",
+                        help="With feature_extraction, train a head per combination of the 'head_farm' section of the head config at once")
+    parser.add_argument('--trunk_cache', default="False",
+                        help="With --target_layers last, run the frozen blocks once and fine-tune the last block from their cached fp16 outputs")
+    parser.add_argument('--inference_precision', default='fp32', choices=['fp32', 'bf16', 'int8'],
+                        help="Precision of embedding extraction: dynamic int8 quantisation of the Linear layers (CPU only) or bf16 autocast")
+    parser.add_argument('--fidelity_sample', default=256, type=int,
+                        help="Number of sequences compared with fp32 in the fidelity report of bf16 and int8 extraction")
+    parser.add_argument('--reverse', default="False",
+                        help="Also score the sequences right-to-left and average both directions when scoring with ProGen")
+    parser.add_argument('--prompts', default="1",
+                        help="Comma-separated contexts or a FASTA file of contexts to generate ProGen sequences from")
+    parser.add_argument('--num_samples', default=100, type=int,
+                        help="Number of sequences generated per prompt")
+    parser.add_argument('--max_length', default=512, type=int,
+                        help="Maximum number of tokens of a generated sequence, prompt included")
+    parser.add_argument('--top_p', default=0.95, type=float)
+    parser.add_argument('--temperature', default=1.0, type=float)
+    parser.add_argument('--filter_threshold', default=0.5, type=float,
+                        help="Minimum head prediction of the generated sequences written when generating with --model_path")
     parser.add_argument('--model_path', default=None, help="Path of the model in .ckpt format for evaluating it or continuing training from checkpoint")
     parser.add_argument('--evaluate', default="False")
     parser.add_argument('--seed', default=42, type=int)
@@ -95,7 +129,9 @@ def main():
             else: run_fine_tuning(args, logger)
         elif args.function == 'one_hot': run_onehot(args, logger)
         elif args.function == 'blosum': run_blosum(args, logger)
-        elif args.function == 'predict' or args.function == 'generate': run_predict(args, logger)
+        elif args.function == 'score': run_score(args, logger)
+        elif args.function == 'generate': run_generate(args, logger)
+        elif args.function == 'predict': run_predict(args, logger)
         else: raise NotImplementedError('Function not supported (yet)')
         logger.log("\n\nEnd of process", force_send=True)
     except:
@@ -3,4 +3,6 @@ from plmfit.functions.fine_tune import fine_tune
 from plmfit.functions.onehot import onehot
 from plmfit.functions.feature_extraction import feature_extraction
 from plmfit.functions.predict import predict
-from plmfit.functions.blosum62 import blosum
\ No newline at end of file
+from plmfit.functions.blosum62 import blosum
+from plmfit.functions.score import score
+from plmfit.functions.generate import generate
\ No newline at end of file
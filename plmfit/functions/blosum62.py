@@ -38,8 +38,13 @@ def blosum(args, logger):
 
     logger.log("Initializing BLOSUM62 encoding...")
     max_len = data['len'].max()
-    encs = utils.blosum62_encode(data['aa_seq'].values, pad_to_length=max_len, logger=logger)
-    encs = encs.reshape(encs.shape[0], -1)
+    # Without feature scaling, the L x L encodings are computed per sample from the residue indices
+    dataset_type = "tensor" if head_config["training_parameters"]["scaler"] else "blosum62"
+    if dataset_type == "blosum62":
+        encs = utils.blosum62_tokenize(data['aa_seq'].values, pad_to_length=max_len)
+    else:
+        encs = utils.blosum62_encode(data['aa_seq'].values, pad_to_length=max_len, logger=logger)
+        encs = encs.reshape(encs.shape[0], -1)
     logger.log(f"BLOSUM62 encoding completed!\nEncoded sequences shape: {encs.shape}")
 
     if args.ray_tuning == "True":
@@ -55,6 +60,7 @@ def blosum(args, logger):
             weights=weights,
             sampler=sampler,
             n_trials=100,
+            dataset_type=dataset_type,
         )
 
     logger.save_data(vars(args), "arguments")
@@ -73,6 +79,7 @@ def blosum(args, logger):
         num_workers=0,
         weights=weights,
         sampler=sampler,
+        dataset_type=dataset_type,
     )
 
 
@@ -91,6 +98,8 @@ def objective(
     sampler=False,
     patience=5,
     num_classes=21,
+    dataset_type="tensor",
+    datasets=None,
 ):
 
     network_type = head_config["architecture_parameters"]["network_type"]
@@ -111,30 +120,23 @@ def objective(
             head_config["architecture_parameters"]["hidden_dim"] = trial.suggest_int(
                 "hidden_dim", 64, 2048
             )
-    if task == "regression":
-        scores = data["score"].values
-    elif task == "classification":
-        if "binary_score" in data:
-            scores = data["binary_score"].values
-        elif "label" in data:
-            scores = data["label"].values
-        else:
-            raise KeyError("Neither 'binary_score' nor 'label' found in data")
-    else:
-        raise ValueError("Task not supported")
 
     training_params = head_config["training_parameters"]
-    data_loaders = utils.create_data_loaders(
-        embeddings,
-        scores,
-        scaler=training_params["scaler"],
+    if datasets is None:
+        datasets = prepare_datasets(
+            task,
+            head_config,
+            embeddings,
+            data,
+            split=split,
+            weights=weights,
+            sampler=sampler,
+            dataset_type=dataset_type,
+        )
+    data_loaders = utils.create_data_loaders_from_datasets(
+        datasets,
         batch_size=training_params["batch_size"],
-        validation_size=training_params["val_split"],
-        dtype=torch.long,
-        split=split,
         num_workers=num_workers,
-        weights=weights,
-        sampler=sampler,
     )
 
     if not on_ray_tuning:
@@ -143,13 +145,13 @@ def objective(
     network_type = head_config["architecture_parameters"]["network_type"]
     if network_type == "linear":
         head_config["architecture_parameters"]["input_dim"] = (
-            embeddings.shape[1]
-        ) 
+            embeddings.shape[1] ** 2 if dataset_type == "blosum62" else embeddings.shape[1]
+        )
         model = heads.LinearHead(head_config["architecture_parameters"])
     elif network_type == "mlp":
         head_config["architecture_parameters"]["input_dim"] = (
-            embeddings.shape[1]
-        ) 
+            embeddings.shape[1] ** 2 if dataset_type == "blosum62" else embeddings.shape[1]
+        )
         model = heads.MLP(head_config["architecture_parameters"])
     else:
         raise ValueError("Head type not supported")
@@ -254,6 +256,42 @@ def objective(
         logger.save_plot(fig, "actual_vs_predicted")
 
 
+def prepare_datasets(
+    task,
+    config,
+    embeddings,
+    data,
+    split=None,
+    weights=None,
+    sampler=False,
+    dataset_type="tensor",
+):
+    if task == "regression":
+        scores = data["score"].values
+    elif task == "classification":
+        if "binary_score" in data:
+            scores = data["binary_score"].values
+        elif "label" in data:
+            scores = data["label"].values
+        else:
+            raise KeyError("Neither 'binary_score' nor 'label' found in data")
+    else:
+        raise ValueError("Task not supported")
+
+    training_params = config["training_parameters"]
+    return utils.prepare_datasets(
+        embeddings,
+        scores,
+        scaler=training_params["scaler"],
+        validation_size=training_params["val_split"],
+        dtype=torch.long,
+        split=split,
+        weights=weights,
+        sampler=sampler,
+        dataset_type=dataset_type,
+    )
+
+
 def hyperparameter_tuning(
     task,
     args,
@@ -267,6 +305,7 @@ def hyperparameter_tuning(
     sampler=False,
     n_trials=100,
     num_classes=21,
+    dataset_type="tensor",
 ):
     if version.parse(pl.__version__) < version.parse("2.2.1"):
         raise RuntimeError(
@@ -283,6 +322,19 @@ def hyperparameter_tuning(
         load_if_exists=True,
     )
 
+    # The split, scaling and tensor conversion do not depend on the tuned hyperparameters,
+    # so they are done once and the datasets are shared by all trials
+    datasets = prepare_datasets(
+        task,
+        head_config,
+        embeddings,
+        data,
+        split=split,
+        weights=weights,
+        sampler=sampler,
+        dataset_type=dataset_type,
+    )
+
     logger.log("Starting hyperparameter tuning...")
     study.optimize(
         lambda trial: objective(
@@ -299,6 +351,8 @@ def hyperparameter_tuning(
             weights=weights,
             sampler=sampler,
             num_classes=num_classes,
+            dataset_type=dataset_type,
+            datasets=datasets,
         ),
         n_trials=n_trials if network_type == "linear" else n_trials * 4,
         callbacks=[LogOptunaTrialCallback(logger)],
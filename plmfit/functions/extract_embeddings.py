@@ -1,5 +1,13 @@
+import numpy as np
 import torch
 from plmfit.shared_utils import utils
+from plmfit.shared_utils.pooling import check_reductions
+from plmfit.shared_utils.inference_precision import (
+    embed_sample,
+    fidelity_report,
+    get_trainer_precision,
+    quantize_linear_layers,
+)
 from lightning import Trainer
 from lightning.pytorch.loggers import TensorBoardLogger
 from plmfit.models.lightning_model import LightningModel, PredictionWriter
@@ -14,23 +22,73 @@ def extract_embeddings(args, logger):
     # Load dataset
     data = utils.load_dataset(args.data_type)
 
-    model = utils.init_plm(args.plm, logger, task="extract_embeddings")
+    # Multiple layers and reductions can be given comma separated and are extracted in a single pass
+    layers = args.layer.split(",")
+    reductions = args.reduction.split(",")
+    check_reductions(reductions)
+
+    # Only the blocks up to the deepest requested layer are loaded
+    model = utils.init_plm(args.plm, logger, task="extract_embeddings", layers=layers)
     assert model != None, "Model is not initialized"
 
     model.experimenting = (
         args.experimenting == "True"
     )  # If we are in experimenting mode
 
-    model.set_layer_to_use(args.layer)
-    model.py_model.reduction = args.reduction
+    multiple_outputs = len(layers) > 1 or len(reductions) > 1
+    if multiple_outputs:
+        if args.split_size > 0:
+            raise ValueError(
+                "split_size is not supported when extracting multiple layers or reductions"
+            )
+        model.set_layers_to_use(layers, reductions)
+    else:
+        model.set_layer_to_use(args.layer)
+        model.py_model.reduction = args.reduction
 
     encs = model.categorical_encode(data)
-    encs = torch.tensor(encs)
+
+    precision = get_trainer_precision(args.inference_precision)
+    if args.inference_precision != "fp32":
+        # The reduced precision embeddings are compared with fp32 on a sample before extracting them all
+        sample = np.random.default_rng(args.seed).choice(
+            len(encs), size=min(args.fidelity_sample, len(encs)), replace=False
+        )
+        sample_encs = torch.as_tensor(encs)[torch.as_tensor(sample)]
+        pad_token_id = utils.get_pad_token_id(model.tokenizer)
+        reference = embed_sample(model.py_model, sample_encs, pad_token_id)
+        if args.inference_precision == "int8":
+            quantize_linear_layers(model.py_model)
+        embeddings = embed_sample(
+            model.py_model,
+            sample_encs,
+            pad_token_id,
+            autocast_dtype=torch.bfloat16 if args.inference_precision == "bf16" else None,
+        )
+        scores = data["score"].values[sample] if "score" in data.columns else None
+        if scores is not None and not np.isfinite(scores.astype(float)).all():
+            scores = None
+        report = fidelity_report(reference, embeddings, scores, seed=args.seed)
+        logger.save_data(report, "fidelity_report")
+        for key, entry in report.items():
+            logger.log(f"{args.inference_precision} fidelity ({key}): {entry}")
+
+    if args.prefix_cache == "True":
+        # Mutational libraries share the wild-type prefix up to the first mutated position, which is run once
+        if not hasattr(model.py_model, "set_prefix"):
+            raise ValueError("prefix_cache is only supported for ProGen models")
+        prefix_length = utils.get_shared_prefix_length(encs)
+        logger.log(f"Running the shared prefix of {prefix_length} tokens once")
+        model.py_model.set_prefix(encs[:1, :prefix_length])
 
     logger.save_data(vars(args), "arguments")
 
-    # TODO: Create predict dataloaders
-    data_loader = utils.create_predict_data_loader(encs, batch_size=4)
+    # Sequences are bucketed by length and each batch is only padded to its own longest sequence
+    data_loader = utils.create_predict_data_loader(
+        encs,
+        max_tokens=args.max_tokens,
+        pad_token_id=utils.get_pad_token_id(model.tokenizer),
+    )
 
     model = LightningModel(
         model.py_model,
@@ -54,7 +112,15 @@ def extract_embeddings(args, logger):
     devices = args.gpus if torch.cuda.is_available() else 1
     strategy = strategy if torch.cuda.is_available() else "auto"
 
-    pred_writer = PredictionWriter(logger=logger, write_interval="epoch", split_size=args.split_size)
+    # Predictions are streamed into a memory-mapped embedding store unless they are split in .pt chunks
+    pred_writer = PredictionWriter(
+        logger=logger,
+        write_interval="epoch" if args.split_size > 0 else "batch",
+        split_size=args.split_size,
+        dtype=args.embeddings_dtype,
+        metadata={"model": args.plm, "layer": args.layer, "reduction": args.reduction},
+        prefix=f"{args.data_type}_{args.plm}_embs" if multiple_outputs else None,
+    )
 
     trainer = Trainer(
         default_root_dir=logger.base_dir,
@@ -62,7 +128,7 @@ def extract_embeddings(args, logger):
         enable_progress_bar=False,
         devices=devices,
         strategy=strategy,
-        precision="16-mixed",
+        precision=precision,
         callbacks=[pred_writer],
     )
     # tuner = Tuner(trainer)
@@ -75,4 +141,4 @@ def extract_embeddings(args, logger):
             model, num_gpus_per_node=int(args.gpus), num_nodes=1
         )
 
-    trainer.predict(model=model, dataloaders=data_loader)
+    trainer.predict(model=model, dataloaders=data_loader, return_predictions=False)
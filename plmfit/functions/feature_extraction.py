@@ -3,6 +3,12 @@ import plmfit.models.downstream_heads as heads
 from lightning import Trainer
 from lightning.pytorch.loggers import TensorBoardLogger
 from plmfit.models.lightning_model import LightningModel
+from plmfit.models.head_farm import (
+    FARM_PARAMETERS,
+    HeadFarm,
+    build_head,
+    save_head_report,
+)
 import optuna
 from optuna.storages import JournalStorage
 from optuna.storages.journal import JournalFileBackend
@@ -11,9 +17,13 @@ from optuna.integration import PyTorchLightningPruningCallback
 from packaging import version
 from optuna.visualization import plot_optimization_history, plot_slice
 from plmfit.shared_utils import utils, data_explore
+from plmfit.shared_utils import parallel_tuning
+from plmfit.shared_utils.random_state import set_seed
 from plmfit.logger import LogOptunaTrialCallback
 import gc
 import copy
+import itertools
+import time
 
 
 def feature_extraction(args, logger):
@@ -56,7 +66,7 @@ def feature_extraction(args, logger):
         reduction=args.reduction,
     )
     assert (
-        embeddings != None
+        embeddings is not None
     ), "Couldn't find embeddings, use the full path of the embeddings file (.pt) or you can use extract_embeddings function to create and save the embeddings."
 
     if task == "regression":
@@ -84,6 +94,23 @@ def feature_extraction(args, logger):
     else:
         raise ValueError("Task not supported")
 
+    if args.head_farm == "True":
+        assert args.evaluate == "False", "Cannot evaluate a head farm"
+        logger.save_data(vars(args), "arguments")
+        logger.save_data(head_config, "head_config")
+        head_farm(
+            task,
+            args,
+            head_config,
+            embeddings,
+            scores,
+            logger,
+            split=split,
+            weights=weights,
+            sampler=sampler,
+        )
+        return
+
     if args.ray_tuning == "True":
         assert args.evaluate == "False", "Cannot evaluate and tune at the same time"
 
@@ -134,6 +161,7 @@ def objective(
     weights=None,
     sampler=False,
     patience=5,
+    datasets=None,
 ):
     config = copy.deepcopy(head_config)
 
@@ -167,16 +195,14 @@ def objective(
             )
 
     training_params = config["training_parameters"]
-    data_loaders = utils.create_data_loaders(
-        embeddings,
-        scores,
-        scaler=training_params["scaler"],
+    if datasets is None:
+        datasets = prepare_datasets(
+            config, embeddings, scores, split=split, weights=weights, sampler=sampler
+        )
+    data_loaders = utils.create_data_loaders_from_datasets(
+        datasets,
         batch_size=training_params["batch_size"],
-        validation_size=training_params["val_split"],
-        split=split,
         num_workers=num_workers,
-        weights=weights,
-        sampler=sampler,
     )
 
     network_type = config["architecture_parameters"]["network_type"]
@@ -217,6 +243,18 @@ def objective(
     if args.data_type == "herH3" and args.split == "one_vs_rest":
         model.track_validation_after = -1
 
+    if training_params.get("solver", False) and args.evaluate != "True":
+        # Linear heads on frozen embeddings are fitted directly, without the Trainer
+        if network_type != "linear":
+            raise ValueError("The solver is only supported for linear heads")
+        loss = model.fit_solver(datasets["train"], datasets["val"])
+        if on_ray_tuning:
+            return loss
+        logger.save_model(model.model, "best_model")
+        model.test_solver(datasets["test"])
+        plot_test_results(task, config, logger)
+        return
+
     devices = 1
     strategy = "auto"
 
@@ -274,6 +312,7 @@ def objective(
             del trainer
             del scores
             del data_loaders
+            del datasets
             del model
             gc.collect()
             return loss
@@ -289,7 +328,117 @@ def objective(
         ckpt_path=ckpt_path,
         dataloaders=data_loaders["test"],
     )
+    plot_test_results(task, config, logger)
+
+
+def head_farm(
+    task,
+    args,
+    head_config,
+    embeddings,
+    scores,
+    logger,
+    split=None,
+    weights=None,
+    sampler=False,
+):
+    """
+    Trains one head per combination of the values listed in the 'head_farm' section of the head config
+    (learning_rate, weight_decay, hidden_dropout and seeds), all at once with a HeadFarm. Each head writes
+    the reports of a single run under head_farm/, and the best validation loss and test metrics of every
+    head are saved under 'head_farm' in the data of the experiment.
+    """
+    farm_config = head_config.get("head_farm", {})
+    unknown = set(farm_config) - set(FARM_PARAMETERS) - {"seeds"}
+    if unknown:
+        raise ValueError(f"Unsupported head farm parameters: {sorted(unknown)}")
+    seeds = farm_config.get("seeds", [args.seed])
+    seeds = list(range(args.seed, args.seed + seeds)) if isinstance(seeds, int) else seeds
+    names = [name for name in FARM_PARAMETERS if name in farm_config]
+
+    configs, farm_heads = [], []
+    for seed, *values in itertools.product(seeds, *(farm_config[name] for name in names)):
+        config = copy.deepcopy(head_config)
+        config.pop("head_farm", None)
+        for name, value in zip(names, values):
+            config[FARM_PARAMETERS[name]][name] = value
+        config["architecture_parameters"]["input_dim"] = embeddings.shape[-1]
+        config["training_parameters"]["seed"] = seed
+        # Each head is initialised with its own seed
+        set_seed(seed)
+        farm_heads.append(build_head(config["architecture_parameters"]))
+        configs.append(config)
+    set_seed(args.seed)
+
+    training_params = head_config["training_parameters"]
+    datasets = prepare_datasets(
+        head_config, embeddings, scores, split=split, weights=weights, sampler=sampler
+    )
+    data_loaders = utils.create_data_loaders_from_datasets(
+        datasets, batch_size=training_params["batch_size"]
+    )
+    config_param = LightningModel.handle_bool_float_config_param
+    farm = HeadFarm(
+        farm_heads,
+        learning_rates=[config["training_parameters"]["learning_rate"] for config in configs],
+        weight_decays=[config["training_parameters"]["weight_decay"] or 0.0 for config in configs],
+        loss_f=training_params["loss_f"],
+        optimizer=training_params["optimizer"],
+        task=task,
+        no_classes=training_params.get("no_classes", 1),
+        gradient_clipping=config_param(training_params["gradient_clipping"], 0, 0.5),
+        device="cuda" if torch.cuda.is_available() else "cpu",
+    )
 
+    logger.log(f"Training {farm.n_heads} heads at once")
+    start_time = time.time()
+    history = farm.fit(
+        data_loaders["train"],
+        data_loaders["val"],
+        epochs=training_params["epochs"],
+        patience=config_param(training_params["early_stopping"], -1, 10),
+        accumulate_grad_batches=config_param(training_params["gradient_accumulation"], 1, 8),
+        epoch_sizing=config_param(training_params["epoch_sizing"], 1.0, 0.2),
+        logger=logger,
+    )
+    training_time = time.time() - start_time
+    logger.log(f"Total training time: {training_time:.1f}s")
+
+    summary = []
+    for head, metrics in enumerate(farm.test_metrics(data_loaders["test"])):
+        name = f"{logger.experiment_name}_head_{head}"
+        save_head_report(
+            f"{logger.base_dir}/head_farm/{name}",
+            configs[head],
+            {key: values[head] for key, values in history.items()},
+            metrics,
+            farm.state_dict(head),
+            report={
+                "training_time": f"{training_time:.1f}",
+                "n_heads": farm.n_heads,
+                "best_epoch": history["best_epoch"][head] + 1,
+            },
+        )
+        summary.append(
+            {
+                "name": name,
+                "parameters": {
+                    "seed": configs[head]["training_parameters"]["seed"],
+                    **{
+                        parameter: configs[head][FARM_PARAMETERS[parameter]][parameter]
+                        for parameter in names
+                    },
+                },
+                "best_val_loss": history["best_val_loss"][head],
+                "metrics": metrics.report["main"],
+            }
+        )
+    best = min(range(len(summary)), key=lambda head: summary[head]["best_val_loss"])
+    logger.log(f"Best head: {summary[best]['name']} {summary[best]['parameters']}")
+    logger.save_data({"heads": summary, "best_head": summary[best]["name"]}, "head_farm")
+
+
+def plot_test_results(task, config, logger):
     if task == "classification":
         if config["architecture_parameters"]["output_dim"] == 1:
             fig, _ = data_explore.plot_roc_curve(
@@ -312,6 +461,19 @@ def objective(
         logger.save_plot(fig, "confusion_matrix")
 
 
+def prepare_datasets(config, embeddings, scores, split=None, weights=None, sampler=False):
+    training_params = config["training_parameters"]
+    return utils.prepare_datasets(
+        embeddings,
+        scores,
+        scaler=training_params["scaler"],
+        validation_size=training_params["val_split"],
+        split=split,
+        weights=weights,
+        sampler=sampler,
+    )
+
+
 def hyperparameter_tuning(
     task,
     args,
@@ -331,9 +493,8 @@ def hyperparameter_tuning(
             )
     network_type = head_config["architecture_parameters"]["network_type"]
 
-    storage = JournalStorage(
-        JournalFileBackend(f"{logger.base_dir}/optuna_journal_storage.log")
-    )
+    storage_path = f"{logger.base_dir}/optuna_journal_storage.log"
+    storage = JournalStorage(JournalFileBackend(storage_path))
     pruner = optuna.pruners.MedianPruner()
     study = optuna.create_study(
         direction="minimize",
@@ -343,29 +504,69 @@ def hyperparameter_tuning(
         load_if_exists=True,
     )
 
+    # The split, scaling and tensor conversion do not depend on the tuned hyperparameters,
+    # so they are done once and the datasets are shared by all trials
+    datasets = prepare_datasets(
+        head_config, embeddings, scores, split=split, weights=weights, sampler=sampler
+    )
+
     logger.log("Starting hyperparameter tuning...")
     logger.mute = True
-    study.optimize(
-        lambda trial: objective(
-            trial,
-            task,
-            args,
-            head_config,
-            embeddings,
-            scores,
-            logger,
-            split,
-            on_ray_tuning=True,
-            num_workers=num_workers,
-            weights=weights,
-            sampler=sampler,
-        ),
-        n_trials=n_trials if network_type == "linear" else n_trials * 4,
-        callbacks=[LogOptunaTrialCallback(logger)],
-        n_jobs=int(args.gpus),
-        gc_after_trial=True,
-        catch=(FileNotFoundError,),
-    )
+    n_trials = n_trials if network_type == "linear" else n_trials * 4
+    if int(args.gpus) == 0 and int(args.cpus) > 1:
+        # On CPU-only nodes the trials run in parallel processes, one per slice of --cpus cores,
+        # sharing the prepared datasets through shared memory
+        logger.log(f"Running trials in {args.cpus} processes", force_unmute=True)
+        parallel_tuning.share_datasets_memory(datasets)
+        parallel_tuning.optimize_in_processes(
+            storage_path,
+            study.study_name,
+            objective,
+            objective_args=(
+                task,
+                args,
+                head_config,
+                embeddings[:0],  # Only the embedding shape is needed once the datasets are prepared
+                scores,
+                logger,
+                split,
+            ),
+            objective_kwargs=dict(
+                on_ray_tuning=True,
+                num_workers=num_workers,
+                weights=weights,
+                sampler=sampler,
+                datasets=datasets,
+            ),
+            n_trials=n_trials,
+            n_workers=int(args.cpus),
+            callbacks=[LogOptunaTrialCallback(logger)],
+            seed=args.seed,
+            catch=(FileNotFoundError,),
+        )
+    else:
+        study.optimize(
+            lambda trial: objective(
+                trial,
+                task,
+                args,
+                head_config,
+                embeddings,
+                scores,
+                logger,
+                split,
+                on_ray_tuning=True,
+                num_workers=num_workers,
+                weights=weights,
+                sampler=sampler,
+                datasets=datasets,
+            ),
+            n_trials=n_trials,
+            callbacks=[LogOptunaTrialCallback(logger)],
+            n_jobs=int(args.gpus),
+            gc_after_trial=True,
+            catch=(FileNotFoundError,),
+        )
     logger.mute = False
     history = plot_optimization_history(study)
     slice = plot_slice(study)
@@ -1,3 +1,4 @@
+import numpy as np
 import torch
 from plmfit.shared_utils import utils, data_explore
 import plmfit.models.downstream_heads as heads
@@ -13,8 +14,12 @@ from lightning.pytorch.utilities.deepspeed import (
 )
 from deepspeed.runtime.zero.stage3 import estimate_zero3_model_states_mem_needs_all_live
 from plmfit.models.lightning_model import LightningModel
+from plmfit.shared_utils.activation_cache import TrunkActivationCache
+from plmfit.shared_utils.pooling import check_reductions
+from plmfit.shared_utils.cpu_distributed import CoreAffinity, cpu_ddp_strategy
 from lightning.pytorch.strategies import DeepSpeedStrategy
 import ast
+import hashlib
 import shutil
 from pathlib import Path
 
@@ -45,7 +50,7 @@ def fine_tune(args, logger):
         else data.get(head_config["training_parameters"]["weights"])
     )
     sampler = head_config["training_parameters"].get("sampler", False) == True
-    model = utils.init_plm(args.plm, logger, task=task)
+    model = utils.init_plm(args.plm, logger, task=task, layers=[args.layer])
     assert model != None, "Model is not initialized"
 
     if args.zeroed == "True":
@@ -60,6 +65,14 @@ def fine_tune(args, logger):
     logger.save_data(vars(args), "arguments")
     logger.save_data(head_config, "head_config")
 
+    use_trunk_cache = args.trunk_cache == "True"
+    if use_trunk_cache and (args.target_layers != "last" or task == "masked_lm"):
+        raise ValueError("The trunk cache needs --target_layers last and a downstream task")
+    if use_trunk_cache and model.layer_to_use == 0:
+        logger.log("No frozen blocks below the first block, fine-tuning without the trunk cache")
+        use_trunk_cache = False
+
+    trunk_cache = None
     if task == "masked_lm":
         data_loaders, training_params = masked_lm_prep(
             model=model,
@@ -71,7 +84,7 @@ def fine_tune(args, logger):
             logger=logger,
         )
     else:
-        data_loaders, training_params = downstream_prep(
+        data_loaders, training_params, trunk_cache = downstream_prep(
             model=model,
             args=args,
             data=data,
@@ -80,6 +93,8 @@ def fine_tune(args, logger):
             head_config=head_config,
             weights=weights,
             sampler=sampler,
+            use_trunk_cache=use_trunk_cache,
+            logger=logger,
         )
 
     if args.ft_method == "lora":
@@ -98,6 +113,9 @@ def fine_tune(args, logger):
         raise ValueError("Fine Tuning method not supported")
 
     model = fine_tuner.prepare_model(model, target_layers=args.target_layers)
+    if trunk_cache is not None:
+        # From now on the model is called with sample indices, see downstream_prep
+        trunk_cache.attach(model.py_model)
 
     utils.trainable_parameters_summary(model, logger)
     model.py_model.task = task
@@ -133,6 +151,13 @@ def fine_tune(args, logger):
     )
     devices = args.gpus if torch.cuda.is_available() else 1
     strategy = strategy if torch.cuda.is_available() else "auto"
+    accelerator, num_nodes = "auto", 1
+    callbacks = [model.early_stopping()]
+    if not torch.cuda.is_available() and (int(args.cpus) > 1 or args.nodes > 1):
+        # CPU-only nodes: --cpus data-parallel processes on each of the --nodes nodes, each on its own cores
+        devices, strategy = int(args.cpus), cpu_ddp_strategy()
+        accelerator, num_nodes = "cpu", args.nodes
+        callbacks.append(CoreAffinity())
 
     trainer = Trainer(
         default_root_dir=logger.base_dir,
@@ -143,10 +168,12 @@ def fine_tune(args, logger):
         gradient_clip_val=model.gradient_clipping(),
         limit_train_batches=(model.epoch_sizing()),
         limit_val_batches=(model.epoch_sizing()),
+        accelerator=accelerator,
         devices=devices,
+        num_nodes=num_nodes,
         strategy=strategy,
         precision="16-mixed",
-        callbacks=[model.early_stopping()],
+        callbacks=callbacks,
     )
     if torch.cuda.is_available():
         estimate_zero3_model_states_mem_needs_all_live(
@@ -213,7 +240,16 @@ def fine_tune(args, logger):
 
 
 def downstream_prep(
-    model, args, data, split, task, head_config, weights=None, sampler=False
+    model,
+    args,
+    data,
+    split,
+    task,
+    head_config,
+    weights=None,
+    sampler=False,
+    use_trunk_cache=False,
+    logger=None,
 ):
     network_type = head_config["architecture_parameters"]["network_type"]
     if network_type == "linear":
@@ -226,9 +262,15 @@ def downstream_prep(
         raise ValueError("Head type not supported")
 
     model.py_model.set_head(pred_model)
+    check_reductions([args.reduction])
     model.py_model.reduction = args.reduction
 
     encs = model.categorical_encode(data)
+    inputs, dtype, trunk_cache = encs, torch.int8, None
+    if use_trunk_cache:
+        # The data loaders yield the sample indices, which the cache maps to their input ids and trunk outputs
+        trunk_cache = trunk_cache_prep(model, args, encs, logger)
+        inputs, dtype = np.arange(len(encs)), torch.long
 
     if task == "regression":
         scores = data["score"].values
@@ -257,19 +299,39 @@ def downstream_prep(
 
     training_params = head_config["training_parameters"]
     data_loaders = utils.create_data_loaders(
-        encs,
+        inputs,
         scores,
         scaler=training_params["scaler"],
         batch_size=training_params["batch_size"],
         validation_size=training_params["val_split"],
-        dtype=torch.int8,
+        dtype=dtype,
         split=split,
         num_workers=0,
         weights=weights,
         sampler=sampler,
     )
 
-    return data_loaders, training_params
+    return data_loaders, training_params, trunk_cache
+
+
+def trunk_cache_prep(model, args, encs, logger):
+    """
+    Runs the frozen blocks below the fine-tuned layer once on every sample, or loads their outputs cached
+    by a previous run on the same samples, model and layer.
+    """
+    boundary = model.layer_to_use
+    digest = hashlib.sha256(np.ascontiguousarray(encs.numpy()).tobytes()).hexdigest()[:16]
+    zeroed = "_zeroed" if args.zeroed == "True" else ""
+    path = f"{utils.get_cache_dir()}/trunk_activations/{args.plm}{zeroed}_layer{boundary}_{digest}"
+    return TrunkActivationCache.build(
+        model.py_model,
+        encs,
+        boundary,
+        path,
+        batch_size=max(1, args.max_tokens // encs.shape[1]),
+        device="cuda" if torch.cuda.is_available() else "cpu",
+        logger=logger,
+    )
 
 
 def masked_lm_prep(model, args, data, split, task, head_config, logger):
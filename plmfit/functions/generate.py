@@ -0,0 +1,376 @@
+import glob
+import json
+import os
+import time
+import torch
+import torch.nn.functional as F
+from plmfit.shared_utils import utils
+import plmfit.models.downstream_heads as heads
+from plmfit.shared_utils.layer_capture import LayerCapture
+from plmfit.shared_utils.pooling import pool
+from plmfit.functions.score import N_TERMINAL, C_TERMINAL
+from plmfit.language_models.progen2.models.progen.modeling_progen import (
+    ProGenForCausalLM,
+)
+
+# Generation stops at the end of sequence token or at the C-terminus
+STOP_TOKENS = ("<|eos|>", C_TERMINAL)
+# Tokens that can never be sampled after the prompt
+BANNED_TOKENS = ("<|pad|>", "<|bos|>", N_TERMINAL)
+# Reductions of the head embeddings that can be computed on the finished sequences
+HEAD_REDUCTIONS = ("mean", "sum", "max", "weighted_mean", "bos", "eos")
+
+
+def generate(args, logger):
+    """
+    Samples num_samples sequences per prompt from a ProGen model and streams them to
+    {experiment_name}_generated.fasta as they finish. With --model_path, the sequences are also scored by a
+    trained head in the same pass and only those whose prediction reaches --filter_threshold are written.
+    """
+    model = utils.init_plm(args.plm, logger, task="causal_lm")
+    assert model != None, "Model is not initialized"
+    if not isinstance(model.py_model, ProGenForCausalLM):
+        raise ValueError("Generation is only supported for ProGen models")
+    logger.save_data(vars(args), "arguments")
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    py_model = model.py_model.to(device)
+    head, head_layer, head_reduction = None, -1, "mean"
+    if args.model_path is not None:
+        head = load_head(args.head_config, args.model_path, py_model.config.n_embd)
+        head = head.to(device)
+        layer, head_reduction = load_head_embeddings(args.model_path, args.plm)
+        head_layer = model.get_layer_index(str(layer))
+        logger.log(f"Scoring the sequences on the {head_reduction} embeddings of layer {layer}")
+
+    prompts = read_prompts(args.prompts)
+    fasta_path = f"{logger.base_dir}/{logger.experiment_name}_generated.fasta"
+    n_sequences, n_written, n_tokens = 0, 0, 0
+    start_time = time.time()
+    with open(fasta_path, "w") as f:
+        for record in generate_sequences(
+            py_model,
+            model.tokenizer,
+            prompts,
+            num_samples=args.num_samples,
+            max_length=args.max_length,
+            top_p=args.top_p,
+            temperature=args.temperature,
+            # The key/value cache grows with the generated length, so batches are sized for max_length
+            batch_size=max(1, args.max_tokens // args.max_length),
+            head=head,
+            head_layer=head_layer,
+            head_reduction=head_reduction,
+            device=device,
+            seed=args.seed,
+        ):
+            n_sequences += 1
+            n_tokens += record["n_generated"]
+            if head is not None and record["prediction"] < args.filter_threshold:
+                continue
+            header = f">prompt_{record['prompt']}_sample_{record['sample']}"
+            if head is not None:
+                header += f" prediction={record['prediction']:.4f}"
+            f.write(f"{header}\n{record['sequence']}\n")
+            n_written += 1
+    generation_time = time.time() - start_time
+
+    report = {
+        "n_prompts": len(prompts),
+        "n_sequences": n_sequences,
+        "n_written": n_written,
+        "generated_tokens": n_tokens,
+        "generation_time": f"{generation_time:.4f}",
+        "tokens_per_second": f"{n_tokens / generation_time:.2f}",
+    }
+    logger.save_data(report, "generation_report")
+    logger.log(f"Generated {n_sequences} sequences ({generation_time:.2f}s): {report}")
+
+
+def read_prompts(prompts):
+    """Prompts from a FASTA file, or from a comma-separated list of contexts (e.g. '1' or '1MEV,1MKT')."""
+    if os.path.isfile(prompts):
+        return list(utils.read_fasta(prompts).values())
+    return prompts.split(",")
+
+
+def load_head(head_config, model_path, input_dim):
+    """
+    Loads a head trained with feature extraction, from the state dict saved at the end of training or from
+    the Lightning checkpoint of the best model. The head must have a single output.
+    """
+    config = utils.load_config(f"training/{head_config}")["architecture_parameters"]
+    config["input_dim"] = input_dim
+    if config["output_dim"] != 1:
+        raise ValueError("Only heads with a single output can filter generated sequences")
+    if config["network_type"] == "linear":
+        head = heads.LinearHead(config)
+    elif config["network_type"] == "mlp":
+        head = heads.MLP(config)
+    else:
+        raise ValueError("Head type not supported")
+
+    state_dict = torch.load(model_path, map_location="cpu")
+    if "state_dict" in state_dict:
+        # The head is the model attribute of the LightningModel
+        state_dict = {
+            key.removeprefix("model."): value
+            for key, value in state_dict["state_dict"].items()
+            if key.startswith("model.")
+        }
+    head.load_state_dict(state_dict)
+    return head.eval()
+
+
+def load_head_embeddings(model_path, plm):
+    """
+    Layer and reduction of the embeddings a head was trained on, read from the {experiment}_data.json
+    saved by feature extraction next to its {experiment}.pt (or above the lightning_logs directory of its
+    checkpoint). Heads trained on embeddings of another model, with a reduction that cannot be computed
+    from the generated sequences alone or on scaled features (the scaler is not saved) are refused, since
+    their predictions on the generated sequences would be meaningless.
+    """
+    data_path = f"{os.path.splitext(model_path)[0]}_data.json"
+    if not os.path.isfile(data_path) and model_path.endswith(".ckpt"):
+        experiment_dir = os.path.dirname(os.path.dirname(os.path.abspath(model_path)))
+        data_paths = glob.glob(f"{experiment_dir}/*_data.json")
+        if len(data_paths) == 1:
+            data_path = data_paths[0]
+    if not os.path.isfile(data_path):
+        raise ValueError(
+            f"Cannot find {data_path} with the embeddings the head was trained on"
+        )
+    with open(data_path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    arguments = data.get("arguments", {})
+    if arguments.get("plm", plm) != plm:
+        raise ValueError(
+            f"The head was trained on embeddings of {arguments['plm']}, not of {plm}"
+        )
+    reduction = arguments.get("reduction", "mean")
+    if reduction not in HEAD_REDUCTIONS:
+        raise ValueError(
+            f"The head was trained on {reduction} embeddings, only {', '.join(HEAD_REDUCTIONS)} are supported"
+        )
+    if data.get("head_config", {}).get("training_parameters", {}).get("scaler"):
+        raise ValueError("Heads trained on scaled embeddings cannot filter generated sequences")
+    return arguments.get("layer", "last"), reduction
+
+
+def generate_sequences(
+    model,
+    tokenizer,
+    prompts,
+    num_samples=1,
+    max_length=512,
+    top_p=0.95,
+    temperature=1.0,
+    batch_size=32,
+    head=None,
+    head_layer=-1,
+    head_reduction="mean",
+    device="cpu",
+    seed=None,
+):
+    """
+    Samples num_samples sequences per prompt with nucleus sampling, batch_size sequences at a time, and
+    yields each sequence as soon as it finishes. See sample_batch.
+
+    Yields:
+        dict: prompt and sample indices, sequence (prompt and generated amino acids, without terminal tokens),
+              n_generated (number of sampled tokens) and prediction (head output, or None without a head).
+    """
+    vocab = tokenizer.get_vocab()
+    id_to_token = {token_id: token for token, token_id in vocab.items()}
+    generator = None
+    if seed is not None:
+        generator = torch.Generator(device=device).manual_seed(seed)
+
+    samples = [
+        (prompt_index, sample_index)
+        for prompt_index in range(len(prompts))
+        for sample_index in range(num_samples)
+    ]
+    model.eval()
+    for start in range(0, len(samples), batch_size):
+        batch_samples = samples[start : start + batch_size]
+        prompt_ids = [
+            tokenizer.encode(prompts[prompt_index]).ids
+            for prompt_index, _ in batch_samples
+        ]
+        for row, token_ids, prediction in sample_batch(
+            model,
+            prompt_ids,
+            pad_token_id=vocab["<|pad|>"],
+            stop_token_ids=[vocab[token] for token in STOP_TOKENS],
+            banned_token_ids=[vocab[token] for token in BANNED_TOKENS],
+            max_length=max_length,
+            top_p=top_p,
+            temperature=temperature,
+            head=head,
+            head_layer=head_layer,
+            head_reduction=head_reduction,
+            bos_token_id=vocab["<|bos|>"],
+            eos_token_id=vocab["<|eos|>"],
+            device=device,
+            generator=generator,
+        ):
+            prompt_index, sample_index = batch_samples[row]
+            tokens = [id_to_token[token_id] for token_id in token_ids]
+            yield {
+                "prompt": prompt_index,
+                "sample": sample_index,
+                "sequence": "".join(
+                    token for token in tokens if token not in (N_TERMINAL, *STOP_TOKENS)
+                ),
+                "n_generated": len(token_ids) - len(prompt_ids[row]),
+                "prediction": prediction,
+            }
+
+
+def sample_batch(
+    model,
+    prompt_ids,
+    pad_token_id,
+    stop_token_ids,
+    banned_token_ids=(),
+    max_length=512,
+    top_p=0.95,
+    temperature=1.0,
+    head=None,
+    head_layer=-1,
+    head_reduction="mean",
+    bos_token_id=None,
+    eos_token_id=None,
+    device="cpu",
+    generator=None,
+):
+    """
+    Samples one sequence per prompt with a key/value cache: the (left-padded) prompts are run once and each
+    step only runs the last sampled tokens. A sequence finishes when it samples a stop token or reaches
+    max_length tokens, and is then dropped from the batch and its cache, so the later steps only run the
+    unfinished sequences. Left padding does not change the outputs as the rotary embeddings only depend on
+    relative positions and the padding is masked.
+
+    With a head, the sequences that finish at the same step are encoded as feature extraction encodes them,
+    bos_token_id, the amino acids (the tokens that are neither stop nor banned tokens) and eos_token_id,
+    and the head is applied to their embeddings (see head_predictions).
+
+    Yields:
+        tuple: (index of the prompt, token ids of the prompt and sampled tokens, head prediction or None)
+    """
+    batch_size = len(prompt_ids)
+    prompt_length = max(len(ids) for ids in prompt_ids)
+    input_ids = torch.full((batch_size, prompt_length), pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros((batch_size, prompt_length), dtype=torch.long)
+    for row, ids in enumerate(prompt_ids):
+        input_ids[row, prompt_length - len(ids) :] = torch.as_tensor(ids)
+        attention_mask[row, prompt_length - len(ids) :] = 1
+    input_ids, attention_mask = input_ids.to(device), attention_mask.to(device)
+
+    tokens = [list(ids) for ids in prompt_ids]
+    lengths = torch.as_tensor([len(ids) for ids in prompt_ids], device=device)
+    active = torch.arange(batch_size, device=device)
+    stop_token_ids = torch.as_tensor(stop_token_ids, device=device)
+    banned_token_ids = torch.as_tensor(banned_token_ids, dtype=torch.long, device=device)
+    terminal_token_ids = {*stop_token_ids.tolist(), *banned_token_ids.tolist()}
+    past_key_values = None
+
+    with torch.no_grad(), torch.autocast(
+        "cuda", enabled=str(device).startswith("cuda")
+    ):
+        while len(active) > 0:
+            outputs = model(
+                input_ids,
+                past_key_values=past_key_values,
+                attention_mask=attention_mask,
+                use_cache=True,
+                output_hidden_states=False,
+                return_dict=True,
+            )
+
+            logits = outputs.logits[:, -1].float() / temperature
+            logits[:, banned_token_ids] = -float("inf")
+            probs = F.softmax(top_p_filter(logits, top_p), dim=-1)
+            next_tokens = torch.multinomial(probs, 1, generator=generator).squeeze(1)
+            for row, token in zip(active.tolist(), next_tokens.tolist()):
+                tokens[row].append(token)
+            lengths[active] += 1
+
+            finished = torch.isin(next_tokens, stop_token_ids) | (
+                lengths[active] >= max_length
+            )
+            if finished.any():
+                predictions = None
+                finished_rows = active[finished]
+                if head is not None:
+                    head_input_ids = [
+                        [bos_token_id]
+                        + [token for token in tokens[row] if token not in terminal_token_ids]
+                        + [eos_token_id]
+                        for row in finished_rows.tolist()
+                    ]
+                    predictions = head_predictions(
+                        model,
+                        head_input_ids,
+                        head,
+                        head_layer,
+                        head_reduction,
+                        pad_token_id,
+                        device=device,
+                    )
+                for i, row in enumerate(finished_rows.tolist()):
+                    yield row, tokens[row], None if predictions is None else predictions[i]
+
+            keep = ~finished
+            if not keep.any():
+                break
+            active = active[keep]
+            past_key_values = tuple(
+                tuple(past_state[keep] for past_state in layer_past)
+                for layer_past in outputs.past_key_values
+            )
+            attention_mask = torch.cat(
+                (attention_mask[keep], attention_mask.new_ones((len(active), 1))), dim=1
+            )
+            input_ids = next_tokens[keep].unsqueeze(1)
+
+
+def head_predictions(
+    model, input_ids, head, head_layer, head_reduction, pad_token_id, device="cpu"
+):
+    """
+    Applies the head to the embeddings of the encoded sequences, run in a single right-padded batch: the
+    output of block head_layer normalised by ln_f and pooled over the tokens but the padding with
+    head_reduction, the same as the embeddings extracted for training the head.
+
+    Returns:
+        list: Head prediction of each sequence.
+    """
+    batch = torch.full(
+        (len(input_ids), max(len(ids) for ids in input_ids)), pad_token_id, dtype=torch.long
+    )
+    for row, ids in enumerate(input_ids):
+        batch[row, : len(ids)] = torch.as_tensor(ids)
+    batch = batch.to(device)
+    mask = batch != pad_token_id
+
+    capture = LayerCapture(
+        {"head": model.transformer.h[head_layer]},
+        transform=lambda key, hidden_states: pool(
+            model.transformer.ln_f(hidden_states), head_reduction, mask
+        ),
+    )
+    with capture:
+        model.transformer(batch, use_cache=False, output_hidden_states=False, return_dict=True)
+    return head(capture.outputs["head"].float()).squeeze(-1).float().tolist()
+
+
+def top_p_filter(logits, top_p):
+    """Keeps the smallest set of most likely tokens whose probability reaches top_p (at least one token)."""
+    sorted_logits, sorted_indices = logits.sort(dim=-1, descending=True)
+    sorted_probs = F.softmax(sorted_logits, dim=-1)
+    # Tokens are removed if the more likely tokens already reach top_p
+    removed = sorted_probs.cumsum(dim=-1) - sorted_probs >= top_p
+    sorted_logits = sorted_logits.masked_fill(removed, -float("inf"))
+    return logits.scatter(-1, sorted_indices, sorted_logits)
@@ -52,6 +52,7 @@ def onehot(args, logger):
         max_len,
         logger=logger,
         model_name="proteinbert",
+        source_key=utils.dataset_source_key(data),
     )
 
     if task == "regression":
@@ -130,6 +131,7 @@ def objective(
     sampler=False,
     patience=5,
     num_classes=21,
+    datasets=None,
 ):
     config = copy.deepcopy(head_config)
 
@@ -164,27 +166,24 @@ def objective(
 
     training_params = config["training_parameters"]
 
-    data_loaders = utils.create_data_loaders(
-        embeddings,
-        scores,
-        scaler=training_params["scaler"],
+    embedding_bag = use_embedding_bag(config, task)
+    if datasets is None:
+        datasets = prepare_datasets(
+            task,
+            config,
+            embeddings,
+            scores,
+            split=split,
+            weights=weights,
+            sampler=sampler,
+            num_classes=num_classes,
+        )
+    data_loaders = utils.create_data_loaders_from_datasets(
+        datasets,
         batch_size=training_params["batch_size"],
-        validation_size=training_params["val_split"],
-        split=split,
         num_workers=num_workers,
-        weights=weights,
-        sampler=sampler,
-        dataset_type="one_hot",
     )
 
-    data_loaders["train"].dataset.set_num_classes(num_classes)
-    data_loaders["val"].dataset.set_num_classes(num_classes)
-    data_loaders["test"].dataset.set_num_classes(num_classes)
-    if task == "token_classification":
-        data_loaders["train"].dataset.set_flatten(False)
-        data_loaders["val"].dataset.set_flatten(False)
-        data_loaders["test"].dataset.set_flatten(False)
-
     network_type = config["architecture_parameters"]["network_type"]
     if network_type == "linear":
         config["architecture_parameters"]["input_dim"] = (
@@ -193,6 +192,8 @@ def objective(
             else num_classes
         )  # Account for one-hot encodings
         model = heads.LinearHead(config["architecture_parameters"])
+        if embedding_bag:
+            model = heads.use_embedding_bag(model, embeddings.shape[1], num_classes)
     elif network_type == "mlp":
         config["architecture_parameters"]["input_dim"] = (
             embeddings.shape[1] * num_classes
@@ -200,6 +201,8 @@ def objective(
             else num_classes
         )  # Account for one-hot encodings
         model = heads.MLP(config["architecture_parameters"])
+        if embedding_bag:
+            model = heads.use_embedding_bag(model, embeddings.shape[1], num_classes)
     elif network_type == "rnn":
         config["architecture_parameters"]["input_dim"] = (
             embeddings.shape[1] * num_classes
@@ -322,6 +325,42 @@ def objective(
         logger.save_plot(fig, "confusion_matrix")
 
 
+def use_embedding_bag(config, task):
+    # Linear and MLP heads can look up the token indices instead of multiplying one-hot encodings
+    return (
+        config["architecture_parameters"].get("embedding_bag", False)
+        and config["architecture_parameters"]["network_type"] in ("linear", "mlp")
+        and task != "token_classification"
+    )
+
+
+def prepare_datasets(
+    task,
+    config,
+    embeddings,
+    scores,
+    split=None,
+    weights=None,
+    sampler=False,
+    num_classes=21,
+):
+    training_params = config["training_parameters"]
+    embedding_bag = use_embedding_bag(config, task)
+    return utils.prepare_datasets(
+        embeddings,
+        scores,
+        scaler=training_params["scaler"],
+        validation_size=training_params["val_split"],
+        split=split,
+        weights=weights,
+        sampler=sampler,
+        dtype=embeddings.dtype if embedding_bag else torch.float32,
+        dataset_type="tensor" if embedding_bag else "one_hot",
+        num_classes=num_classes,
+        flatten=task != "token_classification",
+    )
+
+
 def hyperparameter_tuning(
     task,
     args,
@@ -354,6 +393,19 @@ def hyperparameter_tuning(
         load_if_exists=True,
     )
 
+    # The split and tensor conversion do not depend on the tuned hyperparameters,
+    # so they are done once and the datasets are shared by all trials
+    datasets = prepare_datasets(
+        task,
+        head_config,
+        embeddings,
+        scores,
+        split=split,
+        weights=weights,
+        sampler=sampler,
+        num_classes=num_classes,
+    )
+
     logger.log("Starting hyperparameter tuning...")
     logger.mute = True
     study.optimize(
@@ -371,6 +423,7 @@ def hyperparameter_tuning(
             weights=weights,
             sampler=sampler,
             num_classes=num_classes,
+            datasets=datasets,
         ),
         n_trials=n_trials if network_type == "linear" else n_trials * 4,
         callbacks=[LogOptunaTrialCallback(logger)],
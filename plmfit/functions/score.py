@@ -0,0 +1,380 @@
+import hashlib
+import os
+import time
+import numpy as np
+import pandas as pd
+import torch
+import torch.nn.functional as F
+from scipy.stats import spearmanr
+from plmfit.shared_utils import utils
+from plmfit.language_models.progen2.models.progen.configuration_progen import (
+    ProGenConfig,
+)
+from plmfit.language_models.progen2.models.progen.modeling_progen import (
+    ProGenForCausalLM,
+)
+
+# ProGen marks the N-terminus with '1' and the C-terminus with '2', so a reversed sequence reads 2...1
+N_TERMINAL, C_TERMINAL = "1", "2"
+FIRST_AMINO_ACID, LAST_AMINO_ACID = "A", "Z"
+# Substitutions scored by the masked marginals of ESM models
+AMINO_ACIDS = "ACDEFGHIKLMNPQRSTVWY"
+
+
+def score(args, logger):
+    """
+    Zero-shot scoring of the dataset sequences: ProGen log-likelihoods, or for ESM models the masked
+    marginal scores of the mutations of each sequence with respect to the wild type.
+    """
+    data = utils.load_dataset(args.data_type)
+    logger.save_data(vars(args), "arguments")
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+
+    start_time = time.time()
+    if "esm" in args.plm:
+        scores = score_masked_marginals(args, data, logger, device)
+    else:
+        scores = score_log_likelihoods(args, data, logger, device)
+    scoring_time = time.time() - start_time
+
+    scores = pd.DataFrame(scores, index=data.index)
+    scores.insert(0, "aa_seq", data["aa_seq"].values)
+    scores.to_csv(f"{logger.base_dir}/{logger.experiment_name}_scores.csv")
+
+    report = {
+        "dataset_len": len(data),
+        "scoring_time": f"{scoring_time:.4f}",
+        "sequences_per_second": f"{len(data) / scoring_time:.2f}",
+    }
+    if "score" in data.columns:
+        # Zero-shot fitness baseline: rank correlation of the log-likelihood with the measured scores
+        for column in scores.columns.drop("aa_seq"):
+            valid = (data["score"].notna() & scores[column].notna()).values
+            report[f"spearman_{column}"] = float(
+                spearmanr(
+                    data["score"].values[valid], scores[column].values[valid]
+                ).correlation
+            )
+    logger.save_data(report, "score_report")
+    logger.log(f"Scored {len(data)} sequences ({scoring_time:.2f}s): {report}")
+
+
+def score_log_likelihoods(args, data, logger, device):
+    model = utils.init_plm(args.plm, logger, task="causal_lm")
+    assert model != None, "Model is not initialized"
+    if not isinstance(model.py_model, ProGenForCausalLM):
+        raise ValueError("Log-likelihood scoring is only supported for ProGen models")
+
+    # The sequences are encoded without bos/eos, the terminal tokens are added when scoring
+    encs = utils.categorical_encode(
+        data["aa_seq"].values,
+        model.tokenizer,
+        max(data["len"].values),
+        logger=logger,
+        model_name=args.plm,
+        source_key=utils.dataset_source_key(data),
+    )
+    return score_sequences(
+        model.py_model.to(device),
+        encs,
+        model.tokenizer,
+        max_tokens=args.max_tokens,
+        reverse=args.reverse == "True",
+        device=device,
+        shared_prefix=args.prefix_cache == "True",
+    )
+
+
+def score_masked_marginals(args, data, logger, device):
+    model = utils.init_plm(args.plm, logger, task="masked_lm")
+    assert model != None, "Model is not initialized"
+
+    wild_type = utils.get_wild_type(args.data_type)
+    table = get_masked_marginals(
+        model.py_model.to(device),
+        model.tokenizer,
+        wild_type,
+        args.plm,
+        # Each masked position is a copy of the wild type, batched up to max_tokens tokens
+        batch_size=max(1, args.max_tokens // (len(wild_type) + 2)),
+        device=device,
+        logger=logger,
+    )
+    return {"masked_marginal": score_variants(table, wild_type, data["aa_seq"].values)}
+
+
+def score_sequences(
+    model,
+    encs,
+    tokenizer,
+    max_tokens=4096,
+    reverse=False,
+    device="cpu",
+    shared_prefix=False,
+):
+    """
+    Computes the log-likelihood of each encoded sequence (padded with the tokenizer's padding token and
+    without terminal tokens) under a ProGen causal language model, in batches of sequences of similar
+    length. With reverse, the sequences are also scored right-to-left (2...1) and ll_sum / ll_mean are the
+    average of both directions. With shared_prefix, the prefix shared by all the sequences of a direction
+    (e.g. the wild type up to the first mutated position of a mutational library) is run and scored once,
+    and each batch only runs and scores the tokens after it.
+
+    Returns:
+        dict: Arrays aligned to the rows of encs: ll_forward_sum, ll_forward_mean (and ll_reverse_sum,
+              ll_reverse_mean with reverse), ll_sum and ll_mean.
+    """
+    vocab = tokenizer.get_vocab()
+    pad_token_id = utils.get_pad_token_id(tokenizer)
+    encs = torch.as_tensor(encs).long()
+    lengths = (encs != pad_token_id).sum(dim=1)
+    directions = {
+        "forward": add_terminals(
+            encs, lengths, vocab[N_TERMINAL], vocab[C_TERMINAL], pad_token_id
+        )
+    }
+    if reverse:
+        directions["reverse"] = add_terminals(
+            reverse_sequences(encs, lengths, pad_token_id),
+            lengths,
+            vocab[C_TERMINAL],
+            vocab[N_TERMINAL],
+            pad_token_id,
+        )
+
+    sampler = utils.LengthBucketBatchSampler(
+        range(len(encs)), lengths + 2, max_tokens=max_tokens
+    )
+    scores = {}
+    model.eval()
+    with torch.no_grad(), torch.autocast(
+        "cuda", enabled=str(device).startswith("cuda")
+    ):
+        for direction, input_ids in directions.items():
+            ll_sum = torch.zeros(len(encs))
+            n_tokens = torch.zeros(len(encs))
+            prefix = None
+            prefix_length = utils.get_shared_prefix_length(input_ids) if shared_prefix else 0
+            if prefix_length > 1:
+                prefix = score_prefix(
+                    model,
+                    input_ids[:1, :prefix_length].to(device),
+                    vocab[FIRST_AMINO_ACID],
+                    vocab[LAST_AMINO_ACID],
+                )
+            for indices in sampler:
+                indices = torch.as_tensor(indices)
+                batch = input_ids[indices, : int(lengths[indices].max()) + 2].to(device)
+                if prefix is None:
+                    batch_sum, batch_tokens = sequence_log_likelihoods(
+                        model(batch).logits,
+                        batch,
+                        vocab[FIRST_AMINO_ACID],
+                        vocab[LAST_AMINO_ACID],
+                    )
+                else:
+                    batch_sum, batch_tokens = suffix_log_likelihoods(
+                        model,
+                        batch,
+                        prefix,
+                        vocab[FIRST_AMINO_ACID],
+                        vocab[LAST_AMINO_ACID],
+                    )
+                ll_sum[indices] = batch_sum.cpu()
+                n_tokens[indices] = batch_tokens.cpu().float()
+            scores[f"ll_{direction}_sum"] = ll_sum.numpy()
+            scores[f"ll_{direction}_mean"] = (ll_sum / n_tokens.clamp(min=1)).numpy()
+
+    scores["ll_sum"] = np.mean([scores[f"ll_{d}_sum"] for d in directions], axis=0)
+    scores["ll_mean"] = np.mean([scores[f"ll_{d}_mean"] for d in directions], axis=0)
+    return scores
+
+
+def sequence_log_likelihoods(logits, input_ids, first_token, last_token):
+    """
+    Sums the log-likelihoods of the amino acid tokens of each sequence given the preceding tokens, with the
+    predictions restricted to the amino acid tokens [first_token, last_token] and a single gather. Terminal
+    and padding tokens are not scored. Returns the sums and the number of scored tokens.
+    """
+    log_probs = F.log_softmax(logits[:, :-1, first_token : last_token + 1].float(), dim=-1)
+    targets = input_ids[:, 1:]
+    scored = (targets >= first_token) & (targets <= last_token)
+    token_ll = log_probs.gather(
+        -1, (targets - first_token).clamp(0, last_token - first_token).unsqueeze(-1)
+    ).squeeze(-1)
+    token_ll = token_ll.masked_fill(~scored, 0.0)
+    return token_ll.sum(dim=1), scored.sum(dim=1)
+
+
+def score_prefix(model, prefix_ids, first_token, last_token):
+    """
+    Runs the (1, prefix length) prefix shared by the sequences once. Returns its transformer outputs, with
+    the cached keys and values, and the log-likelihood sum and number of scored tokens of the prefix.
+    """
+    prefix_outputs = model.transformer(
+        prefix_ids,
+        use_cache=True,
+        output_attentions=False,
+        output_hidden_states=False,
+        return_dict=True,
+    )
+    prefix_sum, prefix_tokens = sequence_log_likelihoods(
+        model.lm_head(prefix_outputs.last_hidden_state), prefix_ids, first_token, last_token
+    )
+    return prefix_outputs, prefix_sum, prefix_tokens
+
+
+def suffix_log_likelihoods(model, input_ids, prefix, first_token, last_token):
+    """
+    Same as sequence_log_likelihoods for sequences starting with the prefix returned by score_prefix,
+    running only the tokens after the prefix and computing the logits from the last prefix position on.
+    """
+    prefix_outputs, prefix_sum, prefix_tokens = prefix
+    prefix_length = prefix_outputs.last_hidden_state.shape[1]
+    hidden_states = model.transformer.forward_from_prefix(
+        input_ids, prefix_outputs, output_hidden_states=False
+    ).last_hidden_state
+    # The last prefix position predicts the first token after the prefix
+    logits = model.lm_head(hidden_states[:, prefix_length - 1 :])
+    suffix_sum, suffix_tokens = sequence_log_likelihoods(
+        logits, input_ids[:, prefix_length - 1 :], first_token, last_token
+    )
+    return suffix_sum + prefix_sum, suffix_tokens + prefix_tokens
+
+
+def add_terminals(encs, lengths, start_token, end_token, pad_token_id):
+    input_ids = torch.full(
+        (encs.shape[0], encs.shape[1] + 2), pad_token_id, dtype=encs.dtype
+    )
+    input_ids[:, 0] = start_token
+    input_ids[:, 1:-1] = encs
+    input_ids[torch.arange(len(encs)), lengths + 1] = end_token
+    return input_ids
+
+
+def reverse_sequences(encs, lengths, pad_token_id):
+    positions = torch.arange(encs.shape[1])
+    reversed_positions = (lengths.unsqueeze(1) - 1 - positions).clamp(min=0)
+    reversed_encs = encs.gather(1, reversed_positions)
+    return reversed_encs.masked_fill(positions >= lengths.unsqueeze(1), pad_token_id)
+
+
+def get_masked_marginals(
+    model, tokenizer, wild_type, model_name, batch_size=32, device="cpu", logger=None
+):
+    """
+    Returns the masked marginals table of the wild type (see masked_marginals). The table is cached under
+    CACHE_DIR keyed by the model and the wild type, so datasets sharing a wild type reuse it.
+    """
+    key = hashlib.sha256(f"{model_name}\n{wild_type}".encode("utf-8")).hexdigest()[:16]
+    cache_path = f"{utils.get_cache_dir()}/masked_marginals/{model_name}_{key}.npy"
+    if os.path.isfile(cache_path):
+        if logger is not None:
+            logger.log(f"Loaded cached masked marginals from {cache_path}")
+        return np.load(cache_path)
+
+    table = masked_marginals(
+        model, tokenizer, wild_type, batch_size=batch_size, device=device
+    )
+    utils.save_to_cache(lambda path: np.save(path, table), cache_path, logger)
+    return table
+
+
+def masked_marginals(model, tokenizer, wild_type, batch_size=32, device="cpu"):
+    """
+    Computes the (L, 20) table of log-probabilities of the AMINO_ACIDS at each position of the wild type,
+    with that position masked. Each position is masked once, in batches of batch_size positions, so the
+    table costs L sequence forward passes whatever the number of variants scored with it.
+    """
+    input_ids = torch.as_tensor(tokenizer(wild_type)["input_ids"])
+    amino_acid_ids = torch.as_tensor(tokenizer.convert_tokens_to_ids(list(AMINO_ACIDS)))
+    # The encoded wild type starts with <cls>
+    positions = torch.arange(len(wild_type))
+    table = torch.zeros((len(wild_type), len(AMINO_ACIDS)))
+
+    model.eval()
+    with torch.no_grad(), torch.autocast(
+        "cuda", enabled=str(device).startswith("cuda")
+    ):
+        for batch_positions in positions.split(batch_size):
+            batch_rows = torch.arange(len(batch_positions))
+            batch = input_ids.repeat(len(batch_positions), 1)
+            batch[batch_rows, batch_positions + 1] = tokenizer.mask_token_id
+            logits = model(batch.to(device), output_hidden_states=False).logits
+            logits = logits[batch_rows, batch_positions + 1]
+            log_probs = F.log_softmax(logits.float(), dim=-1)
+            table[batch_positions] = log_probs[:, amino_acid_ids.to(device)].cpu()
+    return table.numpy()
+
+
+def score_variants(table, wild_type, seqs):
+    """
+    Scores each sequence as the sum over its substitutions of log p(mutant) - log p(wild type) in the masked
+    marginals table, vectorised over all the sequences. Sequences whose length differs from the wild type,
+    or with substitutions from or to residues outside AMINO_ACIDS, are scored NaN.
+    """
+    seqs = np.asarray(seqs, dtype=str)
+    length = len(wild_type)
+    scores = np.full(len(seqs), np.nan)
+    same_length = np.char.str_len(seqs) == length
+    if not same_length.any():
+        return scores
+
+    lookup = np.full(256, -1)
+    lookup[np.frombuffer(AMINO_ACIDS.encode("ascii"), dtype=np.uint8)] = np.arange(
+        len(AMINO_ACIDS)
+    )
+    residues = np.frombuffer(
+        "".join(seqs[same_length]).encode("ascii"), dtype=np.uint8
+    ).reshape(-1, length)
+    wild_type_residues = np.frombuffer(wild_type.encode("ascii"), dtype=np.uint8)
+
+    rows, positions = np.nonzero(residues != wild_type_residues)
+    mutants = lookup[residues[rows, positions]]
+    wild_types = lookup[wild_type_residues[positions]]
+    deltas = table[positions, mutants] - table[positions, wild_types]
+    deltas[(mutants < 0) | (wild_types < 0)] = np.nan
+    scores[same_length] = np.bincount(rows, weights=deltas, minlength=residues.shape[0])
+    return scores
+
+
+def benchmark_scoring(
+    n_sequences=256, length=128, max_tokens=4096, reverse=True, config=None, seed=42
+):
+    """
+    Measures the scoring throughput (sequences per second) of score_sequences with a randomly initialised
+    ProGen model, by default a tiny configuration, on random sequences of the given maximum length.
+    """
+    tokenizer = utils.load_tokenizer("progen2-small")
+    vocab = tokenizer.get_vocab()
+    if config is None:
+        config = ProGenConfig(
+            vocab_size=len(vocab),
+            n_positions=length + 2,
+            n_ctx=length + 2,
+            n_embd=128,
+            n_layer=4,
+            n_head=8,
+            rotary_dim=8,
+        )
+    generator = torch.Generator().manual_seed(seed)
+    model = ProGenForCausalLM(config).eval()
+    encs = torch.randint(
+        vocab[FIRST_AMINO_ACID],
+        vocab[LAST_AMINO_ACID] + 1,
+        (n_sequences, length),
+        generator=generator,
+    )
+    # Random lengths, so that batches are bucketed as with a real library
+    lengths = torch.randint(length // 2, length + 1, (n_sequences,), generator=generator)
+    encs[torch.arange(length) >= lengths.unsqueeze(1)] = utils.get_pad_token_id(tokenizer)
+
+    start_time = time.time()
+    score_sequences(model, encs, tokenizer, max_tokens=max_tokens, reverse=reverse)
+    elapsed = time.time() - start_time
+    return {
+        "n_sequences": n_sequences,
+        "tokens": int(lengths.sum()) * (2 if reverse else 1),
+        "seconds": elapsed,
+        "sequences_per_second": n_sequences / elapsed,
+    }
@@ -5,6 +5,8 @@ from torch import nn
 from torch.nn import BCEWithLogitsLoss, CrossEntropyLoss, MSELoss
 from transformers.modeling_outputs import SequenceClassifierOutput, MaskedLMOutput, TokenClassifierOutput
 from plmfit.language_models.proteinbert.modeling_bert import ProteinBertPooler
+from plmfit.shared_utils.layer_capture import LayerCapture
+from plmfit.shared_utils.pooling import pool_many, token_mask
 
 class PlmfitEsmForMaskedLM(EsmForMaskedLM):
     _keys_to_ignore_on_load_missing = [r"position_ids", "lm_head.decoder.weight"]
@@ -117,6 +119,9 @@ class PlmfitEsmForSequenceClassification(EsmForSequenceClassification):
         """
         if input_ids is not None:
             input_ids = input_ids.int()
+        # Padding tokens are neither attended to nor pooled
+        if attention_mask is None:
+            attention_mask = token_mask(input_ids, self.config.pad_token_id)
 
         return_dict = return_dict if return_dict is not None else self.config.use_return_dict
 
@@ -131,7 +136,9 @@ class PlmfitEsmForSequenceClassification(EsmForSequenceClassification):
             return_dict=return_dict,
         )
         sequence_output = outputs[0]
-        pooled_output = self.esm.pooler(sequence_output, pooling_method=self.reduction)
+        pooled_output = self.esm.pooler(
+            sequence_output, pooling_method=self.reduction, mask=attention_mask
+        )
         logits = self.classifier(pooled_output)
 
         loss = None
@@ -268,6 +275,9 @@ class PlmfitEsmForEmbdeddingsExtraction(EsmForSequenceClassification):
     def __init__(self, config):
         super().__init__(config)
         self.reduction = "mean"
+        # Set to extract multiple layers and reductions in a single pass
+        self.layers_to_use = None
+        self.reductions = None
         self.esm.pooler = ProteinBertPooler(config=config)
         del self.esm.contact_head
         del self.classifier
@@ -292,23 +302,43 @@ class PlmfitEsmForEmbdeddingsExtraction(EsmForSequenceClassification):
         
         if input_ids is not None:
             input_ids = input_ids.int()
+        # Padding tokens are neither attended to nor pooled
+        if attention_mask is None:
+            attention_mask = token_mask(input_ids, self.config.pad_token_id)
 
         return_dict = (
             return_dict if return_dict is not None else self.config.use_return_dict
         )
 
-        outputs = self.esm(
-            input_ids,
-            attention_mask=attention_mask,
-            position_ids=position_ids,
-            head_mask=head_mask,
-            inputs_embeds=inputs_embeds,
-            output_attentions=output_attentions,
-            output_hidden_states=output_hidden_states,
-            return_dict=return_dict,
+        # The requested layers are pooled as soon as they run, instead of keeping the hidden states of every layer
+        capture = self.capture_layers(
+            self.layers_to_use or {},
+            transform=lambda layer, hidden_states: pool_many(
+                hidden_states, self.reductions, attention_mask
+            ),
         )
+        with capture:
+            outputs = self.esm(
+                input_ids,
+                attention_mask=attention_mask,
+                position_ids=position_ids,
+                head_mask=head_mask,
+                inputs_embeds=inputs_embeds,
+                output_attentions=output_attentions,
+                output_hidden_states=output_hidden_states,
+                return_dict=return_dict,
+            )
         sequence_output = outputs[0]
-        pooled_output = self.esm.pooler(sequence_output, pooling_method=self.reduction)        
+        if self.layers_to_use is not None:
+            pooled_output = {
+                (layer, reduction): capture.outputs[layer][reduction]
+                for layer in self.layers_to_use
+                for reduction in self.reductions
+            }
+        else:
+            pooled_output = self.esm.pooler(
+                sequence_output, pooling_method=self.reduction, mask=attention_mask
+            )
 
         return SequenceClassifierOutput(
             loss=None,
@@ -316,3 +346,19 @@ class PlmfitEsmForEmbdeddingsExtraction(EsmForSequenceClassification):
             hidden_states=outputs.hidden_states,
             attentions=outputs.attentions,
         )
+
+    def capture_layers(self, layers_to_use, transform=None):
+        """
+        Returns a LayerCapture of the outputs of the layers given as {key: layer_index}, normalised by
+        emb_layer_norm_after like the output of the last layer and then passed to transform(key, hidden_states)
+        if given.
+        """
+
+        def normalise(key, hidden_states):
+            hidden_states = self.esm.encoder.emb_layer_norm_after(hidden_states)
+            return hidden_states if transform is None else transform(key, hidden_states)
+
+        return LayerCapture(
+            {key: self.esm.encoder.layer[layer_index] for key, layer_index in layers_to_use.items()},
+            transform=normalise,
+        )
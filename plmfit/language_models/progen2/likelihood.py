@@ -79,8 +79,6 @@ def sample(device, model, tokenizer, context, max_length, num_return_sequences,
 # likelihood
 
 def cross_entropy(logits, target, reduction='mean'):
-    print(logits.shape)
-    print(target.shape)
     return torch.nn.functional.cross_entropy(input=logits, target=target, weight=None, size_average=None, reduce=None, reduction=reduction)
 
 
@@ -96,11 +94,8 @@ def log_likelihood_custom_2(logits, target, reduction='mean'):
     assert len(target.shape) == 1
     assert logits.shape[0] == target.shape[0]
 
-    log_likelihood = 0.0
-    n = logits.shape[0]
-    for i in range(n):
-        log_likelihood += torch.log_softmax(logits, dim=1)[i, target[i]] / (1. if reduction == 'sum' else n)
-    return log_likelihood
+    log_likelihood = torch.log_softmax(logits, dim=1).gather(1, target.unsqueeze(1)).sum()
+    return log_likelihood / (1. if reduction == 'sum' else logits.shape[0])
 
 
 ########################################################################
@@ -180,7 +175,6 @@ def main():
                 logits = model(target, labels=target).logits
 
                 # shift
-                print()
                 logits = logits[:-1, ...]
                 target = target[1:]
 
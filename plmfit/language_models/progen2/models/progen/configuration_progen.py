@@ -47,6 +47,7 @@ class ProGenConfig(PretrainedConfig):
         eos_token_id=50256,
         pad_token_id=0,
         num_labels=1,
+        attention_backend="sdpa",
         **kwargs
     ):
         super().__init__(bos_token_id=bos_token_id, eos_token_id=eos_token_id, **kwargs)
@@ -72,6 +73,8 @@ class ProGenConfig(PretrainedConfig):
         self.bos_token_id = bos_token_id
         self.eos_token_id = eos_token_id
         self.pad_token_id = pad_token_id
+        # 'sdpa' (fused scaled_dot_product_attention) or 'eager', which is always used to output attentions
+        self.attention_backend = attention_backend
 
     @property
     def max_position_embeddings(self):
@@ -29,34 +29,15 @@ from transformers.modeling_outputs import BaseModelOutputWithPast, CausalLMOutpu
 from transformers.modeling_utils import PreTrainedModel
 from transformers.utils import logging
 from transformers.utils.model_parallel_utils import assert_device_map, get_device_map
+from plmfit.shared_utils.layer_capture import LayerCapture
+from plmfit.shared_utils.rotary_embedding import RotaryEmbeddingCache, apply_rotary_pos_emb
+from plmfit.shared_utils.pooling import pool, pool_many, token_mask
 from .configuration_progen import ProGenConfig
 
 
 logger = logging.get_logger(__name__)
 
 
-def fixed_pos_embedding(x, seq_dim=1, seq_len=None):
-    dim = x.shape[-1]
-    if seq_len is None:
-        seq_len = x.shape[seq_dim]
-    inv_freq = 1.0 / (10000 ** (torch.arange(0, dim, 2) / dim))
-    sinusoid_inp = torch.einsum("i , j -> i j", torch.arange(seq_len), inv_freq).to(x.device).float()
-    return torch.sin(sinusoid_inp), torch.cos(sinusoid_inp)
-
-
-def rotate_every_two(x):
-    x1 = x[:, :, :, ::2]
-    x2 = x[:, :, :, 1::2]
-    x = torch.stack((-x2, x1), axis=-1)
-    return x.flatten(-2)  # in einsum notation: rearrange(x, '... d j -> ... (d j)')
-
-
-def apply_rotary_pos_emb(x, sincos, offset=0):
-    sin, cos = map(lambda t: t[None, offset : x.shape[1] + offset, None, :].repeat_interleave(2, 3), sincos)
-    # einsum notation for lambda t: repeat(t[offset:x.shape[1]+offset,:], "n d -> () n () (d j)", j=2)
-    return (x * cos) + (rotate_every_two(x) * sin)
-
-
 class ProGenAttention(nn.Module):
     def __init__(self, config):
         super().__init__()
@@ -85,6 +66,9 @@ class ProGenAttention(nn.Module):
         self.rotary_dim = None
         if config.rotary_dim is not None:
             self.rotary_dim = config.rotary_dim
+        # Replaced by the cache shared by all the layers of the model
+        self.rotary_cache = RotaryEmbeddingCache()
+        self.attention_backend = getattr(config, "attention_backend", "sdpa")
 
     def _split_heads(self, x, n_head, dim_head, mp_num):
         reshaped = x.reshape(x.shape[:-1] + (n_head//mp_num, dim_head))
@@ -142,6 +126,31 @@ class ProGenAttention(nn.Module):
 
         return attn_output, attn_weights
 
+    def _sdpa_attn(self, query, key, value, attention_mask=None):
+        """
+        Same as _attn with the fused scaled_dot_product_attention kernels, without materialising the
+        attention weights.
+        """
+        query_length, key_length = query.size(-2), key.size(-2)
+        query = query.to(value.dtype)
+        key = key.to(value.dtype)
+        dropout_p = self.attn_dropout.p if self.training else 0.0
+
+        if attention_mask is None and query_length == key_length:
+            return nn.functional.scaled_dot_product_attention(
+                query, key, value, dropout_p=dropout_p, is_causal=True
+            )
+
+        # With cached keys the queries are the last positions, so the causal mask is offset
+        causal_mask = self.bias[:, :, key_length - query_length : key_length, :key_length]
+        attn_mask = torch.zeros(causal_mask.shape, dtype=query.dtype, device=query.device)
+        attn_mask = attn_mask.masked_fill(~causal_mask, self.masked_bias.item())
+        if attention_mask is not None:
+            attn_mask = attn_mask + attention_mask.to(query.dtype)
+        return nn.functional.scaled_dot_product_attention(
+            query, key, value, attn_mask=attn_mask, dropout_p=dropout_p
+        )
+
     def forward(
         self,
         hidden_states,
@@ -184,14 +193,18 @@ class ProGenAttention(nn.Module):
             q_rot = query[:, :, :, : self.rotary_dim]
             q_pass = query[:, :, :, self.rotary_dim :]
 
-            sincos = fixed_pos_embedding(k_rot, 1, seq_len=seq_len)
+            sincos = self.rotary_cache.get(
+                seq_len, self.rotary_dim, torch.promote_types(key.dtype, torch.float32), key.device
+            )
             k_rot = apply_rotary_pos_emb(k_rot, sincos, offset=offset)
             q_rot = apply_rotary_pos_emb(q_rot, sincos, offset=offset)
 
             key = torch.cat([k_rot, k_pass], dim=-1)
             query = torch.cat([q_rot, q_pass], dim=-1)
         else:
-            sincos = fixed_pos_embedding(key, 1, seq_len=seq_len)
+            sincos = self.rotary_cache.get(
+                seq_len, key.shape[-1], torch.promote_types(key.dtype, torch.float32), key.device
+            )
             key = apply_rotary_pos_emb(key, sincos, offset=offset)
             query = apply_rotary_pos_emb(query, sincos, offset=offset)
 
@@ -210,7 +223,10 @@ class ProGenAttention(nn.Module):
             present = None
 
         # compute self-attention: V x Softmax(QK^T)
-        attn_output, attn_weights = self._attn(query, key, value, attention_mask, head_mask)
+        if self.attention_backend == "sdpa" and not output_attentions and head_mask is None:
+            attn_output, attn_weights = self._sdpa_attn(query, key, value, attention_mask), None
+        else:
+            attn_output, attn_weights = self._attn(query, key, value, attention_mask, head_mask)
 
         attn_output = self._merge_heads(attn_output, self.num_attention_heads, self.head_dim)
 
@@ -299,6 +315,12 @@ class ProGenPreTrainedModel(PreTrainedModel):
     def __init__(self, *inputs, **kwargs):
         super().__init__(*inputs, **kwargs)
 
+    def pooling_mask(self, input_ids, attention_mask=None):
+        """Mask of the tokens to pool: the attention mask if given, otherwise the tokens that are not padding."""
+        if attention_mask is not None:
+            return attention_mask
+        return token_mask(input_ids, self.config.pad_token_id)
+
     def _init_weights(self, module):
         """Initialize the weights."""
         if isinstance(module, (nn.Linear,)):
@@ -325,6 +347,7 @@ class ProGenModel(ProGenPreTrainedModel):
         self.wte = nn.Embedding(config.vocab_size, self.embed_dim)
         self.drop = nn.Dropout(config.embd_pdrop)
         self.h = nn.ModuleList([ProGenBlock(config) for _ in range(config.n_layer)])
+        self.share_rotary_cache()
         self.ln_f = nn.LayerNorm(self.embed_dim, eps=config.layer_norm_epsilon)
         self.rotary_dim = min(config.rotary_dim, config.n_ctx // config.num_attention_heads)
         self.init_weights()
@@ -364,6 +387,12 @@ class ProGenModel(ProGenPreTrainedModel):
         self.ln_f = self.ln_f.to("cpu")
         torch.cuda.empty_cache()
 
+    def share_rotary_cache(self):
+        """Makes all the blocks use a single rotary sin/cos cache, so the tables are computed once per model."""
+        self.rotary_cache = RotaryEmbeddingCache()
+        for block in self.h:
+            block.attn.rotary_cache = self.rotary_cache
+
     def get_input_embeddings(self):
         return self.wte
 
@@ -545,6 +574,41 @@ class ProGenModel(ProGenPreTrainedModel):
             attentions=all_self_attentions,
         )
 
+    def forward_from_prefix(self, input_ids, prefix_outputs, output_hidden_states=True):
+        """
+        Runs sequences that all start with the same prefix, given the outputs of the prefix computed once
+        with use_cache=True and output_hidden_states=True. Only the tokens after the prefix are run, on top
+        of the cached keys and values of the prefix. As the model is causal, the hidden states are the same
+        as when running the full sequences.
+        """
+        batch_size = input_ids.shape[0]
+        prefix_length = prefix_outputs.last_hidden_state.shape[1]
+        past_key_values = tuple(
+            tuple(past_state.expand(batch_size, *past_state.shape[1:]) for past_state in layer_past)
+            for layer_past in prefix_outputs.past_key_values
+        )
+        outputs = self(
+            input_ids[:, prefix_length:],
+            past_key_values=past_key_values,
+            use_cache=False,
+            output_attentions=False,
+            output_hidden_states=output_hidden_states,
+            return_dict=True,
+        )
+
+        def merge(prefix_states, states):
+            prefix_states = prefix_states.expand(batch_size, -1, -1).to(states.dtype)
+            return torch.cat((prefix_states, states), dim=1)
+
+        return BaseModelOutputWithPast(
+            last_hidden_state=merge(prefix_outputs.last_hidden_state, outputs.last_hidden_state),
+            hidden_states=(
+                tuple(map(merge, prefix_outputs.hidden_states, outputs.hidden_states))
+                if output_hidden_states
+                else None
+            ),
+        )
+
 
 class ProGenForCausalLM(ProGenPreTrainedModel):
     _keys_to_ignore_on_load_missing = [r"h\.\d+\.attn\.masked_bias", r"h\.\d+\.attn\.bias", r"lm_head\.weight"]
@@ -622,7 +686,7 @@ class ProGenForCausalLM(ProGenPreTrainedModel):
         inputs_embeds=None,
         labels=None,
         use_cache=None,
-        output_attentions=True,
+        output_attentions=None,
         output_hidden_states=True,
         return_dict=None,
     ):
@@ -753,7 +817,7 @@ class ProGenForSequenceClassification(ProGenPreTrainedModel):
         inputs_embeds=None,
         labels=None,
         use_cache=None,
-        output_attentions=True,
+        output_attentions=None,
         output_hidden_states=True,
         return_dict=None,
     ):
@@ -781,29 +845,9 @@ class ProGenForSequenceClassification(ProGenPreTrainedModel):
             output_hidden_states=output_hidden_states,
             return_dict=return_dict,
         )
-        hidden_states = transformer_outputs[0]
-        if input_ids is not None:
-            batch_size = input_ids.shape[0]
-        else:
-            batch_size = inputs_embeds.shape[0]
-
-        if self.reduction == 'eos':
-            if self.config.pad_token_id is None and batch_size != 1:
-                raise ValueError("Cannot handle batch sizes > 1 if no padding token is defined.")
-            if self.config.pad_token_id is None:
-                sequence_lengths = -1
-            else:
-                if input_ids is not None:
-                    sequence_lengths = torch.ne(input_ids, self.config.pad_token_id).sum(-1) - 1
-                else:
-                    sequence_lengths = -1
-                    logger.warning(
-                        f"{self.__class__.__name__} will not detect padding tokens in `inputs_embeds`. Results may be "
-                        "unexpected if using padding tokens in conjunction with `inputs_embeds.`"
-                    )
-            hidden_states = hidden_states[torch.arange(batch_size, device=hidden_states.device), sequence_lengths]
-        elif self.reduction == 'mean':
-            hidden_states = torch.mean(hidden_states, dim=1)
+        hidden_states = pool(
+            transformer_outputs[0], self.reduction, self.pooling_mask(input_ids, attention_mask)
+        )
 
         pooled_logits = self.classifier(hidden_states)
 
@@ -856,6 +900,12 @@ class ProGenForEmbeddingsExtraction(ProGenPreTrainedModel):
         self.init_weights()
 
         self.reduction = "eos"
+        # Set to extract multiple layers and reductions in a single pass
+        self.layers_to_use = None
+        self.reductions = None
+        # Set to run a prefix shared by all the sequences only once
+        self.prefix_ids = None
+        self.prefix_outputs = None
 
         # Model parallel
         self.model_parallel = False
@@ -900,8 +950,8 @@ class ProGenForEmbeddingsExtraction(ProGenPreTrainedModel):
         inputs_embeds=None,
         labels=None,
         use_cache=None,
-        output_attentions=True,
-        output_hidden_states=True,
+        output_attentions=None,
+        output_hidden_states=False,
         return_dict=None,
     ):
         r"""
@@ -917,50 +967,49 @@ class ProGenForEmbeddingsExtraction(ProGenPreTrainedModel):
         # Convert input ids to int if not already done
         if input_ids is not None:
             input_ids = input_ids.int()
-        transformer_outputs = self.transformer(
-            input_ids,
-            past_key_values=past_key_values,
-            attention_mask=attention_mask,
-            token_type_ids=token_type_ids,
-            position_ids=position_ids,
-            head_mask=head_mask,
-            inputs_embeds=inputs_embeds,
-            use_cache=use_cache,
-            output_attentions=output_attentions,
-            output_hidden_states=output_hidden_states,
-            return_dict=return_dict,
+        prefix_outputs = None
+        if self.shares_prefix(input_ids) and past_key_values is None and attention_mask is None:
+            prefix_outputs = self.get_prefix_outputs(input_ids.device)
+
+        # Padding tokens are left out of the pooled embeddings
+        mask = self.pooling_mask(input_ids, attention_mask)
+        # The requested layers are pooled as soon as they run, instead of keeping the hidden states of every layer
+        capture = self.capture_layers(
+            self.layers_to_use or {},
+            transform=lambda layer, hidden_states: pool_many(
+                hidden_states, self.reductions, mask
+            ),
+            prefix_outputs=prefix_outputs,
         )
-        hidden_states = transformer_outputs[0]
-        if input_ids is not None:
-            batch_size = input_ids.shape[0]
-        else:
-            batch_size = inputs_embeds.shape[0]
-
-        if self.reduction == "eos":
-            if self.config.pad_token_id is None and batch_size != 1:
-                raise ValueError(
-                    "Cannot handle batch sizes > 1 if no padding token is defined."
+        with capture:
+            if prefix_outputs is not None:
+                transformer_outputs = self.transformer.forward_from_prefix(
+                    input_ids,
+                    prefix_outputs,
+                    output_hidden_states=output_hidden_states,
                 )
-            if self.config.pad_token_id is None:
-                sequence_lengths = -1
             else:
-                if input_ids is not None:
-                    sequence_lengths = (
-                        torch.ne(input_ids, self.config.pad_token_id).sum(-1) - 1
-                    )
-                else:
-                    sequence_lengths = -1
-                    logger.warning(
-                        f"{self.__class__.__name__} will not detect padding tokens in `inputs_embeds`. Results may be "
-                        "unexpected if using padding tokens in conjunction with `inputs_embeds.`"
-                    )
-            hidden_states = hidden_states[
-                torch.arange(batch_size, device=hidden_states.device), sequence_lengths
-            ]
-        elif self.reduction == "mean":
-            hidden_states = torch.mean(hidden_states, dim=1)
-        elif self.reduction == "none":
-            pass
+                transformer_outputs = self.transformer(
+                    input_ids,
+                    past_key_values=past_key_values,
+                    attention_mask=attention_mask,
+                    token_type_ids=token_type_ids,
+                    position_ids=position_ids,
+                    head_mask=head_mask,
+                    inputs_embeds=inputs_embeds,
+                    use_cache=use_cache,
+                    output_attentions=output_attentions,
+                    output_hidden_states=output_hidden_states,
+                    return_dict=return_dict,
+                )
+        if self.layers_to_use is not None:
+            hidden_states = {
+                (layer, reduction): capture.outputs[layer][reduction]
+                for layer in self.layers_to_use
+                for reduction in self.reductions
+            }
+        else:
+            hidden_states = pool(transformer_outputs[0], self.reduction, mask)
 
         return SequenceClassifierOutputWithPast(
             loss=None,
@@ -970,6 +1019,66 @@ class ProGenForEmbeddingsExtraction(ProGenPreTrainedModel):
             attentions=transformer_outputs.attentions,
         )
 
+    def capture_layers(self, layers_to_use, transform=None, prefix_outputs=None):
+        """
+        Returns a LayerCapture of the outputs of the blocks given as {key: layer_index}, normalised by ln_f
+        like the output of the last block and then passed to transform(key, hidden_states) if given. With
+        prefix_outputs, the blocks only run the tokens after the prefix and the prefix states are prepended.
+        """
+
+        def normalise(key, hidden_states):
+            hidden_states = self.transformer.ln_f(hidden_states)
+            if prefix_outputs is not None:
+                prefix_states = self.layer_output(prefix_outputs, layers_to_use[key])
+                prefix_states = prefix_states.expand(hidden_states.shape[0], -1, -1)
+                hidden_states = torch.cat((prefix_states.to(hidden_states.dtype), hidden_states), dim=1)
+            return hidden_states if transform is None else transform(key, hidden_states)
+
+        return LayerCapture(
+            {key: self.transformer.h[layer_index] for key, layer_index in layers_to_use.items()},
+            transform=normalise,
+        )
+
+    def set_prefix(self, prefix_ids):
+        """
+        Sets the token ids of a prefix shared by the sequences (e.g. the wild-type sequence up to the first
+        mutated position of a mutational library), or None to disable it. The prefix is run once and the
+        following batches only run the tokens after it. Batches that do not start with the prefix are run in full.
+        """
+        self.prefix_ids = None if prefix_ids is None else torch.as_tensor(prefix_ids).reshape(1, -1)
+        self.prefix_outputs = None
+
+    def shares_prefix(self, input_ids):
+        if self.prefix_ids is None or input_ids is None:
+            return False
+        prefix_length = self.prefix_ids.shape[1]
+        # At least one token has to be run after the prefix
+        if input_ids.shape[1] <= prefix_length:
+            return False
+        prefix_ids = self.prefix_ids.to(device=input_ids.device, dtype=input_ids.dtype)
+        return bool((input_ids[:, :prefix_length] == prefix_ids).all())
+
+    def get_prefix_outputs(self, device):
+        # Computed on the first batch, so that it runs on the same device and precision as the batches
+        if (
+            self.prefix_outputs is None
+            or self.prefix_outputs.last_hidden_state.device != device
+        ):
+            self.prefix_outputs = self.transformer(
+                self.prefix_ids.to(device).int(),
+                use_cache=True,
+                output_attentions=False,
+                output_hidden_states=True,
+                return_dict=True,
+            )
+        return self.prefix_outputs
+
+    def layer_output(self, transformer_outputs, layer_index):
+        # hidden_states[i + 1] is the output of block i, the output of the last block is already normalised by ln_f
+        if layer_index == len(self.transformer.h) - 1:
+            return transformer_outputs[0]
+        return self.transformer.ln_f(transformer_outputs.hidden_states[layer_index + 1])
+
 
 class ProGenForTokenClassification(ProGenPreTrainedModel):
     _keys_to_ignore_on_load_missing = [
@@ -1031,7 +1140,7 @@ class ProGenForTokenClassification(ProGenPreTrainedModel):
         inputs_embeds=None,
         labels=None,
         use_cache=None,
-        output_attentions=True,
+        output_attentions=None,
         output_hidden_states=True,
         return_dict=None,
     ):
@@ -26,6 +26,8 @@ from torch import nn
 from torch.utils.checkpoint import checkpoint
 from transformers.modeling_outputs import SequenceClassifierOutputWithPast, MaskedLMOutput
 
+from plmfit.shared_utils.layer_capture import LayerCapture
+from plmfit.shared_utils.pooling import pool, pool_many, token_mask
 from .modeling_utils import ProteinConfig
 from .modeling_utils import ProteinModel
 from .modeling_utils import prune_linear_layer
@@ -77,6 +79,8 @@ class ProteinBertConfig(ProteinConfig):
             initializer_range: The sttdev of the truncated_normal_initializer for
                 initializing all weight matrices.
             layer_norm_eps: The epsilon used by LayerNorm.
+            attention_backend: 'sdpa' to use the fused scaled_dot_product_attention
+                kernels, or 'eager'. Outputting attentions always uses 'eager'.
     """
     pretrained_config_archive_map = BERT_PRETRAINED_CONFIG_ARCHIVE_MAP
     
@@ -95,6 +99,7 @@ class ProteinBertConfig(ProteinConfig):
                  type_vocab_size: int = 2,
                  initializer_range: float = 0.02,
                  layer_norm_eps: float = 1e-12,
+                 attention_backend: str = "sdpa",
                  **kwargs):
         super().__init__(**kwargs)
         self.vocab_size = vocab_size
@@ -109,6 +114,7 @@ class ProteinBertConfig(ProteinConfig):
         self.type_vocab_size = type_vocab_size
         self.initializer_range = initializer_range
         self.layer_norm_eps = layer_norm_eps
+        self.attention_backend = attention_backend
         self.model_type = "bert"
 
 
@@ -153,6 +159,7 @@ class ProteinBertSelfAttention(nn.Module):
                 "The hidden size (%d) is not a multiple of the number of attention "
                 "heads (%d)" % (config.hidden_size, config.num_attention_heads))
         self.output_attentions = config.output_attentions
+        self.attention_backend = getattr(config, "attention_backend", "sdpa")
 
         self.num_attention_heads = config.num_attention_heads
         self.attention_head_size = int(config.hidden_size / config.num_attention_heads)
@@ -178,6 +185,16 @@ class ProteinBertSelfAttention(nn.Module):
         key_layer = self.transpose_for_scores(mixed_key_layer)
         value_layer = self.transpose_for_scores(mixed_value_layer)
 
+        if self.attention_backend == "sdpa" and not self.output_attentions:
+            # Fused kernel, the attention probabilities are never materialised
+            context_layer = nn.functional.scaled_dot_product_attention(
+                query_layer, key_layer, value_layer,
+                attn_mask=attention_mask.to(query_layer.dtype),
+                dropout_p=self.dropout.p if self.training else 0.0)
+            context_layer = context_layer.permute(0, 2, 1, 3).contiguous()
+            new_context_layer_shape = context_layer.size()[:-2] + (self.all_head_size,)
+            return (context_layer.view(*new_context_layer_shape),)
+
         # Take the dot product between "query" and "key" to get the raw attention scores.
         attention_scores = torch.matmul(query_layer, key_layer.transpose(-1, -2))
         attention_scores = attention_scores / math.sqrt(self.attention_head_size)
@@ -369,19 +386,16 @@ class ProteinBertPooler(nn.Module):
         self.dense = nn.Linear(config.hidden_size, config.hidden_size)
         self.activation = nn.Tanh()
 
-    def forward(self, hidden_states, pooling_method='default'):
+    def forward(self, hidden_states, pooling_method='default', mask=None):
         # We "pool" the model by simply taking the hidden state corresponding
         # to the first token.
         if pooling_method == 'default':
             first_token_tensor = hidden_states[:, 0]
             pooled_output = self.dense(first_token_tensor)
             pooled_output = self.activation(pooled_output)
-        elif pooling_method == 'bos':
-            pooled_output = hidden_states[:, 0]
-        elif pooling_method == 'mean':
-            pooled_output = torch.mean(hidden_states, dim=1)
-        elif pooling_method == 'none':
-            pooled_output = hidden_states
+        else:
+            # Any reduction of the pooling module, without the padding tokens of mask
+            pooled_output = pool(hidden_states, pooling_method, mask)
         return pooled_output
 
 
@@ -393,6 +407,13 @@ class ProteinBertAbstractModel(ProteinModel):
     pretrained_model_archive_map = BERT_PRETRAINED_MODEL_ARCHIVE_MAP
     base_model_prefix = "bert"
 
+    def pooling_mask(self, input_ids, input_mask=None):
+        """Mask of the tokens to attend and pool: input_mask if given, otherwise the tokens that are not padding."""
+        if input_mask is not None:
+            return input_mask
+        # The word embeddings use 0 as padding index
+        return token_mask(input_ids, 0)
+
     def _init_weights(self, module):
         """ Initialize the weights """
         if isinstance(module, (nn.Linear, nn.Embedding)):
@@ -538,13 +559,16 @@ class ProteinBertForSequenceClassification(ProteinBertAbstractModel):
     def forward(self, input_ids, input_mask=None, targets=None):
         if input_ids is not None:
             input_ids = input_ids.int()
+        input_mask = self.pooling_mask(input_ids, input_mask)
         outputs = self.bert(input_ids, input_mask=input_mask)
         
         # The first element of outputs is the last layer hidden-state
         sequence_output = outputs[0]
         # The third element of outputs is the hidden states from all layers
         all_hidden_states = outputs[2]
-        pooled_output = self.bert.pooler(sequence_output, pooling_method=self.reduction)
+        pooled_output = self.bert.pooler(
+            sequence_output, pooling_method=self.reduction, mask=input_mask
+        )
 
         logits = self.classifier(pooled_output)
         # (loss), prediction_scores, (hidden_states), (attentions)
@@ -597,10 +621,12 @@ class ProteinBertForContactPrediction(ProteinBertAbstractModel):
 class ProteinBertForEmbeddingsExtraction(ProteinBertAbstractModel):
 
     def __init__(self, config):
-        config.output_hidden_states = True
         super().__init__(config)
         self.bert = ProteinBertModel(config)
         self.reduction = "bos"
+        # Set to extract multiple layers and reductions in a single pass
+        self.layers_to_use = None
+        self.reductions = None
         self.init_weights()
 
     def trim_model(self, layer_to_use):
@@ -608,16 +634,45 @@ class ProteinBertForEmbeddingsExtraction(ProteinBertAbstractModel):
             list(self.bert.encoder.layer.children())[: layer_to_use + 1]
         )
 
+    def capture_layers(self, layers_to_use, transform=None):
+        """
+        Returns a LayerCapture of the outputs of the layers given as {key: layer_index}, passed to
+        transform(key, hidden_states) if given.
+        """
+        return LayerCapture(
+            {key: self.bert.encoder.layer[layer_index] for key, layer_index in layers_to_use.items()},
+            transform=transform,
+        )
+
     def forward(self, input_ids, input_mask=None, targets=None):
         if input_ids is not None:
             input_ids = input_ids.int()
-        outputs = self.bert(input_ids, input_mask=input_mask)
+        # Padding tokens are neither attended to nor pooled
+        input_mask = self.pooling_mask(input_ids, input_mask)
+        # The requested layers are pooled as soon as they run, instead of keeping the hidden states of every layer
+        capture = self.capture_layers(
+            self.layers_to_use or {},
+            transform=lambda layer, hidden_states: pool_many(
+                hidden_states, self.reductions, input_mask
+            ),
+        )
+        with capture:
+            outputs = self.bert(input_ids, input_mask=input_mask)
 
         # The first element of outputs is the last layer hidden-state
         sequence_output = outputs[0]
-        # The third element of outputs is the hidden states from all layers
-        all_hidden_states = outputs[2]
-        pooled_output = self.bert.pooler(sequence_output, pooling_method=self.reduction)
+        # The third element of outputs is the hidden states from all layers, if the config outputs them
+        all_hidden_states = outputs[2] if self.config.output_hidden_states else None
+        if self.layers_to_use is not None:
+            pooled_output = {
+                (layer, reduction): capture.outputs[layer][reduction]
+                for layer in self.layers_to_use
+                for reduction in self.reductions
+            }
+        else:
+            pooled_output = self.bert.pooler(
+                sequence_output, pooling_method=self.reduction, mask=input_mask
+            )
 
         # (loss), prediction_scores, (hidden_states), (attentions)
         return SequenceClassifierOutputWithPast(
@@ -30,6 +30,63 @@ class LinearHead(nn.Module):
             x = self.activation(x)
         return x
 
+    def fit(self, x, y, loss_f='mse', weight_decay=0.0, max_iter=100):
+        """
+        Fits the layer on the whole training set at once instead of with gradient descent: closed-form
+        ridge regression for 'mse', and L-BFGS on the logistic loss of the pre-activation logits for
+        'bce', 'bce_logits' and 'cross_entropy'. With an output activation, 'mse' has no closed form and
+        is minimised on the activated outputs with L-BFGS, starting from the current weights. The weight
+        decay is the L2 penalty (weight_decay / 2 * ||W||^2) added to the mean loss, which is the objective
+        gradient descent with the same weight decay converges to. The bias is not penalised.
+        """
+        x = x.detach().to(torch.float64).reshape(x.size(0), -1)
+        y = y.detach().to(torch.float64)
+        n, input_dim = x.shape
+        output_dim = self.linear.out_features
+
+        if loss_f == 'mse' and "output_activation" not in self.config:
+            y = y.reshape(n, -1)
+            # Centering the data removes the bias from the normal equations
+            x_mean, y_mean = x.mean(dim=0), y.mean(dim=0)
+            x_centered, y_centered = x - x_mean, y - y_mean
+            gram = x_centered.T @ x_centered
+            gram += (n * weight_decay / 2) * torch.eye(input_dim, dtype=gram.dtype)
+            weight = torch.linalg.lstsq(gram, x_centered.T @ y_centered).solution
+            bias = y_mean - x_mean @ weight
+        elif loss_f in ('mse', 'bce', 'bce_logits', 'cross_entropy'):
+            if loss_f == 'mse':
+                y = y.reshape(n, -1)
+                weight = self.linear.weight.detach().T.to(x.dtype).clone().requires_grad_()
+                bias = self.linear.bias.detach().to(x.dtype).clone().requires_grad_()
+            else:
+                weight = torch.zeros((input_dim, output_dim), dtype=x.dtype, requires_grad=True)
+                bias = torch.zeros(output_dim, dtype=x.dtype, requires_grad=True)
+            optimizer = torch.optim.LBFGS(
+                [weight, bias], max_iter=max_iter, line_search_fn='strong_wolfe'
+            )
+
+            def closure():
+                optimizer.zero_grad()
+                logits = x @ weight + bias
+                if loss_f == 'mse':
+                    loss = F.mse_loss(self.activation(logits), y)
+                elif output_dim == 1:
+                    loss = F.binary_cross_entropy_with_logits(logits.squeeze(dim=1), y)
+                else:
+                    loss = F.cross_entropy(logits, y.long())
+                loss = loss + weight_decay / 2 * weight.pow(2).sum()
+                loss.backward()
+                return loss
+
+            optimizer.step(closure)
+        else:
+            raise ValueError(f"Unsupported loss function for the solver: {loss_f}")
+
+        with torch.no_grad():
+            self.linear.weight.copy_(weight.T)
+            self.linear.bias.copy_(bias)
+        return self
+
 
 class MLP(nn.Module):
     def __init__(self, config):
@@ -109,6 +166,49 @@ class RNN(nn.Module):
         init.normal_(self.fc.weight, mean=0.0, std=0.01, generator=random_state)
         init.constant_(self.fc.bias, 0)
 
+class OneHotEmbeddingBag(nn.Module):
+    """
+    Linear layer over flattened one-hot encodings that consumes the token indices directly.
+    Multiplying a one-hot vector by the weight matrix selects one weight column per position, so
+    the output is the sum of seq_len embedding lookups and the one-hot matrix is never materialised.
+    """
+
+    def __init__(self, seq_len, num_classes, out_features):
+        super(OneHotEmbeddingBag, self).__init__()
+        self.seq_len = seq_len
+        self.num_classes = num_classes
+        self.embedding_bag = nn.EmbeddingBag(seq_len * num_classes, out_features, mode='sum')
+        self.bias = nn.Parameter(torch.zeros(out_features))
+        self.register_buffer(
+            'offsets', torch.arange(seq_len) * num_classes, persistent=False
+        )
+
+    @classmethod
+    def from_linear(cls, linear, seq_len, num_classes):
+        """Creates the layer from the weights of a nn.Linear with seq_len * num_classes inputs."""
+        layer = cls(seq_len, num_classes, linear.out_features)
+        with torch.no_grad():
+            layer.embedding_bag.weight.copy_(linear.weight.t())
+            if linear.bias is not None:
+                layer.bias.copy_(linear.bias)
+        return layer
+
+    def forward(self, x):
+        # Position l and token t select row l * num_classes + t of the flattened weight
+        return self.embedding_bag(x.long() + self.offsets) + self.bias
+
+
+def use_embedding_bag(model, seq_len, num_classes):
+    """Replaces the input layer of a LinearHead or MLP with a OneHotEmbeddingBag of the same weights."""
+    if isinstance(model, LinearHead):
+        model.linear = OneHotEmbeddingBag.from_linear(model.linear, seq_len, num_classes)
+    elif isinstance(model, MLP):
+        model.layers[0] = OneHotEmbeddingBag.from_linear(model.layers[0], seq_len, num_classes)
+    else:
+        raise ValueError("Embedding bag input is only supported for linear and mlp heads")
+    return model
+
+
 class AdapterLayer(nn.Module):
     def __init__(self, in_features, bottleneck_dim ,dropout= 0.25 , eps = 1e-5):
         super().__init__()
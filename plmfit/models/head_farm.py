@@ -0,0 +1,311 @@
+import copy
+import json
+import os
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.func import functional_call, stack_module_state
+import plmfit.models.downstream_heads as heads
+from plmfit.models.lightning_model import Metrics
+
+# Per-head hyperparameters of a head farm, and the section of the head config they belong to
+FARM_PARAMETERS = {
+    "learning_rate": "training_parameters",
+    "weight_decay": "training_parameters",
+    "hidden_dropout": "architecture_parameters",
+}
+# LightningModel wraps its optimizer in a ConstantLR scheduler with the default factor and total_iters,
+# stepped every epoch: the learning rate is scaled by LR_FACTOR for the first LR_FACTOR_EPOCHS epochs
+LR_FACTOR = 1 / 3
+LR_FACTOR_EPOCHS = 5
+
+
+class PerHeadDropout(nn.Module):
+    """Dropout whose probability is a buffer, so that each of the stacked heads of a farm has its own."""
+
+    def __init__(self, p):
+        super().__init__()
+        self.register_buffer("p", torch.tensor(float(p)), persistent=False)
+
+    def forward(self, x):
+        if not self.training:
+            return x
+        keep = torch.rand_like(x) >= self.p
+        return x * keep / (1 - self.p).clamp(min=1e-12)
+
+
+def build_head(architecture_parameters):
+    """LinearHead or MLP whose dropout layers can be stacked with different probabilities."""
+    network_type = architecture_parameters["network_type"]
+    if network_type == "linear":
+        return heads.LinearHead(architecture_parameters)
+    if network_type == "mlp":
+        head = heads.MLP(architecture_parameters)
+        for i, layer in enumerate(head.layers):
+            if isinstance(layer, nn.Dropout):
+                head.layers[i] = PerHeadDropout(layer.p)
+        return head
+    raise ValueError("The head farm only supports linear and mlp heads")
+
+
+class HeadFarm:
+    """
+    Trains many heads of the same architecture at once, e.g. the configurations of a hyperparameter sweep
+    or the seeds of a multi-seed run. The parameters of the heads are stacked with
+    torch.func.stack_module_state and the heads are run with vmap on the same batches, so one training
+    loop over the data trains every head. Each head has its own learning rate, weight decay and dropout,
+    and is optimised on its own loss (heads do not share parameters, so the gradient of the sum of the
+    losses is the gradient of each loss for each head).
+
+    The optimisers (adam and sgd) with their learning rate schedule, loss functions, gradient clipping and
+    early stopping are the same as those of LightningModel, applied per head: a head that stops early is
+    masked out of the updates and the parameters of its best validation epoch are kept.
+    """
+
+    def __init__(
+        self,
+        heads,
+        learning_rates,
+        weight_decays,
+        loss_f="mse",
+        optimizer="adam",
+        task="regression",
+        no_classes=1,
+        gradient_clipping=0,
+        device="cpu",
+    ):
+        if optimizer not in ("adam", "sgd"):
+            raise ValueError(f"Unsupported optimizer: {optimizer}")
+        self.n_heads = len(heads)
+        self.loss_f = loss_f
+        self.optimizer = optimizer
+        self.task = task
+        self.no_classes = no_classes
+        self.gradient_clipping = gradient_clipping
+        self.device = device
+
+        params, buffers = stack_module_state([head.to(device) for head in heads])
+        self.params = params
+        self.buffers = buffers
+        self.base = copy.deepcopy(heads[0]).to("meta")
+        self.learning_rates = torch.as_tensor(learning_rates, dtype=torch.float32, device=device)
+        self.weight_decays = torch.as_tensor(weight_decays, dtype=torch.float32, device=device)
+        self.steps = torch.zeros(self.n_heads, device=device)
+        self.epoch = 0
+        self.state = {
+            name: {"exp_avg": torch.zeros_like(param), "exp_avg_sq": torch.zeros_like(param)}
+            for name, param in self.params.items()
+        }
+        self.best_params = {name: param.detach().clone() for name, param in self.params.items()}
+
+    def __call__(self, x, params=None):
+        """(n_heads, batch, ...) outputs of every head."""
+
+        def call(params, buffers, x):
+            return functional_call(self.base, (params, buffers), (x,))
+
+        params = self.params if params is None else params
+        return torch.vmap(call, in_dims=(0, 0, None), randomness="different")(
+            params, self.buffers, x
+        )
+
+    def prepare(self, outputs, labels):
+        # Same outputs and labels as in the steps of LightningModel
+        if self.task == "classification" and self.no_classes > 1:
+            labels = F.one_hot(labels.long(), num_classes=self.no_classes).float()
+        else:
+            outputs = outputs.squeeze(dim=2)
+        return outputs, labels
+
+    def losses(self, outputs, labels):
+        """(n_heads,) mean loss of each head on a batch."""
+        outputs, labels = self.prepare(outputs, labels)
+        labels = labels.to(outputs.dtype).expand_as(outputs)
+        if self.loss_f == "mse":
+            loss = F.mse_loss(outputs, labels, reduction="none")
+        elif self.loss_f == "bce":
+            loss = F.binary_cross_entropy(outputs, labels, reduction="none")
+        elif self.loss_f == "bce_logits":
+            loss = F.binary_cross_entropy_with_logits(outputs, labels, reduction="none")
+        elif self.loss_f == "cross_entropy":
+            loss = F.cross_entropy(
+                outputs.flatten(0, 1), labels.flatten(0, 1), reduction="none"
+            )
+            loss = loss.view(self.n_heads, -1)
+        else:
+            raise ValueError(f"Unsupported loss function: {self.loss_f}")
+        return loss.flatten(1).mean(dim=1)
+
+    def step(self, active, beta1=0.9, beta2=0.999, eps=1e-8):
+        """One step of the optimizer of each active head, as torch.optim.Adam or SGD with its own lr and weight decay."""
+        self.steps += active
+        grads = {name: param.grad for name, param in self.params.items() if param.grad is not None}
+        if self.gradient_clipping:
+            norm = torch.stack(
+                [grad.flatten(1).pow(2).sum(dim=1) for grad in grads.values()]
+            ).sum(dim=0).sqrt()
+            clip = (self.gradient_clipping / (norm + 1e-6)).clamp(max=1.0)
+        learning_rates = self.learning_rates * (LR_FACTOR if self.epoch < LR_FACTOR_EPOCHS else 1.0)
+        with torch.no_grad():
+            for name, grad in grads.items():
+                param = self.params[name]
+                shape = (-1,) + (1,) * (param.dim() - 1)
+                mask = active.view(shape)
+                if self.gradient_clipping:
+                    grad = grad * clip.view(shape)
+                grad = grad + self.weight_decays.view(shape) * param
+                if self.optimizer == "sgd":
+                    update = learning_rates.view(shape) * grad
+                else:
+                    state = self.state[name]
+                    exp_avg = torch.where(mask, beta1 * state["exp_avg"] + (1 - beta1) * grad, state["exp_avg"])
+                    exp_avg_sq = torch.where(
+                        mask, beta2 * state["exp_avg_sq"] + (1 - beta2) * grad * grad, state["exp_avg_sq"]
+                    )
+                    state["exp_avg"], state["exp_avg_sq"] = exp_avg, exp_avg_sq
+                    steps = self.steps.clamp(min=1).view(shape)
+                    denom = (exp_avg_sq.sqrt() / (1 - beta2**steps).sqrt()) + eps
+                    update = learning_rates.view(shape) / (1 - beta1**steps) * exp_avg / denom
+                param.copy_(torch.where(mask, param - update, param))
+                param.grad = None
+
+    def train_epoch(self, loader, active, accumulate_grad_batches=1, limit_batches=None):
+        self.base.train()
+        total, n_samples = torch.zeros(self.n_heads, device=self.device), 0
+        n_batches = len(loader) if limit_batches is None else min(limit_batches, len(loader))
+        for batch_idx, batch in enumerate(loader):
+            if batch_idx >= n_batches:
+                break
+            x, labels = batch[0].to(self.device), batch[1].to(self.device)
+            losses = self.losses(self(x.float()), labels)
+            (losses[active].sum() / accumulate_grad_batches).backward()
+            if (batch_idx + 1) % accumulate_grad_batches == 0 or batch_idx + 1 == n_batches:
+                self.step(active)
+            total += losses.detach() * len(x)
+            n_samples += len(x)
+        self.epoch += 1
+        return total / max(n_samples, 1)
+
+    def evaluate(self, loader, params=None, limit_batches=None):
+        """(n_heads,) mean loss of each head on the samples of the loader."""
+        self.base.eval()
+        total, n_samples = torch.zeros(self.n_heads, device=self.device), 0
+        with torch.no_grad():
+            for batch_idx, batch in enumerate(loader):
+                if limit_batches is not None and batch_idx >= limit_batches:
+                    break
+                x, labels = batch[0].to(self.device), batch[1].to(self.device)
+                total += self.losses(self(x.float(), params), labels) * len(x)
+                n_samples += len(x)
+        return total / max(n_samples, 1)
+
+    def fit(
+        self,
+        train_loader,
+        val_loader,
+        epochs,
+        patience=-1,
+        accumulate_grad_batches=1,
+        epoch_sizing=1.0,
+        logger=None,
+    ):
+        """
+        Trains every head until it stops improving on the validation set for patience epochs (never with
+        patience -1) or for epochs epochs.
+
+        Returns:
+            dict: epoch_train_loss and epoch_val_loss (one list per head, over the epochs it trained),
+                  best_val_loss and best_epoch of each head.
+        """
+        limit_train = max(1, int(len(train_loader) * epoch_sizing))
+        limit_val = max(1, int(len(val_loader) * epoch_sizing))
+        active = torch.ones(self.n_heads, dtype=torch.bool, device=self.device)
+        best_val_loss = torch.full((self.n_heads,), float("inf"), device=self.device)
+        best_epoch = torch.zeros(self.n_heads, dtype=torch.long, device=self.device)
+        epochs_no_improve = torch.zeros(self.n_heads, dtype=torch.long, device=self.device)
+        history = {
+            "epoch_train_loss": [[] for _ in range(self.n_heads)],
+            "epoch_val_loss": [[] for _ in range(self.n_heads)],
+        }
+        for epoch in range(epochs):
+            if not active.any():
+                break
+            train_loss = self.train_epoch(
+                train_loader, active, accumulate_grad_batches, limit_train
+            )
+            val_loss = self.evaluate(val_loader, limit_batches=limit_val)
+            for head in active.nonzero().flatten().tolist():
+                history["epoch_train_loss"][head].append(train_loss[head].item())
+                history["epoch_val_loss"][head].append(val_loss[head].item())
+
+            improved = active & (val_loss < best_val_loss)
+            for name, param in self.params.items():
+                self.best_params[name][improved] = param.detach()[improved]
+            best_val_loss = torch.where(improved, val_loss, best_val_loss)
+            best_epoch[improved] = epoch
+            epochs_no_improve = torch.where(improved, 0, epochs_no_improve + 1)
+            if patience != -1:
+                active &= epochs_no_improve < patience
+            if logger is not None:
+                logger.log(
+                    f"Epoch {epoch + 1}/{epochs} | active heads: {int(active.sum())}/{self.n_heads} | "
+                    f"best val loss: {best_val_loss.min().item():.4f}"
+                )
+
+        history["best_val_loss"] = best_val_loss.tolist()
+        history["best_epoch"] = best_epoch.tolist()
+        return history
+
+    def predict(self, loader):
+        """Outputs of the best parameters of every head, (n_heads, n_samples, ...), with the labels and ids."""
+        self.base.eval()
+        outputs, labels, ids = [], [], []
+        with torch.no_grad():
+            for batch in loader:
+                outputs.append(self(batch[0].to(self.device).float(), self.best_params))
+                labels.append(batch[1])
+                ids.append(batch[2])
+        return torch.cat(outputs, dim=1).cpu(), torch.cat(labels), torch.cat(ids)
+
+    def test_metrics(self, loader):
+        """Metrics of each head on the samples of the loader, as computed by LightningModel.test_step."""
+        outputs, labels, ids = self.predict(loader)
+        if not (self.task == "classification" and self.no_classes > 1):
+            outputs = outputs.squeeze(dim=2)
+        all_metrics = []
+        for head in range(self.n_heads):
+            metrics = Metrics(self.task, no_classes=self.no_classes)
+            metrics.add(outputs[head], labels, ids)
+            metrics.get_metrics()
+            all_metrics.append(metrics)
+        return all_metrics
+
+    def state_dict(self, head):
+        """State dict of the best parameters of a head, loadable by a LinearHead or MLP."""
+        return {name: param[head].detach().cpu().clone() for name, param in self.best_params.items()}
+
+
+def save_head_report(path, head_config, history, metrics, state_dict, report):
+    """
+    Writes the reports of a head of a farm at {path}_*, in the same format as a single training run:
+    {path}_loss.json, {path}_metrics.json, {path}_predictions.npz, {path}_data.json and the model at
+    {path}.pt.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f"{path}_loss.json", "w", encoding="utf-8") as f:
+        json.dump(
+            {
+                "epoch_train_loss": history["epoch_train_loss"],
+                "epoch_val_loss": history["epoch_val_loss"],
+            },
+            f,
+            indent=4,
+        )
+    metrics.save_metrics(path=path)
+    with open(f"{path}_data.json", "w", encoding="utf-8") as f:
+        json.dump(
+            {"head_config": head_config, "report": report, "metrics": metrics.report["main"]},
+            f,
+            indent=4,
+        )
+    torch.save(state_dict, f"{path}.pt")
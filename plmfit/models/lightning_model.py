@@ -4,6 +4,7 @@ import torch
 from torchmetrics import classification, regression, text
 import time
 import json
+import numpy as np
 from deepspeed.ops.adam import DeepSpeedCPUAdam
 from lightning.pytorch.strategies import DeepSpeedStrategy
 from plmfit.shared_utils import utils
@@ -28,6 +29,7 @@ from torchmetrics.regression import (
 )
 from torchmetrics.text import Perplexity
 from lightning.pytorch.callbacks import BasePredictionWriter
+from plmfit.shared_utils.embedding_store import EmbeddingStore
 
 
 class LightningModel(L.LightningModule):
@@ -470,9 +472,7 @@ class LightningModel(L.LightningModule):
         return loss
 
     def on_test_end(self) -> None:
-        self.metrics.preds_list = self.merge_lists(self.metrics.preds_list)
-        self.metrics.actual_list = self.merge_lists(self.metrics.actual_list)
-        self.metrics.ids = self.merge_lists(self.metrics.ids)
+        self.metrics.gather(device=self.device)
         metrics = self.metrics.get_metrics(device=self.device)
         self.plmfit_logger.log(
             f'loss: {self.trainer.logged_metrics["test_loss_epoch"]:.4f} {time.time() - self.epoch_start_time:.4f}s'
@@ -510,6 +510,58 @@ class LightningModel(L.LightningModule):
             f"Prediction ended in {time.time() - self.epoch_start_time:.4f}s"
         )
 
+    ### SOLVER ###
+    def fit_solver(self, train_dataset, val_dataset):
+        """
+        Fits the head (a LinearHead) with its direct solver on the full training set instead of with
+        the Trainer, and returns the validation loss.
+        """
+        start_time = time.time()
+        input, labels = utils.dataset_to_tensors(train_dataset)[:2]
+        self.model.fit(
+            input,
+            labels,
+            loss_f=self.hparams.loss_f,
+            weight_decay=float(self.hparams.weight_decay or 0.0),
+        )
+        outputs, labels = self.solver_outputs(*utils.dataset_to_tensors(val_dataset)[:2])
+        loss = self.loss_function(outputs, labels).item()
+        self.plmfit_logger.log(
+            f"(solver) fitted in {time.time() - start_time:.4f}s | val loss: {loss:.4f}"
+        )
+        return loss
+
+    def test_solver(self, test_dataset):
+        """Tests a head fitted with fit_solver and saves the same metrics as on_test_end."""
+        self.plmfit_logger.log("\n\nTESTING")
+        self.plmfit_logger.log("-" * 10)
+        input, labels, ids = utils.dataset_to_tensors(test_dataset)[:3]
+        outputs, labels = self.solver_outputs(input, labels)
+        self.plmfit_logger.log(f"loss: {self.loss_function(outputs, labels).item():.4f}")
+
+        if self.model.task == "classification" and self.hparams.no_classes > 1:
+            labels = torch.argmax(labels, dim=1)
+        self.metrics.add(outputs, labels, ids)
+        metrics = self.metrics.get_metrics()
+        for key, value in metrics["main"].items():
+            self.plmfit_logger.log(f"{key}: {value}")
+        self.plmfit_logger.save_data(metrics["main"], "metrics")
+        self.metrics.save_metrics(
+            path=f"{self.plmfit_logger.base_dir}/{self.plmfit_logger.experiment_name}"
+        )
+
+    def solver_outputs(self, input, labels):
+        # Same outputs and labels as in the validation and test steps
+        with torch.no_grad():
+            outputs = self(input.to(torch.float32))
+        if self.model.task == "classification" and self.hparams.no_classes > 1:
+            labels = torch.nn.functional.one_hot(
+                labels.long(), num_classes=self.hparams.no_classes
+            ).float()
+        else:
+            outputs = outputs.squeeze(dim=1)
+        return outputs, labels
+
     def configure_optimizers(self):
         optimizer = self.initialize_optimizer(self.trainer.model.parameters())
         lr_scheduler = self.initialize_lr_scheduler(optimizer)
@@ -560,7 +612,8 @@ class LightningModel(L.LightningModule):
         else:
             raise ValueError(f"Unsupported loss function: {self.hparams.loss_f}")
 
-    def handle_bool_float_config_param(self, config_param, false_value=0, true_value=1):
+    @staticmethod
+    def handle_bool_float_config_param(config_param, false_value=0, true_value=1):
         if isinstance(config_param, bool):
             if config_param:
                 return true_value
@@ -603,21 +656,110 @@ class LightningModel(L.LightningModule):
             self.hparams.epoch_sizing, false_value=1.0, true_value=0.2
         )
 
-    def merge_lists(self, lists):
-        if dist.is_initialized():
-            all_rank_list = [None for _ in range(dist.get_world_size())]
-            dist.all_gather_object(all_rank_list, lists)
-            lists = [x for y in all_rank_list for x in y]
-        return lists
+
+class TensorAccumulator:
+    """
+    Growable tensor of rows, preallocated and doubled in size whenever it is full, so that the batches
+    appended during an evaluation are copied once into a single tensor instead of into Python lists.
+    """
+
+    def __init__(self, initial_capacity=1024):
+        self.initial_capacity = initial_capacity
+        self.data = None
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def append(self, values):
+        values = torch.atleast_1d(values.detach())
+        if values.is_floating_point():
+            values = values.float()
+        if self.data is None:
+            self.data = values.new_empty(
+                (max(self.initial_capacity, len(values)), *values.shape[1:])
+            )
+        elif self.size + len(values) > len(self.data):
+            data = self.data.new_empty(
+                (max(2 * len(self.data), self.size + len(values)), *self.data.shape[1:])
+            )
+            data[: self.size] = self.data[: self.size]
+            self.data = data
+        self.data[self.size : self.size + len(values)] = values.to(self.data.device)
+        self.size += len(values)
+
+    def tensor(self):
+        if self.data is None:
+            return torch.empty(0)
+        return self.data[: self.size]
+
+    def set(self, values):
+        self.data = values
+        self.size = len(values)
+
+    def tolist(self):
+        return self.tensor().tolist()
+
+    def gather(self, device=None):
+        """Replaces the rows by the rows of every rank, in rank order."""
+        self.set(all_gather_rows(self.tensor(), device=device))
+
+
+# Dtypes that all_gather_rows exchanges by their index, along with the shapes
+GATHER_DTYPES = (
+    torch.float32,
+    torch.float64,
+    torch.float16,
+    torch.bfloat16,
+    torch.int64,
+    torch.int32,
+    torch.int16,
+    torch.int8,
+    torch.uint8,
+    torch.bool,
+)
+
+
+def all_gather_rows(tensor, device=None, max_dims=8):
+    """
+    Concatenates the rows of a tensor across the ranks, with tensor all_gather. Ranks can hold different
+    numbers of rows (or none), so the tensors are padded to the largest one and trimmed after gathering.
+    The dtype and shape of each rank are exchanged first, so that ranks without rows (e.g. an empty
+    float tensor) take the dtype and row shape of the others.
+    """
+    if not dist.is_initialized() or dist.get_world_size() == 1:
+        return tensor
+    device = tensor.device if device is None else device
+    # The dtype index and the shape padded with -1 to max_dims of each rank, all -1 for ranks without rows
+    shape = torch.full((max_dims + 1,), -1, dtype=torch.long, device=device)
+    if tensor.numel():
+        shape[0] = GATHER_DTYPES.index(tensor.dtype)
+        shape[1 : tensor.dim() + 1] = torch.tensor(tensor.shape)
+    shapes = [torch.empty_like(shape) for _ in range(dist.get_world_size())]
+    dist.all_gather(shapes, shape)
+    shapes = torch.stack(shapes).cpu()
+    n_rows = shapes[:, 1].clamp(min=0).tolist()
+    if not any(n_rows):
+        return tensor
+    first = shapes[shapes[:, 1] > 0][0]
+    dtype = GATHER_DTYPES[first[0]]
+    row_shape = [n for n in first[2:].tolist() if n >= 0]
+    padded = torch.zeros((max(n_rows), *row_shape), dtype=dtype, device=device)
+    padded[: n_rows[dist.get_rank()]] = tensor.to(device=device, dtype=dtype).reshape(-1, *row_shape)
+    gathered = [torch.empty_like(padded) for _ in n_rows]
+    dist.all_gather(gathered, padded)
+    return torch.cat([rows[:n] for rows, n in zip(gathered, n_rows)])
 
 
 class Metrics(torch.nn.Module):
     def __init__(self, task: str, no_classes=1):
         super().__init__()
         self.task = task
-        self.preds_list = []
-        self.actual_list = []
-        self.ids = []
+        # Predictions, labels and sample ids of the evaluated batches, only turned into lists when saved
+        self.preds = TensorAccumulator()
+        self.actual = TensorAccumulator()
+        self.ids = TensorAccumulator()
+        self.report = None
         if task == "classification":
             self.no_classes = no_classes
             if self.no_classes < 2:
@@ -654,30 +796,22 @@ class Metrics(torch.nn.Module):
             )
 
     def add(self, preds, actual, ids):
-        if self.task == "token_classification":
-            self.preds_list.extend(preds.tolist())
-            self.actual_list.extend(actual.tolist())
-            (
-                self.ids.extend(ids.tolist())
-                if len(ids.tolist()) > 1
-                else self.ids.append(ids.item())
-            )
-        else:
-            (
-                self.preds_list.extend(preds.tolist())
-                if len(preds.tolist()) > 1
-                else self.preds_list.append(preds.item())
-            )
-            (
-                self.actual_list.extend(actual.tolist())
-                if len(actual.tolist()) > 1
-                else self.actual_list.append(actual.item())
-            )
-            (
-                self.ids.extend(ids.tolist())
-                if len(ids.tolist()) > 1
-                else self.ids.append(ids.item())
-            )
+        self.preds.append(preds)
+        self.actual.append(actual)
+        self.ids.append(ids)
+
+    def gather(self, device=None):
+        """Gathers the predictions, labels and ids of every rank (no-op without distributed training)."""
+        for accumulator in (self.preds, self.actual, self.ids):
+            accumulator.gather(device=device)
+
+    def pred_columns(self):
+        """Predictions, labels and ids as numpy columns, for the predictions file."""
+        return {
+            "preds": self.preds.tensor().cpu().numpy(),
+            "actual": self.actual.tensor().cpu().numpy(),
+            "ids": self.ids.tensor().cpu().numpy().astype(np.int64),
+        }
 
     def calculate(self, preds, actual):
         if self.task == "classification":
@@ -716,8 +850,8 @@ class Metrics(torch.nn.Module):
 
     def get_metrics(self, device="cpu"):
         self.calculate(
-            torch.tensor(self.preds_list, device=device),
-            torch.tensor(self.actual_list, device=device),
+            self.preds.tensor().to(device),
+            self.actual.tensor().to(device),
         )
         if self.task == "classification":
             return self.get_classification_metrics()
@@ -743,11 +877,6 @@ class Metrics(torch.nn.Module):
                     "tpr": tpr.tolist(),
                     "roc_auc_val": self.roc_auc.compute().item(),
                 },
-                "pred_data": {
-                    "preds": self.preds_list,
-                    "actual": self.actual_list,
-                    "ids": self.ids,
-                },
             }
         else:
             self.report = {
@@ -757,11 +886,6 @@ class Metrics(torch.nn.Module):
                     "mcc": self.mcc.compute().item(),
                     "confusion_matrix": self.cm.compute().tolist(),
                 },
-                "pred_data": {
-                    "preds": self.preds_list,
-                    "actual": self.actual_list,
-                    "ids": self.ids,
-                },
             }
         return self.report
 
@@ -774,15 +898,7 @@ class Metrics(torch.nn.Module):
             "spearman": self.spearman.compute().item(),
         }
 
-        self.report = {
-            "main": metrics,
-            "pred_data": {
-                "preds": self.preds_list,
-                "actual": self.actual_list,
-                "ids": self.ids,
-                "eval_metrics": metrics,
-            },
-        }
+        self.report = {"main": metrics}
 
         return self.report
 
@@ -803,56 +919,68 @@ class Metrics(torch.nn.Module):
                 "mcc": self.mcc.compute().item(),
                 "confusion_matrix": self.cm.compute().tolist(),
             },
-            "pred_data": {
-                "preds": self.preds_list,
-                "actual": self.actual_list,
-                "ids": self.ids,
-            },
         }
         return self.report
 
-    def save_metrics(self, path):
-        metrics_path = f"{path}_metrics.json"
+    def save_metrics(self, path, compress=False):
+        """
+        Writes the report (metrics, ROC curve, confusion matrix) to {path}_metrics.json, and the predictions,
+        labels and ids of the samples as columns of {path}_predictions.npz, uncompressed by default so that
+        data_explore can memory-map them (see utils.load_npz). Both files are overwritten by a later test
+        run on the same path.
+        """
         if self.report is None:
             self.get_metrics()
-
-        # Check if the metrics file already exists
-        if os.path.exists(metrics_path):
-            # Load the existing data
-            with open(metrics_path, "r", encoding="utf-8") as f:
-                existing_data = json.load(f)
-
-            # Check if 'pred_data' field exists and update it
-            if "pred_data" in existing_data:
-                existing_data["pred_data"]["preds"].extend(
-                    self.report["pred_data"]["preds"]
-                )
-                existing_data["pred_data"]["actual"].extend(
-                    self.report["pred_data"]["actual"]
-                )
-                existing_data["pred_data"]["ids"].extend(
-                    self.report["pred_data"]["ids"]
-                )
-                self.report = existing_data
-            else:
-                # If 'pred_data' does not exist, simply prepare to write the current report
-                pass
-
-        # Write the updated or original report to the file
-        with open(metrics_path, "w", encoding="utf-8") as f:
+        with open(f"{path}_metrics.json", "w", encoding="utf-8") as f:
             json.dump(self.report, f, indent=4)
+        if self.task == "masked_lm":
+            return
+
+        (np.savez_compressed if compress else np.savez)(
+            f"{path}_predictions.npz", **self.pred_columns()
+        )
 
 
 class PredictionWriter(BasePredictionWriter):
+    """
+    Writes the predictions in the original order of the samples, using the batch indices.
 
-    def __init__(self, logger, write_interval, split_size=0):
+    With write_interval 'epoch' the predictions are gathered and saved as a single .pt file (or in
+    chunks of split_size). With write_interval 'batch' each batch is streamed into a memory-mapped
+    EmbeddingStore at its row indices, so memory usage does not grow with the number of samples.
+    Predictions keyed by (layer, reduction) are written in one store each, named
+    {prefix}_{layer}_{reduction}/{prefix}_{layer}_{reduction}.
+    """
+
+    def __init__(
+        self,
+        logger,
+        write_interval,
+        split_size=0,
+        dtype="float32",
+        metadata=None,
+        prefix=None,
+    ):
         super().__init__(write_interval)
         self.output_dir = logger.base_dir
         self.file_name = logger.experiment_name
         self.logger = logger
         self.split_size = split_size
+        self.dtype = dtype
+        self.metadata = {} if metadata is None else metadata
+        self.prefix = logger.experiment_name if prefix is None else prefix
+        self.stores = {}
 
     def write_on_epoch_end(self, trainer, pl_module, predictions, batch_indices):
+        # Batches padded to their own length (e.g. reduction 'none') are right padded to the longest one
+        if predictions[0].dim() > 2:
+            max_len = max(prediction.size(1) for prediction in predictions)
+            predictions = [
+                torch.nn.functional.pad(
+                    prediction, (0, 0, 0, max_len - prediction.size(1))
+                )
+                for prediction in predictions
+            ]
         # Make list into a single tensor
         predictions = torch.cat(predictions, dim=0)
         batch_indices = [
@@ -897,16 +1025,38 @@ class PredictionWriter(BasePredictionWriter):
         batch_idx,
         dataloader_idx,
     ):
-
-        torch.save(prediction, f"{self.output_dir}/{self.file_name}_{batch_idx}.pt")
-
-        # Save a file called f"{self.output_dir}/{self.file_name}_{batch_idx}.json" to track the batch indices
-        with open(
-            f"{self.output_dir}/{self.file_name}_{batch_idx}.json",
-            "w",
-            encoding="utf-8",
-        ) as f:
-            json.dump(batch_indices, f, indent=4)
-
-        self.logger.log(f"Predictions saved to {self.output_dir}/{self.file_name}.pt")
-        self.logger.log(f"Predictions shape: {prediction.shape}")
+        predictions = prediction if isinstance(prediction, dict) else {None: prediction}
+        for key, prediction in predictions.items():
+            if key not in self.stores:
+                self.stores[key] = self.init_store(trainer, prediction, key)
+            self.stores[key].write(batch_indices, prediction)
+
+    def init_store(self, trainer, prediction, key=None):
+        dataset = trainer.predict_dataloaders.dataset
+        shape = [len(dataset), *prediction.shape[1:]]
+        if prediction.dim() > 2:
+            # Batches are padded to their own length, so the store is sized for the longest sequence
+            shape[1] = dataset.tensors[0].size(1)
+
+        metadata = dict(self.metadata)
+        if key is None:
+            path = f"{self.output_dir}/{self.file_name}"
+        else:
+            layer, reduction = key
+            metadata.update(layer=layer, reduction=reduction)
+            name = f"{self.prefix}_{layer}_{reduction}"
+            path = f"{self.output_dir}/{name}/{name}"
+
+        if trainer.is_global_zero:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            store = EmbeddingStore.create(path, shape, dtype=self.dtype, **metadata)
+        trainer.strategy.barrier()
+        if not trainer.is_global_zero:
+            store = EmbeddingStore.open(path, mode="r+")
+        return store
+
+    def on_predict_end(self, trainer, pl_module):
+        for store in self.stores.values():
+            store.flush()
+            self.logger.log(f"Predictions saved to {store.path}.npy")
+            self.logger.log(f"Predictions shape: {tuple(store.shape)}")
@@ -1,15 +1,21 @@
 import os
+from plmfit.language_models.progen2.models.progen.configuration_progen import (
+    ProGenConfig,
+)
 from plmfit.language_models.progen2.models.progen.modeling_progen import (
+    ProGenForCausalLM,
     ProGenForSequenceClassification,
     ProGenForEmbeddingsExtraction,
     ProGenForTokenClassification,
 )
 from plmfit.language_models.proteinbert.modeling_bert import (
+    ProteinBertConfig,
     ProteinBertForSequenceClassification,
     ProteinBertForMaskedLM,
     ProteinBertForEmbeddingsExtraction,
     ProteinBertForTokenClassification,
 )
+from plmfit.language_models.proteinbert.file_utils import cached_path
 from plmfit.language_models.esm.modeling_esm import (
     PlmfitEsmForSequenceClassification,
     PlmfitEsmForMaskedLM,
@@ -20,6 +26,13 @@ from plmfit.language_models.esm.modeling_esm import (
 # from plmfit.shared_utils.data_explore import visualize_embeddings
 
 from plmfit.shared_utils.linear_block import ProGenLinearBlock
+from plmfit.shared_utils.layer_loading import (
+    ENCODER_LAYER_PATTERN,
+    PROGEN_LAYER_PATTERN,
+    from_pretrained_layers,
+    load_layers_state_dict,
+)
+from plmfit.shared_utils.pooling import last_token_index, pool, pool_many, token_mask
 import plmfit.shared_utils.utils as utils
 import torch.nn as nn
 import plmfit.logger as l
@@ -30,6 +43,7 @@ import time
 from abc import abstractmethod
 from tokenizers import Tokenizer
 from transformers import (
+    AutoConfig,
     AutoTokenizer,
     AutoModel,
     EsmForMaskedLM,
@@ -77,23 +91,48 @@ class IPretrainedProteinLanguageModel(nn.Module):
     def set_tokenizer(self, tokenizer):
         self.tokenizer = tokenizer
 
-    def set_layer_to_use(self, layer):
+    def get_layer_index(self, layer):
         if layer == "last":
             # The last hidden layer
-            self.layer_to_use = self.no_layers - 1
+            return self.no_layers - 1
         elif layer == "middle":
-            self.layer_to_use = (self.no_layers - 1) // 2
+            return (self.no_layers - 1) // 2
         elif layer == "first":
-            self.layer_to_use = 0
+            return 0
         elif layer == "quarter1":
-            self.layer_to_use = (self.no_layers - 1) // 4
+            return (self.no_layers - 1) // 4
         elif layer == "quarter3":
-            self.layer_to_use = (self.no_layers - 1) // 2 + (self.no_layers - 1) // 4
+            return (self.no_layers - 1) // 2 + (self.no_layers - 1) // 4
         else:
             # Fallback for numeric layer specification or unexpected strings
-            self.layer_to_use = int(layer) if layer.isdigit() else self.no_layers - 1
+            return int(layer) if layer.isdigit() else self.no_layers - 1
+
+    def get_num_layers_to_load(self, layers):
+        """
+        Number of layers to load so that the given layers can be extracted, or None if the full model is
+        needed. Requires no_layers to be read from the config before the model is loaded.
+        """
+        if layers is None:
+            return None
+        num_layers = max(self.get_layer_index(layer) for layer in layers) + 1
+        return num_layers if num_layers < self.no_layers else None
+
+    def set_layer_to_use(self, layer):
+        self.layer_to_use = self.get_layer_index(layer)
+
+        self.py_model.trim_model(self.layer_to_use)
+
+    def set_layers_to_use(self, layers, reductions):
+        """
+        Sets multiple layers and reductions to extract in a single forward pass. The model is trimmed
+        to the deepest requested layer and outputs a dict keyed by (layer, reduction).
+        """
+        layers_to_use = {layer: self.get_layer_index(layer) for layer in layers}
+        self.layer_to_use = max(layers_to_use.values())
 
         self.py_model.trim_model(self.layer_to_use)
+        self.py_model.layers_to_use = layers_to_use
+        self.py_model.reductions = reductions
 
 
 class Antiberty(IPretrainedProteinLanguageModel):
@@ -183,33 +222,43 @@ class ProGenFamily(IPretrainedProteinLanguageModel):
     tokenizer: Tokenizer
 
     def __init__(
-        self, progen_model_name: str, logger: l.Logger, task: str = "regression"
+        self,
+        progen_model_name: str,
+        logger: l.Logger,
+        task: str = "regression",
+        layers=None,
     ):
         super().__init__(logger)
         self.name = progen_model_name
         self.task = task
+        checkpoint = f"{utils.plmfit_path}/language_models/progen2/checkpoints/{progen_model_name}"
+        self.no_layers = ProGenConfig.from_pretrained(checkpoint).n_layer
+        # Only the blocks up to the deepest requested layer are read from the checkpoint
+        load_kwargs = {
+            "num_layers": self.get_num_layers_to_load(layers),
+            "layer_pattern": PROGEN_LAYER_PATTERN,
+            "num_layers_key": "n_layer",
+        }
         if self.task == "causal_lm":
-            raise ValueError("Causal LM not supported yet for ProGen")
-            # self.py_model : PlmfitEsmForMaskedLM = PlmfitEsmForMaskedLM.from_pretrained(f'facebook/{esm_version}', output_hidden_states = True)
-            # self.output_dim = self.py_model.lm_head.decoder.out_features
+            self.py_model = from_pretrained_layers(
+                ProGenForCausalLM, checkpoint, **load_kwargs
+            )
+            self.output_dim = self.py_model.lm_head.out_features
         elif self.task == "token_classification":
-            self.py_model = ProGenForTokenClassification.from_pretrained(
-                f"{utils.plmfit_path}/language_models/progen2/checkpoints/{progen_model_name}"
+            self.py_model = from_pretrained_layers(
+                ProGenForTokenClassification, checkpoint, **load_kwargs
             )
             self.output_dim = self.py_model.classifier.out_features
         elif self.task == "extract_embeddings":
-            self.py_model = ProGenForEmbeddingsExtraction.from_pretrained(
-                f"{utils.plmfit_path}/language_models/progen2/checkpoints/{progen_model_name}"
+            self.py_model = from_pretrained_layers(
+                ProGenForEmbeddingsExtraction, checkpoint, **load_kwargs
             )
         else:
-            self.py_model: ProGenForSequenceClassification = (
-                ProGenForSequenceClassification.from_pretrained(
-                    f"{utils.plmfit_path}/language_models/progen2/checkpoints/{progen_model_name}"
-                )
+            self.py_model: ProGenForSequenceClassification = from_pretrained_layers(
+                ProGenForSequenceClassification, checkpoint, **load_kwargs
             )
             self.output_dim = self.py_model.classifier.out_features
         self.no_parameters = utils.get_parameters(self.py_model)
-        self.no_layers = len(self.py_model.transformer.h)
         self.emb_layers_dim = self.py_model.transformer.h[0].attn.out_proj.out_features
         self.tokenizer = utils.load_tokenizer(progen_model_name)
         self.layer_to_use = -1
@@ -221,6 +270,7 @@ class ProGenFamily(IPretrainedProteinLanguageModel):
             self.py_model.transformer.h = nn.ModuleList(
                 [ProGenLinearBlock(self.config) for _ in range(self.config.n_layer)]
             )
+            self.py_model.transformer.share_rotary_cache()
             self.py_model.transformer.ln_f.weight.fill_(1.0)
             self.py_model.transformer.ln_f.bias.fill_(0.0)
             self.logger.log("Zeroed the model with plain linear blocks")
@@ -230,6 +280,7 @@ class ProGenFamily(IPretrainedProteinLanguageModel):
             data["aa_seq"].values,
             self.tokenizer,
             max(data["len"].values) if max_length == "default" else max_length,
+            source_key=utils.dataset_source_key(data),
             add_bos=True,
             add_eos=True,
             logger=self.logger,
@@ -289,6 +340,7 @@ class ProGenFamily(IPretrainedProteinLanguageModel):
             # FIX: Find embeddings dimension either hard coded for model or real the pytorch model of ProGen. Maybe add reduction dimension as well
             embs = torch.zeros((len(seq_dataset), self.emb_layers_dim)).to(device)
             self.py_model = self.py_model.to(device)
+            pad_token_id = utils.get_pad_token_id(self.tokenizer)
             i = 0
             self.py_model.eval()
             start_extraction_time = time.time()
@@ -305,108 +357,25 @@ class ProGenFamily(IPretrainedProteinLanguageModel):
                             if mem_usage > max_mem_usage:
                                 max_mem_usage = mem_usage
                         else:
-                            model_output = self.py_model(batch[0])
+                            # Only the output of the selected layer is kept
+                            with self.py_model.capture_layers(
+                                {layer: self.layer_to_use}
+                            ) as capture:
+                                self.py_model(batch[0])
                             mem_usage = utils.print_gpu_utilization(
                                 memory_usage, device
                             )
                             if mem_usage > max_mem_usage:
                                 max_mem_usage = mem_usage
-                            hidden_states = (
-                                model_output.hidden_states
-                            )  # Get all hidden states
-
-                            # Log the shape of each layer's embeddings for the first batch if we are unsure what our model outputs
-                            # if i == 0:
-                            #     for layer_index, layer_output in enumerate(hidden_states):
-                            #         self.logger.log(f'Layer {layer_index} shape: {layer_output.shape}')
-
-                            # Now select the specific layer's output
-                            out = hidden_states[layer]
-                        if reduction == "mean":
-                            embs[i : i + current_batch_size, :] = torch.mean(out, dim=1)
-                            if i == 2:
-                                self.logger.log(f"{(torch.mean(out, dim=1)).size()}")
-                                # visualize_embeddings(torch.mean(out, dim=1), use_heatmap=False)
-                        elif reduction == "weighted_mean":
-                            # Calculate L2 norms of vectors across the feature dimension
-                            l2_norms = torch.norm(out, p=2, dim=-1)
-
-                            # Calculate variance of vectors across the feature dimension
-                            variances = torch.var(out, dim=-1, unbiased=False)
-
-                            # Normalize the outputs to positive values to calculate entropy
-                            normalized_outputs = F.softmax(out, dim=-1)
-                            # Calculate entropy across the feature dimension
-                            entropy = -torch.sum(
-                                normalized_outputs
-                                * torch.log(normalized_outputs + 1e-10),
-                                dim=-1,
-                            )
-
-                            # Apply softmax to L2 norms to get weights for each token
-                            weights = F.softmax(l2_norms, dim=1)
-                            print(weights)
-                            # Use weights to perform weighted mean across the sequence length dimension
-                            weighted_mean = torch.sum(
-                                out * weights.unsqueeze(-1), dim=1
-                            )
-                            embs[i : i + current_batch_size, :] = weighted_mean
-                            if i == 2:
-                                # print(f"First batch weighted mean vector: {weighted_mean}")
-                                self.logger.log(
-                                    f"Weighted Mean of first batch: {weighted_mean.numpy()}"
-                                )
-                                # visualize_embeddings(weighted_mean, use_heatmap=False)
-
-                        elif reduction == "sum":
-                            embs[i : i + current_batch_size, :] = torch.sum(out, dim=1)
-                        elif reduction == "bos":
-                            # Select the embeddings for the first token of each sequence in the batch
-                            embs[i : i + current_batch_size, :] = out[:, 0, :]
-                        elif reduction == "eos":
-                            # Initialize a tensor to store the selected embeddings
-                            selected_embs = torch.zeros(
-                                current_batch_size, out.shape[2], device=out.device
-                            )
-
-                            # Iterate over each sequence in the batch
-                            for seq_idx in range(current_batch_size):
-                                # Find the positions of the token with ID equal to 2 in the current sequence
-                                token_positions = (batch[0][seq_idx] == 2).nonzero(
-                                    as_tuple=True
-                                )[0]
-
-                                # Check if the token ID is present in the sequence
-                                if len(token_positions) > 0:
-                                    # Select the position of the last occurrence of the token
-                                    last_position = token_positions[-1].item()
-
-                                    # Select the embeddings for the last occurrence of the token
-                                    selected_embs[seq_idx, :] = out[
-                                        seq_idx, last_position, :
-                                    ]
-                                else:
-                                    # If the token ID is not found, you might want to handle this case.
-                                    # For example, use the embeddings of the last token of the sequence
-                                    # or set to zeros, depending on your application's requirements.
-                                    # Here, we use the embeddings of the last token as a fallback.
-                                    selected_embs[seq_idx, :] = out[seq_idx, -1, :]
-                                    self.logger.log(
-                                        f"EOS token not found for sequence {i}"
-                                    )
-
-                            # Update the embeddings tensor with the selected embeddings
-                            embs[i : i + current_batch_size, :] = selected_embs
-                            if i == 2:
-                                self.logger.log(selected_embs)
-                                # visualize_embeddings(selected_embs, use_heatmap=False)
-                        elif utils.convert_to_number(reduction) is not None:
-                            # Select the embeddings for the i token of each sequence in the batch
-                            embs[i : i + current_batch_size, :] = out[
-                                :, utils.convert_to_number(reduction), :
-                            ]
-                        else:
-                            raise ValueError("Unsupported reduction option")
+                            out = capture.outputs[layer]
+                        # Padding tokens are left out of the pooled embeddings, and eos is the
+                        # last token with id 2 (or the last position) as in the original loops
+                        embs[i : i + current_batch_size, :] = pool(
+                            out,
+                            reduction,
+                            token_mask(batch[0], pad_token_id),
+                            eos_index=last_token_index(batch[0], 2),
+                        )
                         del out
                         i = i + current_batch_size
                         if log_interval != -1 and i % log_interval == 0:
@@ -466,30 +435,45 @@ class ProGenFamily(IPretrainedProteinLanguageModel):
 class ESMFamily(IPretrainedProteinLanguageModel):
     tokenizer: AutoTokenizer
 
-    def __init__(self, esm_version: str, logger: l.Logger, task: str = "regression"):
+    def __init__(
+        self, esm_version: str, logger: l.Logger, task: str = "regression", layers=None
+    ):
         super().__init__(logger, task)
         self.version = esm_version
+        self.no_layers = AutoConfig.from_pretrained(
+            f"facebook/{esm_version}"
+        ).num_hidden_layers
+        # Only the layers up to the deepest requested layer are read from the checkpoint
+        num_layers = self.get_num_layers_to_load(layers)
         if self.task == "masked_lm":
-            self.py_model: PlmfitEsmForMaskedLM = PlmfitEsmForMaskedLM.from_pretrained(
-                f"facebook/{esm_version}", output_hidden_states=True
+            self.py_model: PlmfitEsmForMaskedLM = from_pretrained_layers(
+                PlmfitEsmForMaskedLM,
+                f"facebook/{esm_version}",
+                num_layers,
+                output_hidden_states=True,
             )
             self.output_dim = self.py_model.lm_head.decoder.out_features
         elif self.task == "token_classification":
-            self.py_model = PlmfitEsmForTokenClassification.from_pretrained(
-                f"facebook/{esm_version}", output_hidden_states=True
+            self.py_model = from_pretrained_layers(
+                PlmfitEsmForTokenClassification,
+                f"facebook/{esm_version}",
+                num_layers,
+                output_hidden_states=True,
             )
             self.output_dim = self.py_model.classifier.out_features
         elif self.task == "extract_embeddings":
-            self.py_model = PlmfitEsmForEmbdeddingsExtraction.from_pretrained(
-                f"facebook/{esm_version}", output_hidden_states=True
+            self.py_model = from_pretrained_layers(
+                PlmfitEsmForEmbdeddingsExtraction, f"facebook/{esm_version}", num_layers
             )
         else:
-            self.py_model = PlmfitEsmForSequenceClassification.from_pretrained(
-                f"facebook/{esm_version}", output_hidden_states=True
+            self.py_model = from_pretrained_layers(
+                PlmfitEsmForSequenceClassification,
+                f"facebook/{esm_version}",
+                num_layers,
+                output_hidden_states=True,
             )
             self.output_dim = self.py_model.classifier.out_features
         self.no_parameters = utils.get_parameters(self.py_model)
-        self.no_layers = len(self.py_model.esm.encoder.layer)
         self.emb_layers_dim = self.py_model.esm.encoder.layer[
             0
         ].attention.self.query.in_features
@@ -548,6 +532,7 @@ class ESMFamily(IPretrainedProteinLanguageModel):
             # FIX: Find embeddings dimension either hard coded for model or real the pytorch model of ProGen. Maybe add reduction dimension as well
             embs = torch.zeros((len(seq_dataset), self.emb_layers_dim)).to(device)
             self.py_model = self.py_model.to(device)
+            pad_token_id = utils.get_pad_token_id(self.tokenizer)
             i = 0
             self.py_model.eval()
             start_extraction_time = time.time()
@@ -559,66 +544,20 @@ class ESMFamily(IPretrainedProteinLanguageModel):
                         if layer == "logits":
                             out = self.py_model(batch[0]).logits
                         else:
-                            model_output = self.py_model(batch[0])
-                            hidden_states = model_output.hidden_states
-
-                            # Log the shape of each layer's embeddings for the first batch if we are unsure what our model outputs
-                            # if i == 0:
-                            #     for layer_index, layer_output in enumerate(hidden_states):
-                            #         self.logger.log(f'Layer {layer_index} shape: {layer_output.shape}')
-
-                            # Now select the specific layer's output
-                            out = hidden_states[layer]
-                        if reduction == "mean":
-                            embs[i : i + current_batch_size, :] = torch.mean(out, dim=1)
-                            if i == 0:
-                                self.logger.log(f"{(torch.mean(out, dim=1)).size()}")
-                        elif reduction == "sum":
-                            embs[i : i + current_batch_size, :] = torch.sum(out, dim=1)
-                        elif reduction == "bos":
-                            # Select the embeddings for the first token of each sequence in the batch
-                            embs[i : i + current_batch_size, :] = out[:, 0, :]
-                        elif reduction == "eos":
-                            # Initialize a tensor to store the selected embeddings
-                            selected_embs = torch.zeros(
-                                current_batch_size, out.shape[2], device=out.device
-                            )
-
-                            # Iterate over each sequence in the batch
-                            for seq_idx in range(current_batch_size):
-                                # Find the positions of the token with ID equal to 2 in the current sequence
-                                token_positions = (batch[0][seq_idx] == 2).nonzero(
-                                    as_tuple=True
-                                )[0]
-
-                                # Check if the token ID is present in the sequence
-                                if len(token_positions) > 0:
-                                    # Select the position of the last occurrence of the token
-                                    last_position = token_positions[-1].item()
-
-                                    # Select the embeddings for the last occurrence of the token
-                                    selected_embs[seq_idx, :] = out[
-                                        seq_idx, last_position, :
-                                    ]
-                                else:
-                                    # If the token ID is not found, you might want to handle this case.
-                                    # For example, use the embeddings of the last token of the sequence
-                                    # or set to zeros, depending on your application's requirements.
-                                    # Here, we use the embeddings of the last token as a fallback.
-                                    selected_embs[seq_idx, :] = out[seq_idx, -1, :]
-                                    self.logger.log(
-                                        f"EOS token not found for sequence {i}"
-                                    )
-
-                            # Update the embeddings tensor with the selected embeddings
-                            embs[i : i + current_batch_size, :] = selected_embs
-                        elif utils.convert_to_number(reduction) is not None:
-                            # Select the embeddings for the i token of each sequence in the batch
-                            embs[i : i + current_batch_size, :] = out[
-                                :, utils.convert_to_number(reduction), :
-                            ]
-                        else:
-                            raise ValueError("Unsupported reduction option")
+                            # Only the output of the selected layer is kept
+                            with self.py_model.capture_layers(
+                                {layer: self.layer_to_use}
+                            ) as capture:
+                                self.py_model(batch[0])
+                            out = capture.outputs[layer]
+                        # Padding tokens are left out of the pooled embeddings, and eos is the
+                        # last token with id 2 (or the last position) as in the original loops
+                        embs[i : i + current_batch_size, :] = pool(
+                            out,
+                            reduction,
+                            token_mask(batch[0], pad_token_id),
+                            eos_index=last_token_index(batch[0], 2),
+                        )
                         del out
                         i = i + current_batch_size
                         if log_interval != -1 and i % log_interval == 0:
@@ -678,6 +617,7 @@ class ESMFamily(IPretrainedProteinLanguageModel):
             data["aa_seq"].values,
             self.tokenizer,
             max(data["len"].values) if max_length == "default" else max_length,
+            source_key=utils.dataset_source_key(data),
             logger=self.logger,
             model_name="esm",
         )
@@ -687,30 +627,47 @@ class ESMFamily(IPretrainedProteinLanguageModel):
 class ProteinBERTFamily(IPretrainedProteinLanguageModel):
     tokenizer: Tokenizer
 
-    def __init__(self, logger=None, task="regression"):
+    def __init__(self, logger=None, task="regression", layers=None):
         super().__init__(logger, task)
         self.name = "bert-base"
+        self.no_layers = ProteinBertConfig.from_pretrained(self.name).num_hidden_layers
+        # Only the layers up to the deepest requested layer are read from the checkpoint
+        load_kwargs = {}
+        num_layers = self.get_num_layers_to_load(layers)
+        if num_layers is not None:
+            weights_file = cached_path(
+                ProteinBertForEmbeddingsExtraction.pretrained_model_archive_map[self.name]
+            )
+            load_kwargs = {
+                "state_dict": load_layers_state_dict(
+                    weights_file, num_layers, ENCODER_LAYER_PATTERN
+                ),
+                "num_hidden_layers": num_layers,
+            }
         if self.task == "masked_lm":
             self.py_model: ProteinBertForMaskedLM = (
-                ProteinBertForMaskedLM.from_pretrained("bert-base")
+                ProteinBertForMaskedLM.from_pretrained(self.name, **load_kwargs)
             )
             self.output_dim = self.py_model.mlm.vocab_size
         elif self.task == "token_classification":
             self.py_model: ProteinBertForTokenClassification = (
-                ProteinBertForTokenClassification.from_pretrained("bert-base")
+                ProteinBertForTokenClassification.from_pretrained(
+                    self.name, **load_kwargs
+                )
             )
             self.output_dim = self.py_model.classifier.out_features
         elif self.task == "extract_embeddings":
             self.py_model = ProteinBertForEmbeddingsExtraction.from_pretrained(
-                "bert-base"
+                self.name, **load_kwargs
             )
         else:
             self.py_model: ProteinBertForSequenceClassification = (
-                ProteinBertForSequenceClassification.from_pretrained("bert-base")
+                ProteinBertForSequenceClassification.from_pretrained(
+                    self.name, **load_kwargs
+                )
             )
             self.output_dim = self.py_model.classifier.out_features
         self.no_parameters = utils.get_parameters(self.py_model)
-        self.no_layers = len(self.py_model.bert.encoder.layer)
         self.emb_layers_dim = self.py_model.bert.encoder.layer[
             0
         ].attention.output.dense.out_features
@@ -723,6 +680,7 @@ class ProteinBERTFamily(IPretrainedProteinLanguageModel):
             data["aa_seq"].values,
             self.tokenizer,
             max(data["len"].values) if max_length == "default" else max_length,
+            source_key=utils.dataset_source_key(data),
             add_bos=True,
             add_eos=True,
             logger=self.logger,
@@ -783,6 +741,7 @@ class ProteinBERTFamily(IPretrainedProteinLanguageModel):
             # FIX: Find embeddings dimension either hard coded for model or real the pytorch model of ProGen. Maybe add reduction dimension as well
             embs = torch.zeros((len(seq_dataset), self.emb_layers_dim)).to(device)
             self.py_model = self.py_model.to(device)
+            pad_token_id = utils.get_pad_token_id(self.tokenizer)
             i = 0
             self.py_model.eval()
             start_extraction_time = time.time()
@@ -794,66 +753,20 @@ class ProteinBERTFamily(IPretrainedProteinLanguageModel):
                         if layer == "logits":
                             out = self.py_model(batch[0]).logits
                         else:
-                            model_output = self.py_model(batch[0])
-                            hidden_states = model_output.hidden_states
-
-                            # Log the shape of each layer's embeddings for the first batch if we are unsure what our model outputs
-                            # if i == 0:
-                            #     for layer_index, layer_output in enumerate(hidden_states):
-                            #         self.logger.log(f'Layer {layer_index} shape: {layer_output.shape}')
-
-                            # Now select the specific layer's output
-                            out = hidden_states[layer]
-                        if reduction == "mean":
-                            embs[i : i + current_batch_size, :] = torch.mean(out, dim=1)
-                            if i == 0:
-                                self.logger.log(f"{(torch.mean(out, dim=1)).size()}")
-                        elif reduction == "sum":
-                            embs[i : i + current_batch_size, :] = torch.sum(out, dim=1)
-                        elif reduction == "bos":
-                            # Select the embeddings for the first token of each sequence in the batch
-                            embs[i : i + current_batch_size, :] = out[:, 0, :]
-                        elif reduction == "eos":
-                            # Initialize a tensor to store the selected embeddings
-                            selected_embs = torch.zeros(
-                                current_batch_size, out.shape[2], device=out.device
-                            )
-
-                            # Iterate over each sequence in the batch
-                            for seq_idx in range(current_batch_size):
-                                # Find the positions of the token with ID equal to 2 in the current sequence
-                                token_positions = (batch[0][seq_idx] == 2).nonzero(
-                                    as_tuple=True
-                                )[0]
-
-                                # Check if the token ID is present in the sequence
-                                if len(token_positions) > 0:
-                                    # Select the position of the last occurrence of the token
-                                    last_position = token_positions[-1].item()
-
-                                    # Select the embeddings for the last occurrence of the token
-                                    selected_embs[seq_idx, :] = out[
-                                        seq_idx, last_position, :
-                                    ]
-                                else:
-                                    # If the token ID is not found, you might want to handle this case.
-                                    # For example, use the embeddings of the last token of the sequence
-                                    # or set to zeros, depending on your application's requirements.
-                                    # Here, we use the embeddings of the last token as a fallback.
-                                    selected_embs[seq_idx, :] = out[seq_idx, -1, :]
-                                    self.logger.log(
-                                        f"EOS token not found for sequence {i}"
-                                    )
-
-                            # Update the embeddings tensor with the selected embeddings
-                            embs[i : i + current_batch_size, :] = selected_embs
-                        elif utils.convert_to_number(reduction) is not None:
-                            # Select the embeddings for the i token of each sequence in the batch
-                            embs[i : i + current_batch_size, :] = out[
-                                :, utils.convert_to_number(reduction), :
-                            ]
-                        else:
-                            raise ValueError("Unsupported reduction option")
+                            # Only the output of the selected layer is kept
+                            with self.py_model.capture_layers(
+                                {layer: self.layer_to_use}
+                            ) as capture:
+                                self.py_model(batch[0])
+                            out = capture.outputs[layer]
+                        # Padding tokens are left out of the pooled embeddings, and eos is the
+                        # last token with id 2 (or the last position) as in the original loops
+                        embs[i : i + current_batch_size, :] = pool(
+                            out,
+                            reduction,
+                            token_mask(batch[0], pad_token_id),
+                            eos_index=last_token_index(batch[0], 2),
+                        )
                         del out
                         i = i + current_batch_size
                         if log_interval != -1 and i % log_interval == 0:
@@ -981,36 +894,13 @@ class AnkhFamily(IPretrainedProteinLanguageModel):
             # with torch.cuda.amp.autocast(enabled= fp16):
             for batch in seq_loader:
                 start = time.time()
-                out = self.py_model(batch[0]).hidden_states
+                # Padding tokens are neither attended to nor pooled
+                mask = token_mask(batch[0], self.tokenizer.pad_token_id)
+                out = self.py_model(batch[0], attention_mask=mask).hidden_states
                 for j in range(len(layer)):
-                    lay = layer[j]
+                    pooled = pool_many(out[layer[j]], reduction, mask, positions=mut_pos)
                     for k in range(len(reduction)):
-                        if reduction[k] == "mean":
-                            embs[j, k, i : i + batch_size, :] = torch.mean(
-                                out[lay], dim=1
-                            )
-                        elif reduction[k] == "sum":
-                            embs[j, k, i : i + batch_size, :] = torch.sum(
-                                out[lay], dim=1
-                            )
-                        elif reduction[k] == "eos":
-                            embs[j, k, i : i + batch_size, :] = out[lay][:, -1]
-                        elif reduction[k].startswith("pos"):
-                            embs[j, k, i : i + batch_size, :] = out[lay][
-                                :, int(reduction[k][3:])
-                            ]
-                        elif reduction[k] == "mut_mean":
-                            n_pos = len(mut_pos)
-                            f_pos = mut_pos[0]
-                            for pos in mut_pos[1:]:
-                                out[lay][:, f_pos] = torch.add(
-                                    out[lay][:, f_pos], out[lay][:, pos]
-                                )
-                            embs[j, k, i : i + batch_size, :] = torch.div(
-                                out[lay][:, f_pos], n_pos
-                            )
-                        else:
-                            raise "Unsupported reduction option"
+                        embs[j, k, i : i + batch_size, :] = pooled[reduction[k]]
                 del out
                 i = i + batch_size
                 logger.log(
@@ -0,0 +1,191 @@
+import os
+import numpy as np
+import torch
+from plmfit.shared_utils.embedding_store import EmbeddingStore, is_embedding_store
+from plmfit.shared_utils.layer_capture import LayerCapture
+
+# Transformer blocks of the ProGen, ESM and ProteinBERT models
+BLOCK_PATHS = ("transformer.h", "esm.encoder.layer", "bert.encoder.layer")
+
+
+def get_blocks(model):
+    """ModuleList of the transformer blocks of a model, also when it is wrapped by peft."""
+    if hasattr(model, "get_base_model"):
+        model = model.get_base_model()
+    for path in BLOCK_PATHS:
+        module = model
+        for name in path.split("."):
+            module = getattr(module, name, None)
+        if module is not None:
+            return module
+    raise ValueError(f"Cannot find the transformer blocks of {type(model).__name__}")
+
+
+def pass_through(hidden_states, *args, **kwargs):
+    # Stands in for the forward of a skipped block, with the same outputs as a block without
+    # attentions or cache (the models index the cache and attentions after the hidden states)
+    return (hidden_states, None, None)
+
+
+def drop_hidden_states(module, args, output):
+    if getattr(output, "hidden_states", None) is not None:
+        output.hidden_states = None
+    return output
+
+
+class TrunkActivationCache:
+    """
+    Hidden states at the boundary between the frozen trunk of a model (its blocks below boundary) and the
+    trainable blocks above it, computed once for every sample and stored in fp16 in a memory-mapped
+    EmbeddingStore, one row per sample. Fine-tuning the top blocks then costs a single forward pass of the
+    trunk instead of one per epoch.
+
+    Once attached, the model is called with sample indices instead of input ids: the input ids and the
+    cached hidden states of the samples are looked up, the trunk blocks are skipped and the last one outputs
+    the cached hidden states. Everything else (embeddings, masks, top blocks, pooling and head) runs as
+    usual, so the outputs and the checkpoints are the same as without the cache. The trunk is run in eval
+    mode, without the dropout of the embeddings. The hidden states of the skipped blocks are not
+    available, so output_hidden_states is turned off while the cache is attached.
+
+    Usage:
+        cache = TrunkActivationCache.build(py_model, input_ids, boundary, path)
+        with cache.attach(py_model):
+            py_model(torch.tensor([0, 5, 7]))
+    """
+
+    def __init__(self, store, input_ids, boundary):
+        self.store = store
+        self.input_ids = torch.as_tensor(input_ids)
+        self.boundary = boundary
+        self.states = None
+        self.handles = []
+        self.replaced = []
+        self.config = None
+        self.output_hidden_states = None
+
+    @classmethod
+    def build(
+        cls, model, input_ids, boundary, path, batch_size=32, device="cpu", logger=None
+    ):
+        """
+        Runs the trunk of the model (blocks 0 to boundary - 1) on every sample and stores the hidden
+        states in the store at path, or reuses the store if it has already been built at path.
+
+        Parameters:
+            model (nn.Module): Model whose blocks are found by get_blocks.
+            input_ids (torch.Tensor): (n_samples, seq_len) padded input ids.
+            boundary (int): Index of the first block that is not cached.
+            path (str): Path of the store without extension, keyed by the samples and the boundary.
+        """
+        if boundary < 1:
+            raise ValueError("There are no frozen blocks to cache below the first block")
+        input_ids = torch.as_tensor(input_ids)
+        if is_embedding_store(path):
+            store = EmbeddingStore.open(path)
+            if store.header.get("boundary") == boundary and len(store) == len(input_ids):
+                if logger is not None:
+                    logger.log(f"Loaded cached trunk activations from {path}")
+                return cls(store, input_ids, boundary)
+
+        blocks = get_blocks(model)
+        was_training = model.training
+        model.eval().to(device)
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        # Written to a temporary store that is then renamed, so that concurrent jobs never read it half written
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        store = None
+        with torch.no_grad(), torch.autocast(
+            "cuda", enabled=str(device).startswith("cuda")
+        ), LayerCapture({"boundary": blocks[boundary - 1]}) as capture:
+            # The blocks above the boundary are not needed
+            replaced = replace_forward(blocks[boundary:], pass_through)
+            try:
+                for start in range(0, len(input_ids), batch_size):
+                    model(input_ids[start : start + batch_size].to(device))
+                    states = capture.outputs["boundary"]
+                    if store is None:
+                        store = EmbeddingStore.create(
+                            tmp_path,
+                            (len(input_ids), *states.shape[1:]),
+                            dtype="float16",
+                            boundary=boundary,
+                        )
+                    store.write(np.arange(start, start + len(states)), states)
+            finally:
+                restore_forward(replaced)
+        model.train(was_training)
+        store.flush()
+        del store
+        for extension in (".npy", ".json"):
+            os.replace(f"{tmp_path}{extension}", f"{path}{extension}")
+        if logger is not None:
+            logger.log(f"Cached the trunk activations of {len(input_ids)} samples at {path}")
+        return cls(EmbeddingStore.open(path), input_ids, boundary)
+
+    def attach(self, model):
+        """Makes the model read the trunk outputs from the cache, until detach (or the end of a with block)."""
+        blocks = get_blocks(model)
+        if len(blocks) <= self.boundary:
+            raise ValueError(
+                f"The model has {len(blocks)} blocks, no block is left above the cached boundary {self.boundary}"
+            )
+        # The models loaded with output_hidden_states=True would return the inputs of the skipped blocks
+        self.config = (model.get_base_model() if hasattr(model, "get_base_model") else model).config
+        self.output_hidden_states = self.config.output_hidden_states
+        self.config.output_hidden_states = False
+        self.handles.append(
+            model.register_forward_pre_hook(self.load_batch, with_kwargs=True)
+        )
+        # ProGen returns the hidden states by default, whatever the config
+        self.handles.append(model.register_forward_hook(drop_hidden_states))
+        self.replaced = replace_forward(blocks[: self.boundary - 1], pass_through)
+        self.replaced += replace_forward([blocks[self.boundary - 1]], self.replay)
+        return self
+
+    def detach(self):
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+        restore_forward(self.replaced)
+        self.replaced = []
+        self.states = None
+        if self.config is not None:
+            self.config.output_hidden_states = self.output_hidden_states
+            self.config = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.detach()
+        return False
+
+    def load_batch(self, module, args, kwargs):
+        # Replaces the sample indices by their input ids, and loads their cached hidden states
+        if kwargs.get("output_hidden_states"):
+            raise ValueError(
+                "The hidden states of the cached trunk blocks are not available, output_hidden_states "
+                "cannot be used with the trunk activation cache"
+            )
+        indices = args[0]
+        rows = indices.cpu().numpy()
+        self.states = torch.from_numpy(np.asarray(self.store.array[rows])).to(
+            indices.device, non_blocking=True
+        )
+        return (self.input_ids[rows].to(indices.device),) + tuple(args[1:]), kwargs
+
+    def replay(self, hidden_states, *args, **kwargs):
+        return pass_through(self.states.to(hidden_states.dtype))
+
+
+def replace_forward(modules, forward):
+    """Overrides the forward of the modules (keeping their parameters and hooks), returns the modules."""
+    modules = list(modules)
+    for module in modules:
+        module.forward = forward
+    return modules
+
+
+def restore_forward(modules):
+    for module in modules:
+        del module.forward
@@ -0,0 +1,48 @@
+import os
+from lightning.pytorch.callbacks import Callback
+from lightning.pytorch.strategies import DDPStrategy
+from plmfit.shared_utils.parallel_tuning import (
+    get_available_cores,
+    pin_to_cores,
+    split_cores,
+)
+
+# Size of the buckets of gradients that are all-reduced together
+BUCKET_CAP_MB = 25
+
+
+def cpu_ddp_strategy(bucket_cap_mb=BUCKET_CAP_MB, start_method="popen"):
+    """
+    Data-parallel strategy over gloo for CPU-only nodes. The gradients are all-reduced in buckets of
+    bucket_cap_mb as soon as a bucket is ready, overlapping the communication with the rest of the backward
+    pass, and the buckets are views of the gradients so they are not copied. With accumulate_grad_batches,
+    Lightning runs the accumulated batches under no_sync, so gradients are only all-reduced once per
+    optimizer step.
+    """
+    return DDPStrategy(
+        process_group_backend="gloo",
+        bucket_cap_mb=bucket_cap_mb,
+        gradient_as_bucket_view=True,
+        start_method=start_method,
+    )
+
+
+def process_cores(local_rank, processes_per_node):
+    """
+    Cores of a process of a node: its own slice of the cores available to the node, or the cores it is
+    already bound to when srun starts one task per process with --cpus-per-task.
+    """
+    if "SLURM_CPUS_PER_TASK" in os.environ and "SLURM_STEP_ID" in os.environ:
+        return get_available_cores()
+    core_slices = split_cores(processes_per_node)
+    return core_slices[local_rank % len(core_slices)]
+
+
+class CoreAffinity(Callback):
+    """
+    Pins each data-parallel process of a node to its own cores with one intra-op thread per core, so that
+    the processes do not oversubscribe the cores of the node.
+    """
+
+    def setup(self, trainer, pl_module, stage):
+        pin_to_cores(process_cores(trainer.local_rank, trainer.num_devices))
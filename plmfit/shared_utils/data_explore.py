@@ -306,20 +306,28 @@ def plot_roc_curve(y_test_list=None, y_pred_list=None, json_path=None):
     return fig, roc_auc_data
 
 
+def load_predictions(json_path):
+    """
+    Predictions, labels and ids saved with the metrics at json_path ({experiment}_metrics.json) by
+    Metrics.save_metrics, memory-mapped from {experiment}_predictions.npz.
+    """
+    return utils.load_npz(f"{json_path.removesuffix('_metrics.json')}_predictions.npz")
+
+
 def plot_actual_vs_predicted(y_test_list=None, y_pred_list=None, axis_range=[0, 1], eval_metrics=None, json_path=None):
     if json_path:
         with open(json_path, 'r') as file:
-            json_data = json.load(file)
-            y_test_list = json_data['pred_data']['actual']
-            y_pred_list = json_data['pred_data']['preds']
-            eval_metrics = json_data['main']
+            eval_metrics = json.load(file)['main']
+        predictions = load_predictions(json_path)
+        y_test_list = predictions['actual']
+        y_pred_list = predictions['preds']
     fig, ax = plt.subplots(figsize=(8, 8))
-    y_test_list = np.asarray(y_test_list, dtype=np.float32).flatten()
-    y_pred_list = np.asarray(y_pred_list, dtype=np.float32).flatten()
+    y_test_list = np.asarray(y_test_list, dtype=np.float32).ravel()
+    y_pred_list = np.asarray(y_pred_list, dtype=np.float32).ravel()
     ax.scatter(y_test_list, y_pred_list, color='darkorange', alpha=0.1, label='Predicted vs Actual')
     
-    min_val = min(min(y_test_list), min(y_pred_list), axis_range[0])
-    max_val = max(max(y_test_list), max(y_pred_list), axis_range[1])
+    min_val = min(y_test_list.min(), y_pred_list.min(), axis_range[0])
+    max_val = max(y_test_list.max(), y_pred_list.max(), axis_range[1])
     
     ax.plot([min_val, max_val], [min_val, max_val], 'k--', lw=2, label='Ideal')
     ax.set_xlim([min_val, max_val])
@@ -0,0 +1,81 @@
+import json
+import os
+import numpy as np
+import torch
+
+
+class EmbeddingStore:
+    """
+    On-disk embedding matrix backed by a memory-mapped .npy file and a small JSON header
+    (shape, dtype, model, layer, reduction) stored next to it as {path}.json.
+
+    The array is preallocated when the store is created, so batches of embeddings can be written
+    at their row indices as they arrive and read back without loading the full matrix in memory.
+    """
+
+    def __init__(self, path, array, header):
+        self.path = path
+        self.array = array
+        self.header = header
+
+    @classmethod
+    def create(cls, path, shape, dtype="float32", **metadata):
+        """
+        Preallocates a store of the given shape and writes its header.
+
+        Parameters:
+            path (str): Path of the store without extension.
+            shape (tuple): Shape of the embedding matrix (rows first).
+            dtype (str): 'float16' or 'float32'.
+            metadata: Extra entries of the header (e.g. model, layer, reduction).
+        """
+        if dtype not in ("float16", "float32"):
+            raise ValueError("dtype must be either 'float16' or 'float32'")
+        header = {"shape": [int(dim) for dim in shape], "dtype": dtype, **metadata}
+        array = np.lib.format.open_memmap(
+            f"{path}.npy", mode="w+", dtype=np.dtype(dtype), shape=tuple(header["shape"])
+        )
+        with open(f"{path}.json", "w", encoding="utf-8") as f:
+            json.dump(header, f, indent=4)
+        return cls(path, array, header)
+
+    @classmethod
+    def open(cls, path, mode="r"):
+        """Opens an existing store, 'r' for reading and 'r+' for writing into it."""
+        path = strip_store_extension(path)
+        with open(f"{path}.json", "r", encoding="utf-8") as f:
+            header = json.load(f)
+        array = np.load(f"{path}.npy", mmap_mode=mode)
+        return cls(path, array, header)
+
+    @property
+    def shape(self):
+        return self.array.shape
+
+    def __len__(self):
+        return self.array.shape[0]
+
+    def write(self, indices, values):
+        """Writes a batch of embeddings at the given row indices, padding the sequence dimension if needed."""
+        if torch.is_tensor(values):
+            values = values.detach().float().cpu().numpy()
+        if values.ndim > 2 and values.shape[1] < self.array.shape[1]:
+            pad_width = [(0, 0)] * values.ndim
+            pad_width[1] = (0, self.array.shape[1] - values.shape[1])
+            values = np.pad(values, pad_width)
+        self.array[np.asarray(indices)] = values
+
+    def flush(self):
+        self.array.flush()
+
+
+def strip_store_extension(path):
+    for extension in (".npy", ".json"):
+        if path.endswith(extension):
+            return path[: -len(extension)]
+    return path
+
+
+def is_embedding_store(path):
+    path = strip_store_extension(path)
+    return os.path.isfile(f"{path}.json") and os.path.isfile(f"{path}.npy")
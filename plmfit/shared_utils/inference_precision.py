@@ -0,0 +1,113 @@
+from functools import partial
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from scipy.stats import spearmanr
+from torch.utils.data import DataLoader, TensorDataset
+from plmfit.models.downstream_heads import LinearHead
+from plmfit.shared_utils.utils import pad_collate
+
+# Trainer precision of each inference precision. 'fp32' keeps the mixed precision used on GPUs, but runs in
+# true fp32 on CPU, where Lightning would turn 16-mixed into bf16 autocast
+TRAINER_PRECISIONS = {"fp32": "32-true", "bf16": "bf16-mixed", "int8": "32-true"}
+
+
+def get_trainer_precision(inference_precision):
+    if inference_precision not in TRAINER_PRECISIONS:
+        raise ValueError(
+            f"inference_precision must be one of {', '.join(TRAINER_PRECISIONS)}"
+        )
+    if inference_precision == "int8" and torch.cuda.is_available():
+        raise ValueError("int8 inference is only supported on CPU")
+    if inference_precision == "fp32" and torch.cuda.is_available():
+        return "16-mixed"
+    return TRAINER_PRECISIONS[inference_precision]
+
+
+def quantize_linear_layers(model):
+    """
+    Dynamic int8 quantisation of every Linear layer of the model (attention projections, MLP and dense
+    layers). Weights are stored in int8 and activations are quantised on the fly, which runs on the int8
+    CPU kernels.
+    """
+    return torch.ao.quantization.quantize_dynamic(
+        model, {nn.Linear}, dtype=torch.qint8, inplace=True
+    )
+
+
+def embed_sample(model, encs, pad_token_id, batch_size=32, autocast_dtype=None):
+    """
+    Runs an embedding extraction model on a (small) sample of encoded sequences, optionally under CPU
+    autocast. Returns a dict of embeddings, keyed by (layer, reduction) when the model outputs several.
+    """
+    data_loader = DataLoader(
+        TensorDataset(torch.as_tensor(encs)),
+        batch_size=batch_size,
+        shuffle=False,
+        collate_fn=partial(pad_collate, pad_token_id=pad_token_id),
+    )
+    outputs = {}
+    model.eval()
+    with torch.no_grad(), torch.autocast(
+        "cpu", dtype=autocast_dtype or torch.bfloat16, enabled=autocast_dtype is not None
+    ):
+        for (input,) in data_loader:
+            batch_outputs = model(input).logits
+            if not isinstance(batch_outputs, dict):
+                batch_outputs = {"embeddings": batch_outputs}
+            for key, embeddings in batch_outputs.items():
+                outputs.setdefault(key, []).append(embeddings.float())
+    return {key: torch.cat(embeddings) for key, embeddings in outputs.items()}
+
+
+def linear_probe_spearman(embeddings, scores, train_indices, test_indices, weight_decay=1e-2):
+    """Spearman correlation on the test indices of a ridge regression fitted on the train indices."""
+    head = LinearHead(
+        {"input_dim": embeddings.shape[1], "output_dim": 1, "task": "regression"}
+    )
+    head.fit(embeddings[train_indices], scores[train_indices], "mse", weight_decay)
+    with torch.no_grad():
+        predictions = head(embeddings[test_indices].float()).squeeze(-1)
+    return float(spearmanr(scores[test_indices].numpy(), predictions.numpy()).correlation)
+
+
+def fidelity_report(reference, embeddings, scores=None, test_size=0.2, seed=42):
+    """
+    Compares the embeddings of a reduced precision run with the fp32 reference embeddings of the same
+    sequences: per-sequence cosine similarity and, if scores are given, the test Spearman correlation of a
+    linear probe fitted on each set of embeddings.
+    """
+    report = {}
+    if scores is not None:
+        scores = torch.as_tensor(np.asarray(scores, dtype=np.float64))
+        indices = np.random.default_rng(seed).permutation(len(scores))
+        n_test = max(1, int(len(scores) * test_size))
+        test_indices, train_indices = indices[:n_test], indices[n_test:]
+
+    for key in reference:
+        reference_embeddings = reference[key].flatten(1)
+        quantized_embeddings = embeddings[key].flatten(1)
+        cosine_similarity = F.cosine_similarity(
+            reference_embeddings, quantized_embeddings, dim=1
+        )
+        entry = {
+            "cosine_similarity_mean": float(cosine_similarity.mean()),
+            "cosine_similarity_min": float(cosine_similarity.min()),
+        }
+        if scores is not None:
+            reference_spearman = linear_probe_spearman(
+                reference_embeddings, scores, train_indices, test_indices
+            )
+            spearman = linear_probe_spearman(
+                quantized_embeddings, scores, train_indices, test_indices
+            )
+            entry.update(
+                {
+                    "linear_probe_spearman_fp32": reference_spearman,
+                    "linear_probe_spearman": spearman,
+                    "linear_probe_spearman_delta": spearman - reference_spearman,
+                }
+            )
+        report["_".join(key) if isinstance(key, tuple) else key] = entry
+    return report
@@ -0,0 +1,42 @@
+class LayerCapture:
+    """
+    Captures the outputs of selected layers of a model with forward hooks, so that a forward pass does
+    not have to keep the hidden states (and attentions) of every layer. Each output is passed to
+    transform(key, hidden_states) as soon as its layer has run, and only the result is kept, e.g. the
+    pooled embeddings, so the full hidden states of the layer can be freed right away.
+
+    Usage:
+        with LayerCapture({"middle": model.layers[5]}, transform=pool) as capture:
+            model(input_ids)
+        capture.outputs["middle"]
+    """
+
+    def __init__(self, layers, transform=None):
+        self.layers = layers
+        self.transform = transform
+        self.outputs = {}
+        self.handles = []
+
+    def __enter__(self):
+        self.outputs = {}
+        for key, module in self.layers.items():
+            self.handles.append(module.register_forward_hook(self.hook(key)))
+        return self
+
+    def __exit__(self, *exc_info):
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+        return False
+
+    def hook(self, key):
+        def capture(module, inputs, output):
+            # Transformer blocks return a tuple that starts with the hidden states
+            hidden_states = output[0] if isinstance(output, tuple) else output
+            self.outputs[key] = (
+                hidden_states
+                if self.transform is None
+                else self.transform(key, hidden_states)
+            )
+
+        return capture
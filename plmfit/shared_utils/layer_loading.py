@@ -0,0 +1,105 @@
+import json
+import os
+import re
+import torch
+from safetensors import safe_open
+from transformers.utils import cached_file
+
+# Matches the index of the transformer block a checkpoint key belongs to
+PROGEN_LAYER_PATTERN = r"(?:^|\.)h\.(\d+)\."
+ENCODER_LAYER_PATTERN = r"(?:^|\.)encoder\.layer\.(\d+)\."
+
+SAFE_WEIGHTS_INDEX_NAME = "model.safetensors.index.json"
+SAFE_WEIGHTS_NAME = "model.safetensors"
+WEIGHTS_INDEX_NAME = "pytorch_model.bin.index.json"
+WEIGHTS_NAME = "pytorch_model.bin"
+
+
+def resolve_checkpoint_file(pretrained_model_name_or_path, filename):
+    """Path of a file of a local checkpoint directory or of a Hub model (downloaded if needed), or None."""
+    return cached_file(
+        pretrained_model_name_or_path,
+        filename,
+        _raise_exceptions_for_missing_entries=False,
+        _raise_exceptions_for_connection_errors=False,
+    )
+
+
+def load_layers_state_dict(weights, num_layers, layer_pattern):
+    """
+    Reads the tensors of a checkpoint needed by a model trimmed to its first num_layers blocks, that is
+    every tensor except those of the later blocks (found with layer_pattern). Tensors are read lazily:
+    safetensors files are memory-mapped and only the kept tensors are loaded, the shards of a sharded
+    checkpoint that only hold discarded blocks are never opened (nor downloaded), and .bin files are
+    memory-mapped so the pages of discarded tensors are never read.
+
+    Parameters:
+        weights (str): Path of a weights file, or a local checkpoint directory or Hub model name.
+        num_layers (int): Number of blocks to keep.
+        layer_pattern (str): Regex whose first group is the block index of a key.
+    """
+
+    def keep(key):
+        match = re.search(layer_pattern, key)
+        return match is None or int(match.group(1)) < num_layers
+
+    if os.path.isfile(weights):
+        return read_tensors(weights, keep)
+
+    for index_name in (SAFE_WEIGHTS_INDEX_NAME, WEIGHTS_INDEX_NAME):
+        index_file = resolve_checkpoint_file(weights, index_name)
+        if index_file is None:
+            continue
+        with open(index_file, "r", encoding="utf-8") as f:
+            weight_map = json.load(f)["weight_map"]
+        shards = sorted({shard for key, shard in weight_map.items() if keep(key)})
+        state_dict = {}
+        for shard in shards:
+            state_dict.update(
+                read_tensors(resolve_checkpoint_file(weights, shard), keep)
+            )
+        return state_dict
+
+    for weights_name in (SAFE_WEIGHTS_NAME, WEIGHTS_NAME):
+        weights_file = resolve_checkpoint_file(weights, weights_name)
+        if weights_file is not None:
+            return read_tensors(weights_file, keep)
+    raise EnvironmentError(f"No weights file found for {weights}")
+
+
+def read_tensors(path, keep):
+    if path.endswith(".safetensors"):
+        with safe_open(path, framework="pt", device="cpu") as f:
+            return {key: f.get_tensor(key) for key in f.keys() if keep(key)}
+    try:
+        state_dict = torch.load(path, map_location="cpu", mmap=True)
+    except RuntimeError:
+        # Checkpoints saved in the legacy (non-zip) format cannot be memory-mapped
+        state_dict = torch.load(path, map_location="cpu")
+    return {key: tensor for key, tensor in state_dict.items() if keep(key)}
+
+
+def from_pretrained_layers(
+    model_class,
+    pretrained_model_name_or_path,
+    num_layers=None,
+    layer_pattern=ENCODER_LAYER_PATTERN,
+    num_layers_key="num_hidden_layers",
+    **kwargs,
+):
+    """
+    Same as model_class.from_pretrained, but the model is built with only its first num_layers blocks and
+    only their weights are read from the checkpoint, so the discarded blocks are never materialised.
+    num_layers_key is the config attribute holding the number of blocks. With num_layers None, the full
+    model is loaded.
+    """
+    if num_layers is None:
+        return model_class.from_pretrained(pretrained_model_name_or_path, **kwargs)
+
+    config = model_class.config_class.from_pretrained(
+        pretrained_model_name_or_path, **{num_layers_key: num_layers}, **kwargs
+    )
+    state_dict = load_layers_state_dict(
+        pretrained_model_name_or_path, num_layers, layer_pattern
+    )
+    return model_class.from_pretrained(None, config=config, state_dict=state_dict)
@@ -1,6 +1,7 @@
 import torch
 from torch import nn
 import math
+from plmfit.shared_utils.rotary_embedding import RotaryEmbeddingCache, apply_rotary_pos_emb
 
 class ProGenLinearBlock(nn.Module):
     def __init__(self, config):
@@ -39,26 +40,6 @@ class ProGenLinearBlock(nn.Module):
 
         return outputs  # hidden_states, present, (attentions)
     
-def fixed_pos_embedding(x, seq_dim=1, seq_len=None):
-    dim = x.shape[-1]
-    if seq_len is None:
-        seq_len = x.shape[seq_dim]
-    inv_freq = 1.0 / (10000 ** (torch.arange(0, dim, 2) / dim))
-    sinusoid_inp = torch.einsum("i , j -> i j", torch.arange(seq_len), inv_freq).to(x.device).float()
-    return torch.sin(sinusoid_inp), torch.cos(sinusoid_inp)
-
-
-def rotate_every_two(x):
-    x1 = x[:, :, :, ::2]
-    x2 = x[:, :, :, 1::2]
-    x = torch.stack((-x2, x1), axis=-1)
-    return x.flatten(-2)  # in einsum notation: rearrange(x, '... d j -> ... (d j)')
-
-
-def apply_rotary_pos_emb(x, sincos, offset=0):
-    sin, cos = map(lambda t: t[None, offset : x.shape[1] + offset, None, :].repeat_interleave(2, 3), sincos)
-    # einsum notation for lambda t: repeat(t[offset:x.shape[1]+offset,:], "n d -> () n () (d j)", j=2)
-    return (x * cos) + (rotate_every_two(x) * sin)
 
 class ProGenZeroAttention(nn.Module):
     def __init__(self, config):
@@ -85,6 +66,8 @@ class ProGenZeroAttention(nn.Module):
         self.rotary_dim = None
         if config.rotary_dim is not None:
             self.rotary_dim = config.rotary_dim
+        # Replaced by the cache shared by all the layers of the model
+        self.rotary_cache = RotaryEmbeddingCache()
         
         self.init_weights()
 
@@ -185,14 +168,18 @@ class ProGenZeroAttention(nn.Module):
             q_rot = query[:, :, :, : self.rotary_dim]
             q_pass = query[:, :, :, self.rotary_dim :]
 
-            sincos = fixed_pos_embedding(k_rot, 1, seq_len=seq_len)
+            sincos = self.rotary_cache.get(
+                seq_len, self.rotary_dim, torch.promote_types(key.dtype, torch.float32), key.device
+            )
             k_rot = apply_rotary_pos_emb(k_rot, sincos, offset=offset)
             q_rot = apply_rotary_pos_emb(q_rot, sincos, offset=offset)
 
             key = torch.cat([k_rot, k_pass], dim=-1)
             query = torch.cat([q_rot, q_pass], dim=-1)
         else:
-            sincos = fixed_pos_embedding(key, 1, seq_len=seq_len)
+            sincos = self.rotary_cache.get(
+                seq_len, key.shape[-1], torch.promote_types(key.dtype, torch.float32), key.device
+            )
             key = apply_rotary_pos_emb(key, sincos, offset=offset)
             query = apply_rotary_pos_emb(query, sincos, offset=offset)
 
@@ -0,0 +1,131 @@
+import os
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+import optuna
+from optuna.storages import JournalStorage
+from optuna.storages.journal import JournalFileBackend
+from optuna.study import MaxTrialsCallback
+from plmfit.shared_utils.random_state import set_seed
+
+
+def get_available_cores():
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def split_cores(n_slices, cores=None):
+    """Splits the available cores into at most n_slices contiguous slices of (nearly) equal size."""
+    cores = get_available_cores() if cores is None else cores
+    n_slices = max(1, min(n_slices, len(cores)))
+    return [
+        [int(core) for core in cores_slice]
+        for cores_slice in np.array_split(cores, n_slices)
+    ]
+
+
+def pin_to_cores(cores):
+    """Pins the current process to the cores and uses one intra-op thread per core."""
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
+
+
+def share_datasets_memory(datasets):
+    """Moves the tensors of prepared datasets to shared memory, so worker processes do not copy them."""
+    for name in ("train", "val", "test"):
+        for tensor in datasets[name].tensors:
+            tensor.share_memory_()
+    for weights in datasets.get("weights", {}).values():
+        if torch.is_tensor(weights):
+            weights.share_memory_()
+    return datasets
+
+
+def optimize_in_processes(
+    storage_path,
+    study_name,
+    objective,
+    objective_args,
+    objective_kwargs,
+    n_trials,
+    n_workers,
+    callbacks=(),
+    seed=42,
+    catch=(),
+):
+    """
+    Runs the trials of an Optuna study in a pool of processes, each pinned to its own slice of the
+    available cores. The processes coordinate through the journal file storage of the study, and stop
+    once the study has n_trials trials in total.
+
+    The objective is called as objective(trial, *objective_args, **objective_kwargs), so it has to be a
+    module-level function. Tensors in the arguments should be moved to shared memory beforehand
+    (see share_datasets_memory), otherwise each process receives its own copy.
+    """
+    core_slices = split_cores(n_workers)
+    n_workers = len(core_slices)
+    callbacks = list(callbacks) + [MaxTrialsCallback(n_trials, states=None)]
+
+    # Forking a process that already uses OpenMP threads can deadlock, so workers are spawned
+    context = mp.get_context("spawn")
+    processes = [
+        context.Process(
+            target=tuning_worker,
+            args=(
+                rank,
+                core_slices[rank],
+                storage_path,
+                study_name,
+                objective,
+                objective_args,
+                objective_kwargs,
+                n_trials,
+                callbacks,
+                seed,
+                catch,
+            ),
+        )
+        for rank in range(n_workers)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+    failed = [process.exitcode for process in processes if process.exitcode != 0]
+    if failed:
+        raise RuntimeError(f"{len(failed)} tuning worker(s) failed with exit codes {failed}")
+
+
+def tuning_worker(
+    rank,
+    cores,
+    storage_path,
+    study_name,
+    objective,
+    objective_args,
+    objective_kwargs,
+    n_trials,
+    callbacks,
+    seed,
+    catch,
+):
+    pin_to_cores(cores)
+    # Each worker samples its own trials
+    set_seed(seed + rank)
+
+    study = optuna.load_study(
+        study_name=study_name,
+        storage=JournalStorage(JournalFileBackend(storage_path)),
+        sampler=optuna.samplers.TPESampler(seed=seed + rank),
+        pruner=optuna.pruners.MedianPruner(),
+    )
+    study.optimize(
+        lambda trial: objective(trial, *objective_args, **objective_kwargs),
+        n_trials=n_trials,
+        callbacks=callbacks,
+        gc_after_trial=True,
+        catch=catch,
+    )
@@ -0,0 +1,99 @@
+import torch
+import torch.nn.functional as F
+
+
+def token_mask(input_ids, pad_token_id):
+    """(batch, seq_len) bool mask of the tokens that are not padding, or None without input ids or padding token."""
+    if input_ids is None or pad_token_id is None:
+        return None
+    return input_ids != pad_token_id
+
+
+def last_token_index(input_ids, token_id):
+    """
+    (batch,) index of the last occurrence of token_id in each sequence, or of the last position for the
+    sequences that do not contain it.
+    """
+    is_token = input_ids == token_id
+    last = is_token.shape[1] - 1 - is_token.flip(1).int().argmax(dim=1)
+    return torch.where(is_token.any(dim=1), last, is_token.shape[1] - 1)
+
+
+def check_reductions(reductions):
+    """Raises a ValueError for the reductions the PLM wrappers cannot compute from the command line."""
+    if "mut_mean" in reductions:
+        raise ValueError(
+            "The mut_mean reduction needs the positions of the mutation window, which are not passed to "
+            "the model wrappers. Use mean, sum, max, weighted_mean, bos, eos or pos<i> instead."
+        )
+
+
+def get_position(reduction):
+    """Index of the token selected by a positional reduction ('pos5', '5' or 5), or None for other reductions."""
+    if isinstance(reduction, int):
+        return reduction
+    if reduction.startswith("pos"):
+        reduction = reduction[3:]
+    return int(reduction) if reduction.lstrip("-").isdigit() else None
+
+
+def pool(hidden_states, reduction, mask=None, positions=None, eos_index=None):
+    """
+    Pools (batch, seq_len, dim) hidden states along the sequence, without Python loops over the sequences.
+    Padding tokens (False in mask) are excluded, so sequences of different lengths padded in a batch are pooled
+    as if they had been run alone. Without mask, all the tokens are pooled.
+
+    Reductions:
+        mean, sum, max: over the tokens of each sequence.
+        weighted_mean: mean weighted by the softmax of the L2 norms of the tokens.
+        bos: first token. eos: last (non-padding) token, or the token at eos_index of each sequence.
+        pos<i> or <i>: token at index i.
+        mut_mean: mean over the token indices in positions (e.g. the mutation window).
+        none: the hidden states themselves.
+    """
+    if reduction == "none":
+        return hidden_states
+    if reduction == "bos":
+        return hidden_states[:, 0]
+    position = get_position(reduction)
+    if position is not None:
+        return hidden_states[:, position]
+
+    if mask is None:
+        mask = torch.ones(hidden_states.shape[:2], dtype=torch.bool, device=hidden_states.device)
+    mask = mask.to(device=hidden_states.device, dtype=torch.bool)
+    if reduction == "eos":
+        if eos_index is None:
+            eos_index = mask.shape[1] - 1 - mask.flip(1).int().argmax(dim=1)
+        eos_index = eos_index.to(hidden_states.device)
+        return hidden_states[torch.arange(len(eos_index), device=eos_index.device), eos_index]
+    if reduction == "mut_mean":
+        if positions is None:
+            raise ValueError("The mut_mean reduction needs the positions of the mutation window")
+        window = torch.zeros_like(mask)
+        window[:, torch.as_tensor(positions, device=mask.device)] = True
+        mask, reduction = mask & window, "mean"
+
+    if reduction == "max":
+        return hidden_states.masked_fill(~mask.unsqueeze(-1), -float("inf")).amax(dim=1)
+    if reduction == "weighted_mean":
+        norms = hidden_states.norm(p=2, dim=-1).masked_fill(~mask, -float("inf"))
+        weights = F.softmax(norms.float(), dim=1).to(hidden_states.dtype)
+    elif reduction in ("mean", "sum"):
+        weights = mask.to(hidden_states.dtype)
+        if reduction == "mean":
+            weights = weights / weights.sum(dim=1, keepdim=True).clamp(min=1)
+    else:
+        raise ValueError(f"Unsupported reduction option: {reduction}")
+    # Weighted sum over the sequence as a batched matrix product, without a (batch, seq_len, dim) product
+    return torch.bmm(weights.unsqueeze(1), hidden_states).squeeze(1)
+
+
+def pool_many(hidden_states, reductions, mask=None, positions=None, eos_index=None):
+    """Pools the same hidden states with each of the reductions, returns a dict keyed by reduction."""
+    return {
+        reduction: pool(
+            hidden_states, reduction, mask=mask, positions=positions, eos_index=eos_index
+        )
+        for reduction in reductions
+    }
@@ -0,0 +1,52 @@
+import torch
+
+
+class RotaryEmbeddingCache:
+    """
+    Sin/cos tables of the rotary position embeddings, shared by the attention layers of a model. The
+    tables are computed once per (dim, dtype, device), already interleaved (each frequency repeated for the
+    two dimensions it rotates) and shaped to broadcast over (batch, seq_len, heads, dim). They grow lazily,
+    doubling their length whenever a longer sequence is seen, and each layer slices the positions it needs.
+    """
+
+    def __init__(self, base=10000):
+        self.base = base
+        self.tables = {}
+
+    def get(self, seq_len, dim, dtype=torch.float32, device="cpu"):
+        """Returns the (1, seq_len, 1, dim) sin and cos tables of the positions 0 to seq_len - 1."""
+        key = (dim, dtype, torch.device(device))
+        if key not in self.tables or self.tables[key][0].shape[1] < seq_len:
+            length = seq_len
+            if key in self.tables:
+                length = max(seq_len, 2 * self.tables[key][0].shape[1])
+            self.tables[key] = self.build(length, dim, dtype, device)
+        sin, cos = self.tables[key]
+        return sin[:, :seq_len], cos[:, :seq_len]
+
+    def build(self, length, dim, dtype, device):
+        # Same frequencies as the original fixed_pos_embedding of ProGen, computed in fp32
+        inv_freq = 1.0 / (self.base ** (torch.arange(0, dim, 2) / dim))
+        sinusoid_inp = torch.einsum("i , j -> i j", torch.arange(length), inv_freq).float()
+        sinusoid_inp = sinusoid_inp.repeat_interleave(2, dim=-1)[None, :, None, :]
+        return (
+            torch.sin(sinusoid_inp).to(device=device, dtype=dtype),
+            torch.cos(sinusoid_inp).to(device=device, dtype=dtype),
+        )
+
+
+def rotate_every_two(x):
+    """(x0, x1, x2, x3, ...) -> (-x1, x0, -x3, x2, ...) along the last dimension, with a single copy."""
+    rotated = x.unflatten(-1, (-1, 2)).flip(-1)
+    rotated[..., 0].neg_()
+    return rotated.flatten(-2)
+
+
+def apply_rotary_pos_emb(x, sincos, offset=0):
+    """
+    Rotates x of shape (batch, seq_len, heads, dim), whose first token is at position offset, with the
+    tables of RotaryEmbeddingCache.get. The tables are in fp32, so the result is in fp32 (or in the dtype
+    of x if wider) as with the original ProGen implementation.
+    """
+    sin, cos = (t[:, offset : x.shape[1] + offset] for t in sincos)
+    return torch.addcmul(x * cos, rotate_every_two(x), sin)
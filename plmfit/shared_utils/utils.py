@@ -10,6 +10,9 @@ from torch.utils.data import (
     Subset,
     random_split,
     WeightedRandomSampler,
+    BatchSampler,
+    SequentialSampler,
+    get_worker_info,
 )
 from sklearn.model_selection import train_test_split
 import numpy as np
@@ -31,7 +34,13 @@ import blosum as bl
 from collections import Counter
 import torch.nn.functional as F
 import ast
+import hashlib
+import struct
+import threading
+import zipfile
+from functools import partial
 from plmfit.shared_utils.random_state import get_random_state
+from plmfit.shared_utils.embedding_store import EmbeddingStore, is_embedding_store
 
 load_dotenv()
 plmfit_path = os.getenv("PLMFIT_PATH", "./plmfit")
@@ -46,8 +55,179 @@ def set_path(base_path):
     config_dir = os.getenv("CONFIG_DIR", "./config")
 
 
+def get_cache_dir():
+    return os.getenv("CACHE_DIR", f"{data_dir}/.cache")
+
+
+def hash_file(file_path, chunk_size=1 << 24):
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def file_fingerprint(file_path):
+    """
+    Content hash of a file, remembered under CACHE_DIR with the size and modification time of the file so
+    that it is only computed again (by hash_file) when the file has been modified.
+    """
+    stat = os.stat(file_path)
+    abs_path = os.path.abspath(file_path)
+    index_path = f"{get_cache_dir()}/file_hashes/{hashlib.sha256(abs_path.encode('utf-8')).hexdigest()[:16]}.json"
+    if os.path.isfile(index_path):
+        try:
+            with open(index_path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+            if entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+                return entry["sha256"]
+        except (OSError, ValueError, KeyError):
+            pass
+
+    entry = {
+        "path": abs_path,
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "sha256": hash_file(file_path),
+    }
+
+    def save_entry(path):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(entry, f)
+
+    save_to_cache(save_entry, index_path)
+    return entry["sha256"]
+
+
+def save_to_cache(save_fn, cache_path, logger=None):
+    """
+    Writes a cache file atomically (to a temporary file that is then renamed), so that concurrent jobs
+    never read a partially written file. Failing to write the cache is not fatal.
+    """
+    extension = os.path.splitext(cache_path)[1]
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp{extension}"
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        save_fn(tmp_path)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        if logger is not None:
+            logger.log(f"Could not write cache file {cache_path}: {e}")
+
+
 def load_dataset(data_type):
-    return pd.read_csv(f"{data_dir}/{data_type}/{data_type}_data_full.csv")
+    """
+    Loads the dataset of the given data type. The columns are cached in binary .npy files keyed by the
+    fingerprint of the csv, so subsequent loads memory-map them instead of parsing the csv, and a changed
+    csv is parsed again. Numeric columns are stored as they are and text columns (sequences, splits) as
+    integer codes into their unique values.
+
+    The fingerprint is kept in data.attrs, see dataset_source_key.
+    """
+    file_path = f"{data_dir}/{data_type}/{data_type}_data_full.csv"
+    source_hash = file_fingerprint(file_path)
+    cache_path = f"{get_cache_dir()}/datasets/{data_type}_{source_hash[:16]}"
+
+    if os.path.isfile(f"{cache_path}/columns.json"):
+        data = load_cached_columns(cache_path)
+    else:
+        data = pd.read_csv(file_path)
+        save_to_cache(partial(save_cached_columns, data), cache_path)
+    data.attrs["source_hash"] = source_hash
+    data.attrs["n_rows"] = len(data)
+    return data
+
+
+def save_cached_columns(data, cache_path):
+    os.makedirs(cache_path)
+    columns = []
+    for i, (name, column) in enumerate(data.items()):
+        if column.dtype.kind in "biufc":
+            np.save(f"{cache_path}/{i}.npy", column.values)
+            columns.append({"name": name, "kind": "numeric"})
+        else:
+            # Missing values get the code -1
+            codes, categories = pd.factorize(column, use_na_sentinel=True)
+            np.save(f"{cache_path}/{i}_codes.npy", codes.astype(np.int32))
+            np.save(
+                f"{cache_path}/{i}_categories.npy",
+                np.asarray(categories, dtype=object),
+                allow_pickle=True,
+            )
+            columns.append({"name": name, "kind": "codes"})
+    with open(f"{cache_path}/columns.json", "w", encoding="utf-8") as f:
+        json.dump(columns, f)
+
+
+def load_cached_columns(cache_path):
+    with open(f"{cache_path}/columns.json", "r", encoding="utf-8") as f:
+        columns = json.load(f)
+    data = {}
+    for i, column in enumerate(columns):
+        if column["kind"] == "numeric":
+            # Copy-on-write, so the columns can be modified as those of a parsed csv
+            data[column["name"]] = np.load(f"{cache_path}/{i}.npy", mmap_mode="c")
+        else:
+            codes = np.load(f"{cache_path}/{i}_codes.npy", mmap_mode="r")
+            categories = np.load(f"{cache_path}/{i}_categories.npy", allow_pickle=True)
+            # Missing values (-1) are taken from the None appended to the unique values
+            data[column["name"]] = np.append(categories, None).take(codes)
+    return pd.DataFrame(data)
+
+
+def load_npz(path, mmap_mode="r"):
+    """
+    Loads the arrays of an .npz file into a dict. Arrays stored without compression are memory-mapped
+    at their offset in the archive, so only the parts that are used are read from disk, compressed ones
+    (or all of them with mmap_mode None) are read in full.
+    """
+    arrays = {}
+    with zipfile.ZipFile(path) as archive, open(path, "rb") as f:
+        for info in archive.infolist():
+            name = info.filename[: -len(".npy")]
+            if mmap_mode is None or info.compress_type != zipfile.ZIP_STORED:
+                with archive.open(info) as member:
+                    arrays[name] = np.lib.format.read_array(member)
+                continue
+            # The array starts after the local file header (30 bytes, then the file name and extra field)
+            f.seek(info.header_offset + 26)
+            name_length, extra_length = struct.unpack("<HH", f.read(4))
+            f.seek(info.header_offset + 30 + name_length + extra_length)
+            version = np.lib.format.read_magic(f)
+            read_header = (
+                np.lib.format.read_array_header_1_0
+                if version == (1, 0)
+                else np.lib.format.read_array_header_2_0
+            )
+            shape, fortran_order, dtype = read_header(f)
+            if dtype.hasobject or 0 in shape:
+                f.seek(info.header_offset + 30 + name_length + extra_length)
+                arrays[name] = np.lib.format.read_array(f)
+                continue
+            arrays[name] = np.memmap(
+                path,
+                dtype=dtype,
+                mode=mmap_mode,
+                shape=shape,
+                order="F" if fortran_order else "C",
+                offset=f.tell(),
+            )
+    return arrays
+
+
+def dataset_source_key(data, column="aa_seq"):
+    """
+    Key of a column of a dataset returned by load_dataset: the fingerprint of its csv and a vectorised hash
+    of the current values of the column, which can have been reordered or edited since it was loaded.
+    None if rows of the dataset have been dropped since, or it was not loaded by load_dataset.
+    """
+    source_hash = data.attrs.get("source_hash")
+    if source_hash is None or not data.index.equals(pd.RangeIndex(data.attrs["n_rows"])):
+        return None
+    values_hash = hashlib.sha256(
+        pd.util.hash_pandas_object(data[column], index=False).values.tobytes()
+    ).hexdigest()[:16]
+    return f"{source_hash}:{column}:{values_hash}"
 
 
 def load_embeddings(
@@ -67,10 +247,21 @@ def load_embeddings(
         layer (str): Layer information (default is 'last').
         model (str): Model information (default is 'progen2-small').
         reduction (str): Reduction method (default is 'mean').
+
+    Returns:
+        The embeddings as a tensor, or as a read-only memory-mapped array if they were saved in an embedding store.
     """
     if emb_path is None:
         emb_path = f"{data_dir}/{data_type}/embeddings/{data_type}_{model}_embs_layer{layer}_{reduction}.pt"
 
+    # Embedding stores are memory-mapped instead of loaded in memory
+    for store_path in (
+        f"{emb_path}/{data_type}_{model}_embs_{layer}_{reduction}/{data_type}_{model}_embs_{layer}_{reduction}",
+        emb_path,
+    ):
+        if is_embedding_store(store_path):
+            return EmbeddingStore.open(store_path).array
+
     try:
         embeddings = torch.load(
             f"{emb_path}/{data_type}_{model}_embs_{layer}_{reduction}/{data_type}_{model}_embs_{layer}_{reduction}.pt",
@@ -103,6 +294,8 @@ def create_data_loaders(
     weights=None,
     sampler=False,
     dataset_type="tensor",
+    num_classes=None,
+    flatten=True,
 ):
     """
     Create DataLoader objects for training, validation, and testing.
@@ -116,11 +309,65 @@ def create_data_loaders(
         validation_size (float): Fraction of the training data to be used as the validation set (default is 0.1).
         batch_size (int): Batch size for DataLoader (default is 64).
         scaler (bool): If to use feature scaling with a standard scaler.
+        num_classes (int): Number of classes of the 'one_hot' dataset type.
+        flatten (bool): If to flatten the one-hot encodings of each sample (default is True).
 
     Returns:
         dict: Dictionary containing DataLoader objects for train, validation, and test.
     """
+    datasets = prepare_datasets(
+        dataset,
+        scores,
+        split=split,
+        test_size=test_size,
+        validation_size=validation_size,
+        scaler=scaler,
+        dtype=dtype,
+        weights=weights,
+        sampler=sampler,
+        dataset_type=dataset_type,
+        num_classes=num_classes,
+        flatten=flatten,
+    )
+    return create_data_loaders_from_datasets(
+        datasets, batch_size=batch_size, num_workers=num_workers
+    )
+
+
+def prepare_datasets(
+    dataset,
+    scores,
+    split=None,
+    test_size=0.2,
+    validation_size=0.1,
+    scaler=None,
+    dtype=torch.float32,
+    weights=None,
+    sampler=False,
+    dataset_type="tensor",
+    num_classes=None,
+    flatten=True,
+):
+    """
+    Splits, scales and converts the data into the train, validation and test datasets, without creating
+    the DataLoaders. The datasets are only read from, so hyperparameter tuning trials can prepare them
+    once and share them, only creating their DataLoaders with create_data_loaders_from_datasets.
+
+    Parameters are the same as create_data_loaders.
+
+    Returns:
+        dict: Dictionary containing the train, val and test datasets, and the weights of the
+              train and val sets under 'weights' if a weighted sampler is used.
+    """
     random_state = get_random_state()
+
+    # Memory-mapped embeddings are split by row indices and read per sample
+    embeddings = None
+    if isinstance(dataset, np.memmap):
+        if dataset_type != "tensor":
+            raise ValueError("Memory-mapped embeddings only support dataset_type 'tensor'")
+        embeddings = dataset
+        dataset = np.arange(embeddings.shape[0])
     if split is None:
         X_train, X_test, y_train, y_test = train_test_split(
             dataset, scores, test_size=test_size, random_state=random_state
@@ -191,16 +438,25 @@ def create_data_loaders(
                 )
 
     # Scale the features if scaler is provided
-    if scaler:
+    if scaler and embeddings is not None:
+        scaler = StandardScaler()
+        for rows in np.array_split(np.sort(X_train), max(1, len(X_train) // 4096)):
+            scaler.partial_fit(embeddings[rows].reshape(len(rows), -1))
+    elif scaler:
         scaler = StandardScaler()
         X_train = scaler.fit_transform(X_train)
         X_val = scaler.transform(X_val)
         X_test = scaler.transform(X_test)
 
-    # Assuming X_train, X_val, X_test, y_train, y_val, y_test could be either NumPy arrays or PyTorch tensors
-    X_train = convert_or_clone_to_tensor(X_train, dtype=dtype)
-    X_val = convert_or_clone_to_tensor(X_val, dtype=dtype)
-    X_test = convert_or_clone_to_tensor(X_test, dtype=dtype)
+    if embeddings is not None:
+        X_train = torch.as_tensor(X_train)
+        X_val = torch.as_tensor(X_val)
+        X_test = torch.as_tensor(X_test)
+    else:
+        # Assuming X_train, X_val, X_test, y_train, y_val, y_test could be either NumPy arrays or PyTorch tensors
+        X_train = convert_or_clone_to_tensor(X_train, dtype=dtype)
+        X_val = convert_or_clone_to_tensor(X_val, dtype=dtype)
+        X_test = convert_or_clone_to_tensor(X_test, dtype=dtype)
     # Add to X_test an identifier
     test_ids = torch.arange(X_test.size(0))
 
@@ -213,12 +469,21 @@ def create_data_loaders(
         weights_val = convert_or_clone_to_tensor(weights_val, dtype=torch.float32)
         weights_test = convert_or_clone_to_tensor(weights_test, dtype=torch.float32)
 
-    if dataset_type == "tensor":
+    if embeddings is not None:
+        Dataset = partial(
+            EmbeddingStoreDataset,
+            embeddings,
+            dtype=dtype,
+            scaler=scaler if scaler else None,
+        )
+    elif dataset_type == "tensor":
         Dataset = TensorDataset
     elif dataset_type == "one_hot":
-        Dataset = OneHotDataset
+        Dataset = partial(OneHotDataset, num_classes=num_classes, flatten=flatten)
+    elif dataset_type == "blosum62":
+        Dataset = Blosum62Dataset
     else:
-        raise ValueError("dataset_type must be either 'tensor' or 'one_hot'")
+        raise ValueError("dataset_type must be either 'tensor', 'one_hot' or 'blosum62'")
 
     # Create DataLoader for training, validation, and testing
     if weights is not None and sampler is False:
@@ -230,15 +495,37 @@ def create_data_loaders(
         val_dataset = Dataset(X_val, y_val)
         test_dataset = Dataset(X_test, y_test, test_ids)
 
+    datasets = {"train": train_dataset, "val": val_dataset, "test": test_dataset}
     if sampler:
-        train_sampler = init_weighted_sampler(train_dataset, weights_train)
-        val_sampler = init_weighted_sampler(val_dataset, weights_val)
+        datasets["weights"] = {"train": weights_train, "val": weights_val}
+    return datasets
+
+
+def create_data_loaders_from_datasets(datasets, batch_size=64, num_workers=0):
+    """
+    Create DataLoader objects for training, validation, and testing from the datasets of prepare_datasets.
+
+    Returns:
+        dict: Dictionary containing DataLoader objects for train, validation, and test.
+    """
+    random_state = get_random_state()
+    train_dataset = datasets["train"]
+    val_dataset = datasets["val"]
+    test_dataset = datasets["test"]
+
+    sampler = "weights" in datasets
+    if sampler:
+        train_sampler = init_weighted_sampler(train_dataset, datasets["weights"]["train"])
+        val_sampler = init_weighted_sampler(val_dataset, datasets["weights"]["val"])
         test_sampler = None
     else:
         train_sampler = None
         val_sampler = None
         test_sampler = None
 
+    # One-hot batches are encoded at once by the dataset
+    collate_fn = collate_batch if isinstance(train_dataset, OneHotDataset) else None
+
     train_loader = DataLoader(
         train_dataset,
         batch_size=batch_size,
@@ -246,6 +533,7 @@ def create_data_loaders(
         num_workers=num_workers,
         pin_memory=num_workers > 0,
         sampler=train_sampler,
+        collate_fn=collate_fn,
         generator=random_state,
     )
     val_loader = DataLoader(
@@ -255,6 +543,7 @@ def create_data_loaders(
         num_workers=num_workers,
         pin_memory=num_workers > 0,
         sampler=val_sampler,
+        collate_fn=collate_fn,
         generator=random_state,
     )
     test_loader = DataLoader(
@@ -264,6 +553,7 @@ def create_data_loaders(
         num_workers=num_workers,
         pin_memory=num_workers > 0,
         sampler=test_sampler,
+        collate_fn=collate_fn,
         generator=random_state,
     )
 
@@ -275,6 +565,9 @@ def create_predict_data_loader(
     dtype=torch.int8,
     num_workers=0,
     dataset_type="tensor",
+    max_tokens=None,
+    pad_token_id=None,
+    num_classes=None,
 ):
     """
     Create DataLoader objects for prediction.
@@ -282,6 +575,9 @@ def create_predict_data_loader(
     Parameters:
         dataset (numpy.ndarray): Input dataset.
         batch_size (int): Batch size for DataLoader (default is 64).
+        max_tokens (int): If provided, sequences are bucketed by length and batches are capped
+                          by this token budget (batch size x padded length) instead of batch_size.
+        pad_token_id (int): Padding token of the encoded sequences, required with max_tokens.
 
     Returns:
         DataLoader: DataLoader object for prediction.
@@ -291,33 +587,171 @@ def create_predict_data_loader(
     if dataset_type == "tensor":
         Dataset = TensorDataset
     elif dataset_type == "one_hot":
-        Dataset = OneHotDataset
+        Dataset = partial(OneHotDataset, num_classes=num_classes)
     else:
         raise ValueError("dataset_type must be either 'tensor' or 'one_hot'")
 
     dataset = Dataset(X)
 
+    if max_tokens is None:
+        return DataLoader(
+            dataset,
+            batch_size=batch_size,
+            shuffle=False,
+            num_workers=num_workers,
+            pin_memory=num_workers > 0,
+            collate_fn=collate_batch if dataset_type == "one_hot" else None,
+        )
+
+    if dataset_type != "tensor":
+        raise ValueError("Batching by max_tokens only supports dataset_type 'tensor'")
+    if pad_token_id is None:
+        raise ValueError("pad_token_id must be provided when batching by max_tokens")
+
+    lengths = (X != pad_token_id).sum(dim=-1)
+    # Lightning re-instantiates the batch sampler when predicting to track the batch indices,
+    # passing only the sampler, batch_size and drop_last, so the lengths are bound to the class
+    batch_sampler = LengthBucketBatchSampler.bind(lengths, max_tokens=max_tokens)(
+        SequentialSampler(dataset)
+    )
+
     return DataLoader(
         dataset,
-        batch_size=batch_size,
-        shuffle=False,
+        batch_sampler=batch_sampler,
+        collate_fn=partial(pad_collate, pad_token_id=pad_token_id),
         num_workers=num_workers,
         pin_memory=num_workers > 0,
     )
 
 
+class LengthBucketBatchSampler(BatchSampler):
+    """
+    Groups samples of similar length into batches whose padded size (batch size x longest
+    sequence) does not exceed a token budget. Batches are yielded longest first so that
+    out-of-memory errors surface at the start of a run. Every index of the wrapped sampler is
+    yielded exactly once, so predictions can be put back in order from the batch indices.
+
+    Samplers that are re-created from (sampler, batch_size, drop_last) only, as Lightning does
+    when predicting, must come from a class returned by bind, which holds the lengths and budget.
+    """
+
+    bound_lengths = None
+    bound_max_tokens = 4096
+
+    def __init__(self, sampler, lengths=None, max_tokens=None, batch_size=None, drop_last=False):
+        if lengths is None:
+            lengths = self.bound_lengths
+        if lengths is None:
+            raise ValueError("lengths must be provided or bound with LengthBucketBatchSampler.bind")
+        self.sampler = sampler
+        self.lengths = torch.as_tensor(lengths)
+        self.max_tokens = self.bound_max_tokens if max_tokens is None else max_tokens
+        self.batch_size = batch_size  # Optional cap on the number of samples per batch
+        self.drop_last = drop_last
+
+    def create_batches(self):
+        indices = torch.as_tensor(list(self.sampler), dtype=torch.long)
+        order = torch.argsort(self.lengths[indices], descending=True, stable=True)
+        indices = indices[order].tolist()
+        lengths = self.lengths[indices].clamp(min=1).tolist()
+
+        batches = []
+        batch = []
+        batch_max_len = 0
+        for idx, length in zip(indices, lengths):
+            # Indices are sorted by decreasing length, so the first sample of a batch is the longest
+            full = (batch_max_len * (len(batch) + 1) > self.max_tokens) or (
+                self.batch_size is not None and len(batch) >= self.batch_size
+            )
+            if batch and full:
+                batches.append(batch)
+                batch = []
+            if not batch:
+                batch_max_len = length
+            batch.append(idx)
+
+        if batch and not self.drop_last:
+            batches.append(batch)
+        return batches
+
+    @classmethod
+    def bind(cls, lengths, max_tokens=4096):
+        """
+        Returns a subclass whose samplers default to the given lengths and token budget.
+        """
+        attributes = {"bound_lengths": torch.as_tensor(lengths), "bound_max_tokens": max_tokens}
+        return type(cls.__name__, (cls,), attributes)
+
+    def __reduce__(self):
+        # Bound subclasses are created at runtime and cannot be pickled by reference
+        return (
+            LengthBucketBatchSampler,
+            (self.sampler, self.lengths, self.max_tokens, self.batch_size, self.drop_last),
+        )
+
+    def __iter__(self):
+        yield from self.create_batches()
+
+    def __len__(self):
+        return len(self.create_batches())
+
+
+def pad_collate(batch, pad_token_id=0):
+    """
+    Stacks a batch of padded sequences and trims the padding columns that are shared by all the
+    sequences of the batch, so that each batch is only padded to its own longest sequence.
+    """
+    tensors = [torch.stack(samples) for samples in zip(*batch)]
+    input = tensors[0]
+    non_pad_columns = (input != pad_token_id).any(dim=0).nonzero()
+    width = int(non_pad_columns.max()) + 1 if len(non_pad_columns) > 0 else 1
+    tensors[0] = input[:, :width]
+    return tuple(tensors)
+
+
+def get_shared_prefix_length(encs):
+    """
+    Returns the length of the prefix shared by all the encoded sequences, e.g. the positions before the first
+    mutation of a mutational library. At least the last position is left out of the prefix.
+    """
+    encs = torch.as_tensor(encs)
+    differs = (encs != encs[:1]).any(dim=0).nonzero()
+    length = int(differs[0]) if len(differs) > 0 else encs.shape[1]
+    return min(length, encs.shape[1] - 1)
+
+
+def get_pad_token_id(tokenizer):
+    vocab = tokenizer.get_vocab()
+    for pad_token in ("<|pad|>", "<pad>"):
+        if pad_token in vocab:
+            return vocab[pad_token]
+    raise ValueError("Tokenizer has no padding token")
+
+
 class OneHotDataset(TensorDataset):
     """
     A custom dataset class that one-hot encodes the first tensor in the dataset.
-    set_num_classes must be called before using this dataset, to set the number of classes.
+    The number of classes must be given, either at construction or with set_num_classes, before using this dataset.
+
+    The DataLoader fetches whole batches through __getitems__ (use collate_batch as collate_fn), which
+    one-hot encodes the batch with a single scatter into a reusable (pinned when CUDA is available) buffer.
+    The buffers are rotated between num_buffers batches, so a batch is only valid until num_buffers more
+    batches have been fetched: enough for a training loop, but consumers that keep more batches (e.g. to
+    concatenate them) must copy them or turn the reuse off with reuse_buffers=False, in which case every
+    batch is encoded into a new tensor.
     """
 
-    def __init__(self, *tensors, flatten=True):
-        assert all(
-            tensors[0].size(0) == tensor.size(0) for tensor in tensors
-        ), "Size mismatch between tensors"
-        self.tensors = tensors
-        self.flatten = True
+    # Lightning prefetches the next batch while the current one is in use, so the buffers are rotated
+    num_buffers = 3
+
+    def __init__(self, *tensors, flatten=True, num_classes=None, reuse_buffers=True):
+        super().__init__(*tensors)
+        self.flatten = flatten
+        self.num_classes = num_classes
+        self.reuse_buffers = reuse_buffers
+        # Buffers are kept per thread, as the dataset can be shared by concurrent tuning trials
+        self.buffers = {}
+        self.next_buffer = {}
 
     def set_num_classes(self, num_classes):
         self.num_classes = num_classes
@@ -325,6 +759,9 @@ class OneHotDataset(TensorDataset):
     def set_flatten(self, flatten):
         self.flatten = flatten
 
+    def set_reuse_buffers(self, reuse_buffers):
+        self.reuse_buffers = reuse_buffers
+
     def __getitem__(self, index):
         # one hot the first tensor index and the others as is and then return
         return tuple(
@@ -332,6 +769,112 @@ class OneHotDataset(TensorDataset):
             for i, tensor in enumerate(self.tensors)
         )
 
+    def __getitems__(self, indices):
+        index = torch.as_tensor(indices, dtype=torch.long)
+        return (self.one_hot_batch(self.tensors[0][index]),) + tuple(
+            tensor[index] for tensor in self.tensors[1:]
+        )
+
+    def one_hot_batch(self, seqs):
+        shape = (*seqs.shape, self.num_classes)
+        if self.reuse_buffers and get_worker_info() is None:
+            encs = self.get_buffer(shape, seqs.dtype)
+        else:
+            # Batches of worker processes are sent through shared memory, so they cannot be reused
+            encs = torch.empty(shape, dtype=seqs.dtype)
+        encs.zero_().scatter_(-1, seqs.long().unsqueeze(-1), 1)
+        return encs.flatten(start_dim=1) if self.flatten else encs
+
+    def get_buffer(self, shape, dtype):
+        thread = threading.get_ident()
+        slot = self.next_buffer.get(thread, 0)
+        self.next_buffer[thread] = (slot + 1) % self.num_buffers
+        buffer = self.buffers.get((thread, slot))
+        if (
+            buffer is None
+            or buffer.dtype != dtype
+            or buffer.shape[1:] != shape[1:]
+            or buffer.size(0) < shape[0]
+        ):
+            buffer = torch.empty(shape, dtype=dtype, pin_memory=torch.cuda.is_available())
+            self.buffers[(thread, slot)] = buffer
+        return buffer[: shape[0]]
+
+
+def collate_batch(batch):
+    """Collate function for datasets that already return whole batches from __getitems__."""
+    return batch
+
+
+def dataset_to_tensors(dataset, batch_size=4096):
+    """Returns the (encoded) tensors of a whole dataset, e.g. to fit a model on it at once."""
+    if type(dataset) is TensorDataset:
+        return dataset.tensors
+    data_loader = DataLoader(
+        dataset,
+        batch_size=batch_size,
+        shuffle=False,
+        collate_fn=collate_batch if isinstance(dataset, OneHotDataset) else None,
+    )
+    # OneHotDataset batches are views into its reused buffers, so each one is copied as it is produced
+    batches = (tuple(tensor.clone() for tensor in batch) for batch in data_loader)
+    return tuple(torch.cat(tensors) for tensors in zip(*batches))
+
+
+class EmbeddingStoreDataset(TensorDataset):
+    """
+    A custom dataset class whose first tensor holds row indices into memory-mapped embeddings.
+    Rows are read (and scaled if a fitted scaler is given) per sample, so the full matrix is never materialised.
+    """
+
+    def __init__(self, embeddings, *tensors, dtype=torch.float32, scaler=None):
+        super().__init__(*tensors)
+        self.embeddings = embeddings
+        self.dtype = dtype
+        self.scaler = scaler
+
+    def __getstate__(self):
+        # Pickling a memmap copies its data, so spawned processes reopen the file instead
+        state = self.__dict__.copy()
+        if isinstance(self.embeddings, np.memmap) and self.embeddings.filename is not None:
+            state["embeddings"] = self.embeddings.filename
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if isinstance(self.embeddings, str):
+            self.embeddings = np.load(self.embeddings, mmap_mode="r")
+
+    def __getitem__(self, index):
+        row = int(self.tensors[0][index])
+        embedding = np.asarray(self.embeddings[row], dtype=np.float32)
+        if self.scaler is not None:
+            embedding = (
+                (embedding.reshape(-1) - self.scaler.mean_) / self.scaler.scale_
+            ).reshape(embedding.shape)
+        return (torch.tensor(embedding, dtype=self.dtype),) + tuple(
+            tensor[index] for tensor in self.tensors[1:]
+        )
+
+
+class Blosum62Dataset(TensorDataset):
+    """
+    A custom dataset class whose first tensor holds BLOSUM62 residue indices (see blosum62_tokenize).
+    The (flattened) BLOSUM62 encoding is computed per sample, instead of materialising N x L x L up front.
+    """
+
+    def __init__(self, *tensors, flatten=True):
+        super().__init__(*tensors)
+        self.flatten = flatten
+        _, self.table = load_blosum62_table()
+
+    def __getitem__(self, index):
+        indices = self.tensors[0][index]
+        encs = blosum62_gather(indices, self.table).to(dtype=indices.dtype)
+        return (encs.flatten() if self.flatten else encs,) + tuple(
+            tensor[index] for tensor in self.tensors[1:]
+        )
+
 
 def one_hot_encode(seqs, num_classes, flatten=True):
     # get dtype and save it
@@ -608,49 +1151,84 @@ def load_transformer_tokenizer(model_name, tokenizer):
         raise "Transformer tokenizer not supported (yet)"
 
 
-def blosum62_encode(sequences, pad_to_length, logger=None):
-    # Load the BLOSUM62 matrix from your custom library
+def load_blosum62_table():
+    """
+    Loads the BLOSUM62 substitution matrix as a lookup table.
+
+    Returns:
+        dict: Mapping of each residue symbol to its index in the table.
+        torch.Tensor: (26, 26) int8 substitution matrix. The extra last row and column are zeros and
+                      are used for unknown residues and padding.
+    """
     BLOSUM62 = bl.BLOSUM(62)
-    encoded_sequences = []
-    i = 0
-    for seq in sequences:
-        i += 1
-        encoded_seq = []
-        for acid in seq:
-            # Fetch the BLOSUM62 row for the current amino acid
-            row = BLOSUM62[acid]
-            # Extract scores for the sequence from the row corresponding to each amino acid
-            encoded_row = [
-                row.get(aa, 0) for aa in seq
-            ]  # default to 0 if pair not found
-
-            # Convert list to torch tensor and pad the encoded row to ensure all rows have the same number of columns
-            encoded_row = torch.tensor(encoded_row, dtype=torch.int8)
-            if encoded_row.size(0) < pad_to_length:
-                encoded_row = torch.nn.functional.pad(
-                    encoded_row,
-                    (0, pad_to_length - encoded_row.size(0)),
-                    mode="constant",
-                    value=0,
-                )
+    symbols = list(BLOSUM62.keys())
+    table = torch.zeros((len(symbols) + 1, len(symbols) + 1), dtype=torch.int8)
+    for i, acid in enumerate(symbols):
+        for j, aa in enumerate(symbols):
+            table[i, j] = int(BLOSUM62[acid].get(aa, 0))
+    return {acid: i for i, acid in enumerate(symbols)}, table
+
 
-            encoded_seq.append(encoded_row)
+def blosum62_tokenize(sequences, pad_to_length):
+    """
+    Maps the residues of each sequence to their index in the BLOSUM62 lookup table, padding with the
+    index of the zero row/column.
 
-        # Stack all rows to create a 2D tensor for each sequence
-        encoded_seq = torch.stack(encoded_seq)
+    Returns:
+        torch.Tensor: (N, pad_to_length) int8 tensor of residue indices.
+    """
+    symbol_to_index, table = load_blosum62_table()
+    unknown_index = table.size(0) - 1
 
-        # Pad the encoded sequence if it has fewer rows than `pad_to_length`
-        if encoded_seq.size(0) < pad_to_length:
-            padding = torch.zeros((pad_to_length - encoded_seq.size(0), pad_to_length))
-            encoded_seq = torch.cat((encoded_seq, padding), dim=0)
+    # Byte lookup table, so that all the sequences are mapped at once
+    byte_to_index = np.full(256, unknown_index, dtype=np.int8)
+    for acid, i in symbol_to_index.items():
+        byte_to_index[ord(acid)] = i
 
-        if logger is not None and i % 1000 == 0:
-            logger.log(f"Encoded sequence {i}")
+    sequences = np.array(
+        [seq[:pad_to_length].encode("ascii") for seq in sequences], dtype=f"S{pad_to_length}"
+    )
+    seq_bytes = sequences.view(np.uint8).reshape(len(sequences), pad_to_length)
+    return torch.from_numpy(byte_to_index[seq_bytes])
 
-        encoded_sequences.append(encoded_seq)
 
-    # Stack all sequence tensors to create a 3D tensor for the batch
-    return torch.stack(encoded_sequences)
+def blosum62_gather(indices, table=None):
+    """
+    Builds the (..., L, L) BLOSUM62 encodings of a batch of residue indices with a single gather.
+    """
+    if table is None:
+        _, table = load_blosum62_table()
+    indices = indices.long()
+    return table[indices.unsqueeze(-1), indices.unsqueeze(-2)]
+
+
+def blosum62_encode(sequences, pad_to_length, logger=None, batch_size=1024):
+    """
+    Encodes each sequence as the (pad_to_length, pad_to_length) matrix of BLOSUM62 substitution scores
+    between all pairs of its residues. Unknown residues and padding are scored 0.
+
+    Returns:
+        torch.Tensor: (N, pad_to_length, pad_to_length) int8 tensor.
+    """
+    _, table = load_blosum62_table()
+    indices = blosum62_tokenize(sequences, pad_to_length)
+
+    encoded_sequences = torch.empty(
+        (len(indices), pad_to_length, pad_to_length), dtype=torch.int8
+    )
+    for start in range(0, len(indices), batch_size):
+        encoded_sequences[start : start + batch_size] = blosum62_gather(
+            indices[start : start + batch_size], table
+        )
+        if logger is not None:
+            logger.log(f"Encoded sequence {min(start + batch_size, len(indices))}")
+
+    return encoded_sequences
+
+
+def get_token_dtype(tokenizer):
+    # Smallest integer type that can hold every token id of the vocabulary
+    return np.int8 if len(tokenizer.get_vocab()) <= np.iinfo(np.int8).max else np.int16
 
 
 def categorical_encode(
@@ -661,89 +1239,111 @@ def categorical_encode(
     add_eos=False,
     logger=None,
     model_name="progen2",
+    source_key=None,
 ):
+    """
+    Encodes the sequences in a single batched tokenizer call, with native padding and truncation.
+    The encodings are cached under CACHE_DIR, keyed by the sequences, the tokenizer and the encoding
+    settings, so repeated runs on the same data skip tokenization. The sequences are identified by
+    source_key when given (see dataset_source_key), otherwise by their hash.
+
+    Returns:
+        torch.Tensor: (N, padded length) int8 (or int16 for larger vocabularies) tensor of token ids.
+    """
+    token_dtype = get_token_dtype(tokenizer)
     if logger != None:
         logger.log(f"Initiating categorical encoding")
-        logger.log(f"Memory needed for encoding: {len(seqs) * max_len * 4}B")
-
-    if "progen2" in model_name:
-        # Adjust max_len if BOS or EOS tokens are to be added
-        internal_max_len = max_len + int(add_bos) + int(add_eos)
-
-        seq_tokens = tokenizer.get_vocab()["<|pad|>"] * torch.ones(
-            (len(seqs), internal_max_len), dtype=int
+        logger.log(
+            f"Memory needed for encoding: {len(seqs) * max_len * np.dtype(token_dtype).itemsize}B"
         )
-        for itr, seq in enumerate(seqs):
-            # Encode the sequence without adding special tokens by the tokenizer itself
-            encoded_seq_ids = tokenizer.encode(seq, add_special_tokens=False).ids
-
-            # Prepare sequence with space for BOS and/or EOS if needed
-            sequence = []
-            if add_bos:
-                sequence.append(tokenizer.get_vocab()["<|bos|>"])
-            sequence.extend(
-                encoded_seq_ids[:max_len]
-            )  # Ensure the core sequence does not exceed user-specified max_len
-            if add_eos:
-                sequence.append(tokenizer.get_vocab()["<|eos|>"])
-
-            # Truncate the sequence if it exceeds internal_max_len
-            truncated_sequence = sequence[:internal_max_len]
-
-            # Update the seq_tokens tensor
-            seq_len = len(truncated_sequence)
-            seq_tokens[itr, :seq_len] = torch.tensor(
-                truncated_sequence, dtype=torch.long
-            )
 
-            if itr == 0 and logger is not None:
-                logger.log(f"First sequence tokens: {seq_tokens[0].tolist()}")
-    elif "bert" in model_name:
+    cache_key = get_encoding_cache_key(
+        seqs, tokenizer, max_len, add_bos, add_eos, model_name, token_dtype, source_key
+    )
+    cache_path = f"{get_cache_dir()}/encodings/{cache_key}.npy"
+    if os.path.isfile(cache_path):
+        # Memory-mapped copy-on-write, so the pages are only read when used
+        seq_tokens = torch.from_numpy(np.load(cache_path, mmap_mode="c"))
+        if logger != None:
+            logger.log(f"Loaded cached categorical encoding from {cache_path}")
+        return seq_tokens
+
+    if "progen2" in model_name or "bert" in model_name:
+        if "progen2" in model_name:
+            pad_token, bos_token, eos_token = "<|pad|>", "<|bos|>", "<|eos|>"
+        else:
+            pad_token, bos_token, eos_token = "<pad>", "<cls>", "<sep>"
+        vocab = tokenizer.get_vocab()
+
         # Adjust max_len if BOS or EOS tokens are to be added
-        internal_max_len = max_len + int(add_bos) + int(add_eos)
+        internal_max_len = int(max_len) + int(add_bos) + int(add_eos)
 
-        seq_tokens = tokenizer.get_vocab()["<pad>"] * torch.ones(
-            (len(seqs), internal_max_len), dtype=int
+        # Work on a copy, so that the padding and truncation settings do not leak to the model tokenizer
+        batch_tokenizer = Tokenizer.from_str(tokenizer.to_str())
+        template = [bos_token] * add_bos + ["$A"] + [eos_token] * add_eos
+        batch_tokenizer.post_processor = TemplateProcessing(
+            single=" ".join(template),
+            special_tokens=[
+                (token, vocab[token])
+                for token, added in ((bos_token, add_bos), (eos_token, add_eos))
+                if added
+            ],
+        )
+        # The special tokens are kept when truncating, so the core sequence does not exceed max_len
+        batch_tokenizer.enable_truncation(max_length=internal_max_len)
+        batch_tokenizer.enable_padding(
+            pad_id=vocab[pad_token], pad_token=pad_token, length=internal_max_len
         )
-        for itr, seq in enumerate(seqs):
-            # Encode the sequence without adding special tokens by the tokenizer itself
-            encoded_seq_ids = tokenizer.encode(seq, add_special_tokens=False).ids
-
-            # Prepare sequence with space for BOS and/or EOS if needed
-            sequence = []
-            if add_bos:
-                sequence.append(tokenizer.get_vocab()["<cls>"])
-            sequence.extend(
-                encoded_seq_ids[:max_len]
-            )  # Ensure the core sequence does not exceed user-specified max_len
-            if add_eos:
-                sequence.append(tokenizer.get_vocab()["<sep>"])
-
-            # Truncate the sequence if it exceeds internal_max_len
-            truncated_sequence = sequence[:internal_max_len]
-
-            # Update the seq_tokens tensor
-            seq_len = len(truncated_sequence)
-            seq_tokens[itr, :seq_len] = torch.tensor(
-                truncated_sequence, dtype=torch.long
-            )
 
-            if itr == 0 and logger is not None:
-                logger.log(f"First sequence tokens: {seq_tokens[0].tolist()}")
+        encodings = batch_tokenizer.encode_batch(list(seqs))
+        seq_tokens = torch.from_numpy(
+            np.array([encoding.ids for encoding in encodings], dtype=token_dtype)
+        )
     elif "esm" in model_name:
-        seq_tokens = tokenizer.get_vocab()["<pad>"] * torch.ones(
-            (len(seqs), int(max_len) + 2), dtype=int
-        )  ### Adding  to max_len because ESMTokenizer adds cls and eos tokens in the begging and the neding of aa_seq
-        for itr, seq in enumerate(seqs):
-            tok_seq = torch.tensor(tokenizer.encode(seq))
-            seq_tokens[itr][: tok_seq.shape[0]] = tok_seq
+        ### Adding 2 to max_len because ESMTokenizer adds cls and eos tokens in the begging and the neding of aa_seq
+        encodings = tokenizer(
+            list(seqs),
+            padding="max_length",
+            truncation=True,
+            max_length=int(max_len) + 2,
+            return_attention_mask=False,
+        )
+        seq_tokens = torch.from_numpy(
+            np.array(encodings["input_ids"], dtype=token_dtype)
+        )
     else:
         raise "Model tokenizer not defined"
+
+    save_to_cache(lambda path: np.save(path, seq_tokens.numpy()), cache_path, logger)
+
+    if logger is not None and len(seq_tokens) > 0:
+        logger.log(f"First sequence tokens: {seq_tokens[0].tolist()}")
     if logger != None:
         logger.log(f"Categorical encoding finished")
     return seq_tokens
 
 
+def get_encoding_cache_key(
+    seqs, tokenizer, max_len, add_bos, add_eos, model_name, token_dtype, source_key=None
+):
+    digest = hashlib.sha256()
+    if isinstance(tokenizer, Tokenizer):
+        digest.update(tokenizer.to_str().encode("utf-8"))
+    else:
+        digest.update(type(tokenizer).__name__.encode("utf-8"))
+        digest.update(json.dumps(tokenizer.get_vocab(), sort_keys=True).encode("utf-8"))
+    model_branch = next(
+        (name for name in ("progen2", "bert", "esm") if name in model_name), model_name
+    )
+    settings = [model_branch, int(max_len), bool(add_bos), bool(add_eos), np.dtype(token_dtype).name]
+    digest.update(json.dumps(settings).encode("utf-8"))
+    if source_key is not None:
+        digest.update(f"{source_key}:{len(seqs)}".encode("utf-8"))
+    else:
+        digest.update("\n".join(map(str, seqs)).encode("utf-8"))
+    return digest.hexdigest()
+
+
 def get_parameters(model, print_w_mat=False, logger=None):
     s = 0
     c = 0
@@ -1004,7 +1604,11 @@ def find_mutation_positions(seq, ref, padding_id=None):
     return [i for i, (s, r) in enumerate(zip(seq, ref)) if s != r]
 
 
-def init_plm(model_name, logger, task="regression"):
+def init_plm(model_name, logger, task="regression", layers=None):
+    """
+    Initialises a pretrained language model. If the layers that will be used are given (e.g. ["middle"]),
+    only the blocks up to the deepest of them are loaded.
+    """
     model = None
     supported_progen2 = ["progen2-small", "progen2-medium", "progen2-xlarge"]
     supported_ESM = [
@@ -1020,11 +1624,11 @@ def init_plm(model_name, logger, task="regression"):
 
     if "progen" in model_name:
         assert model_name in supported_progen2, "Progen version is not supported"
-        model = ProGenFamily(model_name, logger, task)
+        model = ProGenFamily(model_name, logger, task, layers=layers)
 
     elif "esm" in model_name:
         assert model_name in supported_ESM, "ESM version is not supported"
-        model = ESMFamily(model_name, logger, task)
+        model = ESMFamily(model_name, logger, task, layers=layers)
     # elif "ankh" in model_name:
     #     assert model_name in supported_Ankh, "Ankh version is not supported"
     #     model = AnkhFamily(model_name)
@@ -1034,7 +1638,7 @@ def init_plm(model_name, logger, task="regression"):
         assert (
             model_name in supported_Proteinbert
         ), "ProteinBERT version is not supported"
-        model = ProteinBERTFamily(logger, task)
+        model = ProteinBERTFamily(logger, task, layers=layers)
     else:
         raise "PLM not supported"
 
@@ -25,10 +25,12 @@ export HF_HOME="/cluster/scratch/$SLURM_USERNAME/"
 export HF_HUB_CACHE="/cluster/scratch/$SLURM_USERNAME/"
 source $VIRTUAL_ENV/bin/activate
 
-nvidia-smi
-nvidia-smi --query-gpu=timestamp,name,utilization.gpu,memory.total,memory.used --format=csv -l 1 > ${11}/gpu_usage.log 2>&1 &
-# Store the PID of the nvidia-smi background process
-NVIDIA_SMI_PID=$!
+if [ "${13}" -gt 0 ]; then
+  nvidia-smi
+  nvidia-smi --query-gpu=timestamp,name,utilization.gpu,memory.total,memory.used --format=csv -l 1 > ${11}/gpu_usage.log 2>&1 &
+  # Store the PID of the nvidia-smi background process
+  NVIDIA_SMI_PID=$!
+fi
 
 while true; do
   myjobs -j $SLURM_JOBID >> ${11}/task_monitor.log 2>&1
@@ -36,9 +38,16 @@ while true; do
 done &
 CPU_FREE_PID=$!
 
-srun python3 plmfit --function $1 --ft_method $2 --target_layers $3 --head_config $4 \
-        --data_type $5 --split $6 --plm $7 --layer $8 --reduction $9 \
-        --output_dir ${10} --experiment_dir ${11} --experiment_name ${12} --gpus ${13} --nodes ${14} --beta True --experimenting ${15}
+if [ "${13}" -gt 0 ]; then
+  srun python3 plmfit --function $1 --ft_method $2 --target_layers $3 --head_config $4 \
+          --data_type $5 --split $6 --plm $7 --layer $8 --reduction $9 \
+          --output_dir ${10} --experiment_dir ${11} --experiment_name ${12} --gpus ${13} --nodes ${14} --beta True --experimenting ${15}
+  kill $NVIDIA_SMI_PID
+else
+  # CPU-only nodes: gloo data-parallel processes, one per task
+  bash scripts/fine_tuning/launch_cpu_ddp.sh --function $1 --ft_method $2 --target_layers $3 --head_config $4 \
+          --data_type $5 --split $6 --plm $7 --layer $8 --reduction $9 \
+          --output_dir ${10} --experiment_dir ${11} --experiment_name ${12} --beta True --experimenting ${15}
+fi
 
-kill $NVIDIA_SMI_PID
 kill $CPU_FREE_PID
\ No newline at end of file
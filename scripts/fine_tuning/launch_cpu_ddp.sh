@@ -0,0 +1,16 @@
+#!/bin/bash
+# Runs plmfit with one gloo data-parallel process per SLURM task, for fine-tuning on CPU-only nodes.
+# Call it from a job submitted with --nodes=<M> --ntasks-per-node=<N> --cpus-per-task=<C>, with the
+# plmfit arguments, e.g.:
+#   bash scripts/fine_tuning/launch_cpu_ddp.sh --function fine_tuning --ft_method lora ...
+# Each of the N x M processes is bound to its own C cores and runs C intra-op threads.
+
+export MASTER_PORT=${MASTER_PORT:-$(expr 10000 + $(echo -n $SLURM_JOBID | tail -c 4))}
+export MASTER_ADDR=${MASTER_ADDR:-$(scontrol show hostnames "$SLURM_JOB_NODELIST" | head -n 1)}
+export OMP_NUM_THREADS=${SLURM_CPUS_PER_TASK:-1}
+export MKL_NUM_THREADS=$OMP_NUM_THREADS
+echo "MASTER_ADDR:MASTER_PORT="${MASTER_ADDR}:${MASTER_PORT}
+echo "Processes per node: $SLURM_NTASKS_PER_NODE, nodes: $SLURM_JOB_NUM_NODES, threads per process: $OMP_NUM_THREADS"
+
+srun --cpu-bind=cores python3 plmfit "$@" \
+        --gpus 0 --cpus "$SLURM_NTASKS_PER_NODE" --nodes "$SLURM_JOB_NUM_NODES"
@@ -18,15 +18,20 @@ do
   experiment_name="${data_type}_${split}_${plm}_${ft_method}_${layer}_${reduction}_${head}_${task}"
   experiment_dir="$output_dir/$function/${ft_method}_${target_layers}/$experiment_name/$uid"
   total_gpus="$((${gpus}*${nodes}))"
+  if [ "$gpus" -gt 0 ]; then
+    resources="--ntasks=$total_gpus --ntasks-per-node=$gpus --gpus-per-node=$gres:$gpus"
+  else
+    # CPU-only: CPU_TASKS_PER_NODE data-parallel processes per node, each with CPUS_PER_TASK cores
+    cpu_tasks="${CPU_TASKS_PER_NODE:-4}"
+    resources="--ntasks=$((${cpu_tasks}*${nodes})) --ntasks-per-node=$cpu_tasks --cpus-per-task=${CPUS_PER_TASK:-8}"
+  fi
   
   sbatch --job-name="${ft_method}_${data_type}_${plm}_${task}" \
          --output="$experiment_dir/euler_output.out" \
          --error="$experiment_dir/euler_error.err" \
          --mem-per-cpu="$mem_per_cpu" \
          --nodes=$nodes \
-         --ntasks=$total_gpus \
-         --ntasks-per-node=$gpus \
-         --gpus-per-node=$gres:$gpus \
+         $resources \
          --time=$run_time:00:00 \
          scripts/fine_tuning/fine_tuning_mass.sh \
          "$function" "$ft_method" "$target_layers" "$head_config" "$data_type" "$split" "$plm" "$layer" "$reduction" "$output_dir" "$experiment_dir" "$experiment_name" "$gpus" "$nodes" "$experimenting"
@@ -0,0 +1,198 @@
+import copy
+import unittest
+import torch
+import torch.nn.functional as F
+import plmfit.models.downstream_heads as heads
+from plmfit.models.lightning_model import LightningModel
+from plmfit.models.head_farm import HeadFarm, build_head
+from plmfit.shared_utils.random_state import set_seed
+
+
+class TestOneHotEmbeddingBag(unittest.TestCase):
+    def setUp(self):
+        set_seed(42)
+        self.seq_len, self.num_classes = 6, 5
+        self.encs = torch.randint(0, self.num_classes, (8, self.seq_len), dtype=torch.int8)
+        self.one_hot = F.one_hot(self.encs.long(), self.num_classes).flatten(start_dim=1).float()
+
+    def test_heads_match_one_hot_inputs(self):
+        configs = [
+            {"network_type": "linear", "output_dim": 2, "task": "regression"},
+            {
+                "network_type": "mlp",
+                "output_dim": 2,
+                "task": "regression",
+                "hidden_dim": 16,
+                "hidden_activation": "relu",
+                "hidden_dropout": 0.0,
+            },
+        ]
+        for config in configs:
+            config["input_dim"] = self.seq_len * self.num_classes
+            head = (
+                heads.LinearHead(config)
+                if config["network_type"] == "linear"
+                else heads.MLP(config)
+            )
+            expected = head(self.one_hot)
+            head = heads.use_embedding_bag(head, self.seq_len, self.num_classes)
+            torch.testing.assert_close(head(self.encs), expected)
+
+
+class TestLinearHeadSolver(unittest.TestCase):
+    def setUp(self):
+        set_seed(42)
+        self.x = torch.randn(200, 5)
+        self.true_weight = torch.randn(5)
+
+    def test_ridge_solution_matches_normal_equations(self):
+        y = self.x @ self.true_weight + 0.5 + 0.01 * torch.randn(200)
+        head = heads.LinearHead({"input_dim": 5, "output_dim": 1, "task": "regression"})
+        head.fit(self.x, y, loss_f="mse", weight_decay=0.0)
+        torch.testing.assert_close(
+            head.linear.weight.squeeze(0), self.true_weight, atol=1e-2, rtol=0
+        )
+        torch.testing.assert_close(head.linear.bias, torch.tensor([0.5]), atol=1e-2, rtol=0)
+
+        # The gradient of the penalised mean squared error vanishes at the solution
+        head.fit(self.x, y, loss_f="mse", weight_decay=0.1)
+        loss = F.mse_loss(head(self.x).squeeze(1), y)
+        loss = loss + 0.1 / 2 * head.linear.weight.pow(2).sum()
+        loss.backward()
+        self.assertLess(head.linear.weight.grad.abs().max().item(), 1e-4)
+        self.assertLess(head.linear.bias.grad.abs().max().item(), 1e-4)
+
+    def test_mse_with_output_activation(self):
+        y = torch.sigmoid(self.x @ self.true_weight - 0.3)
+        head = heads.LinearHead(
+            {"input_dim": 5, "output_dim": 1, "task": "regression", "output_activation": "sigmoid"}
+        )
+        head.fit(self.x, y, loss_f="mse", weight_decay=0.0)
+        # The weights are fitted through the activation, not to the activated targets
+        torch.testing.assert_close(
+            head.linear.weight.squeeze(0), self.true_weight, atol=1e-2, rtol=0
+        )
+        torch.testing.assert_close(head.linear.bias, torch.tensor([-0.3]), atol=1e-2, rtol=0)
+
+        head.fit(self.x, y, loss_f="mse", weight_decay=0.1)
+        loss = F.mse_loss(head(self.x).squeeze(1), y)
+        loss = loss + 0.1 / 2 * head.linear.weight.pow(2).sum()
+        loss.backward()
+        self.assertLess(head.linear.weight.grad.abs().max().item(), 1e-4)
+
+    def test_logistic_regression_converges(self):
+        for output_dim in (1, 3):
+            if output_dim == 1:
+                y = (self.x @ self.true_weight > 0).float()
+                config = {"output_activation": "sigmoid", "task": "classification"}
+                loss_f = "bce"
+            else:
+                y = torch.argmax(self.x[:, :3], dim=1).float()
+                config = {"task": "classification"}
+                loss_f = "cross_entropy"
+            config.update(input_dim=5, output_dim=output_dim)
+            head = heads.LinearHead(config)
+            head.fit(self.x, y, loss_f=loss_f, weight_decay=0.01)
+
+            logits = head.linear(self.x)
+            if output_dim == 1:
+                loss = F.binary_cross_entropy_with_logits(logits.squeeze(1), y)
+                accuracy = ((logits.squeeze(1) > 0).float() == y).float().mean()
+            else:
+                loss = F.cross_entropy(logits, y.long())
+                accuracy = (logits.argmax(dim=1) == y.long()).float().mean()
+            loss = loss + 0.01 / 2 * head.linear.weight.pow(2).sum()
+            loss.backward()
+            self.assertLess(head.linear.weight.grad.abs().max().item(), 1e-3)
+            self.assertGreater(accuracy.item(), 0.95)
+
+
+class TestHeadFarm(unittest.TestCase):
+    def setUp(self):
+        set_seed(42)
+        self.x = torch.randn(48, 8)
+        self.y = self.x @ torch.randn(8) + 0.1 * torch.randn(48)
+        self.config = {"network_type": "linear", "input_dim": 8, "output_dim": 1, "task": "regression"}
+        self.loader = torch.utils.data.DataLoader(
+            torch.utils.data.TensorDataset(self.x, self.y), batch_size=16
+        )
+
+    def test_matches_heads_trained_one_by_one(self):
+        learning_rates, weight_decays = [1e-2, 1e-3, 5e-2], [0.0, 0.01, 0.1]
+        farm_heads = [build_head(self.config) for _ in learning_rates]
+        expected = []
+        for head, lr, weight_decay in zip(farm_heads, learning_rates, weight_decays):
+            head = copy.deepcopy(head)
+            optimizer = torch.optim.Adam(head.parameters(), lr=lr, weight_decay=weight_decay)
+            lr_scheduler = LightningModel.initialize_lr_scheduler(None, optimizer)
+            for _ in range(3):
+                for x, y in self.loader:
+                    optimizer.zero_grad()
+                    F.mse_loss(head(x).squeeze(dim=1), y).backward()
+                    optimizer.step()
+                lr_scheduler.step()
+            expected.append(head)
+
+        farm = HeadFarm(farm_heads, learning_rates, weight_decays, loss_f="mse", optimizer="adam")
+        history = farm.fit(self.loader, self.loader, epochs=3)
+        self.assertEqual([len(losses) for losses in history["epoch_val_loss"]], [3, 3, 3])
+        # The validation loss decreases at every epoch, so the best parameters are the last ones
+        self.assertEqual(history["best_epoch"], [2, 2, 2])
+        for index, head in enumerate(expected):
+            state_dict = farm.state_dict(index)
+            torch.testing.assert_close(state_dict["linear.weight"], head.linear.weight.detach())
+            torch.testing.assert_close(state_dict["linear.bias"], head.linear.bias.detach())
+
+    def test_single_head_matches_torch_optimizers(self):
+        config = dict(self.config, network_type="mlp", hidden_dim=16, hidden_dropout=0.0)
+        config["hidden_activation"] = "relu"
+        for optimizer_name, optimizer_class in (("adam", torch.optim.Adam), ("sgd", torch.optim.SGD)):
+            head = build_head(config)
+            expected = copy.deepcopy(head)
+            # Same optimizer, learning rate schedule (stepped every epoch) and gradient norm clipping as a
+            # LightningModel trained by the Trainer
+            optimizer = optimizer_class(expected.parameters(), lr=1e-2, weight_decay=0.01)
+            lr_scheduler = LightningModel.initialize_lr_scheduler(None, optimizer)
+            farm = HeadFarm(
+                [head], [1e-2], [0.01], optimizer=optimizer_name, gradient_clipping=0.5
+            )
+            # Past the epochs of the reduced learning rate
+            for _ in range(7):
+                for x, y in self.loader:
+                    optimizer.zero_grad()
+                    F.mse_loss(expected(x).squeeze(dim=1), y).backward()
+                    torch.nn.utils.clip_grad_norm_(expected.parameters(), 0.5)
+                    optimizer.step()
+                lr_scheduler.step()
+                farm.train_epoch(self.loader, torch.ones(1, dtype=torch.bool))
+            for name, param in expected.named_parameters():
+                torch.testing.assert_close(farm.params[name][0].detach(), param.detach())
+
+    def test_early_stopping_is_per_head(self):
+        # A head with a zero learning rate never improves after its first epoch
+        farm = HeadFarm(
+            [build_head(self.config) for _ in range(2)], [1e-2, 0.0], [0.0, 0.0], optimizer="sgd"
+        )
+        initial = farm.params["linear.weight"][1].detach().clone()
+        history = farm.fit(self.loader, self.loader, epochs=6, patience=2)
+        self.assertEqual(len(history["epoch_val_loss"][0]), 6)
+        self.assertEqual(len(history["epoch_val_loss"][1]), 3)
+        self.assertEqual(history["best_epoch"][1], 0)
+        torch.testing.assert_close(farm.state_dict(1)["linear.weight"], initial)
+
+    def test_mlp_dropout_is_per_head(self):
+        config = dict(self.config, network_type="mlp", hidden_dim=32, hidden_dropout=0.0)
+        config["hidden_activation"] = "relu"
+        mlp_heads = [build_head(dict(config, hidden_dropout=p)) for p in (0.0, 0.5)]
+        farm = HeadFarm(mlp_heads, [1e-3, 1e-3], [0.0, 0.0])
+        farm.base.train()
+        outputs = farm(self.x)
+        farm.base.eval()
+        eval_outputs = farm(self.x)
+        torch.testing.assert_close(outputs[0], eval_outputs[0])
+        self.assertFalse(torch.allclose(outputs[1], eval_outputs[1]))
+        torch.testing.assert_close(eval_outputs[1], mlp_heads[1].eval()(self.x))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,185 @@
+import copy
+import json
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+import torch
+from plmfit.shared_utils import utils
+from plmfit.models.downstream_heads import LinearHead
+from plmfit.functions.generate import (
+    BANNED_TOKENS,
+    STOP_TOKENS,
+    generate_sequences,
+    load_head_embeddings,
+    sample_batch,
+)
+from plmfit.language_models.progen2.models.progen.configuration_progen import (
+    ProGenConfig,
+)
+from plmfit.language_models.progen2.models.progen.modeling_progen import (
+    ProGenForCausalLM,
+    ProGenForEmbeddingsExtraction,
+)
+
+
+class TestProGenGeneration(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.tokenizer = utils.load_tokenizer("progen2-small")
+        self.vocab = self.tokenizer.get_vocab()
+        config = ProGenConfig(
+            vocab_size=self.tokenizer.get_vocab_size(),
+            n_positions=64,
+            n_ctx=64,
+            n_embd=64,
+            n_layer=2,
+            n_head=8,
+            rotary_dim=4,
+        )
+        self.model = ProGenForCausalLM(config).eval()
+        self.prompts = ["1MKT", "1MKTAYIAK", "1G"]
+        self.prompt_ids = [self.tokenizer.encode(prompt).ids for prompt in self.prompts]
+        self.stop_token_ids = [self.vocab[token] for token in STOP_TOKENS]
+        self.banned_token_ids = [self.vocab[token] for token in BANNED_TOKENS]
+
+    def greedy(self, ids, max_length):
+        # Same as sample_batch with greedy decoding, one sequence at a time and without cache
+        ids = list(ids)
+        while len(ids) < max_length:
+            with torch.no_grad():
+                logits = self.model(torch.tensor([ids])).logits[0, -1]
+            logits[self.banned_token_ids] = -float("inf")
+            ids.append(int(logits.argmax()))
+            if ids[-1] in self.stop_token_ids:
+                break
+        return ids
+
+    def test_cached_batch_matches_single_sequences(self):
+        # With a tiny top_p only the most likely token is kept
+        outputs = {
+            row: token_ids
+            for row, token_ids, _ in sample_batch(
+                self.model,
+                self.prompt_ids,
+                pad_token_id=self.vocab["<|pad|>"],
+                stop_token_ids=self.stop_token_ids,
+                banned_token_ids=self.banned_token_ids,
+                max_length=20,
+                top_p=1e-6,
+            )
+        }
+        self.assertEqual(sorted(outputs), [0, 1, 2])
+        for row, ids in enumerate(self.prompt_ids):
+            self.assertEqual(outputs[row], self.greedy(ids, 20))
+
+    def extracted_embeddings(self, sequences, layer, reduction):
+        # Embeddings of the sequences as feature extraction computes them, with the weights of the model
+        config = copy.deepcopy(self.model.config)
+        config.pad_token_id = self.vocab["<|pad|>"]
+        extractor = ProGenForEmbeddingsExtraction(config).eval()
+        extractor.load_state_dict(self.model.state_dict(), strict=False)
+        extractor.layers_to_use = {layer: layer}
+        extractor.reductions = [reduction]
+        with tempfile.TemporaryDirectory() as tmp_dir, patch.object(utils, "data_dir", tmp_dir):
+            encs = utils.categorical_encode(
+                sequences,
+                self.tokenizer,
+                max(len(sequence) for sequence in sequences),
+                add_bos=True,
+                add_eos=True,
+            )
+        with torch.no_grad():
+            return extractor(encs).logits[(layer, reduction)]
+
+    def test_head_scores_extracted_embeddings(self):
+        head = LinearHead({"input_dim": 64, "output_dim": 1, "task": "regression"}).eval()
+        id_to_token = {token_id: token for token, token_id in self.vocab.items()}
+        terminal_tokens = (*STOP_TOKENS, *BANNED_TOKENS)
+        for layer, reduction in ((-1, "mean"), (0, "sum"), (0, "max"), (1, "eos")):
+            with self.subTest(layer=layer, reduction=reduction):
+                sequences, predictions = [], []
+                for row, token_ids, prediction in sample_batch(
+                    self.model,
+                    self.prompt_ids,
+                    pad_token_id=self.vocab["<|pad|>"],
+                    stop_token_ids=self.stop_token_ids,
+                    banned_token_ids=self.banned_token_ids,
+                    max_length=16,
+                    head=head,
+                    head_layer=layer,
+                    head_reduction=reduction,
+                    bos_token_id=self.vocab["<|bos|>"],
+                    eos_token_id=self.vocab["<|eos|>"],
+                    generator=torch.Generator().manual_seed(0),
+                ):
+                    tokens = [id_to_token[token_id] for token_id in token_ids]
+                    sequences.append(
+                        "".join(token for token in tokens if token not in terminal_tokens)
+                    )
+                    predictions.append(prediction)
+
+                with torch.no_grad():
+                    expected = head(self.extracted_embeddings(sequences, layer, reduction))
+                for prediction, value in zip(predictions, expected.squeeze(-1).tolist()):
+                    self.assertAlmostEqual(prediction, value, places=4)
+
+    def test_head_embeddings_from_saved_config(self):
+        def saved(arguments, scaler=False):
+            with open(os.path.join(tmp_dir, "head_data.json"), "w") as f:
+                json.dump(
+                    {
+                        "arguments": arguments,
+                        "head_config": {"training_parameters": {"scaler": scaler}},
+                    },
+                    f,
+                )
+            return load_head_embeddings(os.path.join(tmp_dir, "head.pt"), "progen2-small")
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with self.assertRaises(ValueError):
+                load_head_embeddings(os.path.join(tmp_dir, "head.pt"), "progen2-small")
+            arguments = {"plm": "progen2-small", "layer": "middle", "reduction": "max"}
+            self.assertEqual(saved(arguments), ("middle", "max"))
+            # Checkpoints are saved in the lightning_logs directory of the experiment
+            os.makedirs(os.path.join(tmp_dir, "lightning_logs"))
+            self.assertEqual(
+                load_head_embeddings(
+                    os.path.join(tmp_dir, "lightning_logs", "best_model.ckpt"), "progen2-small"
+                ),
+                ("middle", "max"),
+            )
+            for invalid, scaler in (
+                ({"plm": "esm2_t6_8M_UR50D"}, False),
+                ({"reduction": "mut_mean"}, False),
+                ({}, True),
+            ):
+                with self.assertRaises(ValueError):
+                    saved({**arguments, **invalid}, scaler=scaler)
+
+    def test_generated_sequences(self):
+        records = list(
+            generate_sequences(
+                self.model,
+                self.tokenizer,
+                self.prompts,
+                num_samples=3,
+                max_length=12,
+                batch_size=4,
+                seed=0,
+            )
+        )
+        self.assertEqual(
+            sorted((record["prompt"], record["sample"]) for record in records),
+            [(prompt, sample) for prompt in range(3) for sample in range(3)],
+        )
+        for record in records:
+            prompt = self.prompts[record["prompt"]]
+            self.assertTrue(record["sequence"].startswith(prompt[1:]))
+            self.assertLessEqual(len(self.prompt_ids[record["prompt"]]) + record["n_generated"], 12)
+            self.assertFalse(any(token in record["sequence"] for token in "12<|"))
+            self.assertIsNone(record["prediction"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,482 @@
+import copy
+import json
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+import torch
+from lightning import Trainer
+from transformers import EsmConfig
+from plmfit.language_models.progen2.models.progen.configuration_progen import (
+    ProGenConfig,
+)
+from plmfit.language_models.progen2.models.progen.modeling_progen import (
+    ProGenForEmbeddingsExtraction,
+    ProGenForSequenceClassification,
+    ProGenModel,
+)
+from plmfit.language_models.proteinbert.modeling_bert import (
+    ProteinBertConfig,
+    ProteinBertModel,
+    ProteinBertForEmbeddingsExtraction,
+)
+from plmfit.language_models.esm.modeling_esm import (
+    PlmfitEsmForEmbdeddingsExtraction,
+    PlmfitEsmForSequenceClassification,
+)
+from plmfit.shared_utils import layer_loading
+from plmfit.shared_utils.activation_cache import TrunkActivationCache
+from plmfit.shared_utils.rotary_embedding import (
+    RotaryEmbeddingCache,
+    apply_rotary_pos_emb,
+)
+from plmfit.shared_utils.inference_precision import (
+    embed_sample,
+    fidelity_report,
+    get_trainer_precision,
+    quantize_linear_layers,
+)
+
+
+def tiny_progen_config():
+    return ProGenConfig(
+        vocab_size=32,
+        n_positions=64,
+        n_ctx=64,
+        n_embd=64,
+        n_layer=3,
+        n_head=8,
+        rotary_dim=4,
+        resid_pdrop=0.0,
+        embd_pdrop=0.0,
+        attn_pdrop=0.0,
+        bos_token_id=1,
+        eos_token_id=2,
+        pad_token_id=0,
+    )
+
+
+def masked_mean(hidden_states, input_ids, pad_token_id):
+    # Mean over the tokens that are not padding
+    mask = (input_ids != pad_token_id).unsqueeze(-1).to(hidden_states.dtype)
+    return (hidden_states * mask).sum(dim=1) / mask.sum(dim=1)
+
+
+class TestProGenEmbeddingsExtraction(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.model = ProGenForEmbeddingsExtraction(tiny_progen_config()).eval()
+        self.input_ids = torch.tensor(
+            [[1, 5, 6, 7, 8, 2], [1, 9, 10, 2, 0, 0]], dtype=torch.long
+        )
+
+    def test_multiple_layers_and_reductions_match_single_runs(self):
+        multi = copy.deepcopy(self.model)
+        multi.trim_model(2)
+        multi.layers_to_use = {"first": 0, "last": 2}
+        multi.reductions = ["mean", "eos"]
+        with torch.no_grad():
+            outputs = multi(self.input_ids).logits
+
+        self.assertEqual(
+            set(outputs),
+            {("first", "mean"), ("first", "eos"), ("last", "mean"), ("last", "eos")},
+        )
+        for (layer, reduction), embeddings in outputs.items():
+            single = copy.deepcopy(self.model)
+            single.trim_model(multi.layers_to_use[layer])
+            single.reduction = reduction
+            with torch.no_grad():
+                expected = single(self.input_ids).logits
+            torch.testing.assert_close(embeddings, expected)
+
+    def test_only_requested_layers_are_kept(self):
+        self.model.layers_to_use = {"first": 0, "middle": 1}
+        self.model.reductions = ["mean"]
+        with torch.no_grad():
+            outputs = self.model(self.input_ids)
+            full = self.model.transformer(self.input_ids, output_hidden_states=True)
+
+        self.assertIsNone(outputs.hidden_states)
+        self.assertIsNone(outputs.attentions)
+        for block in self.model.transformer.h:
+            self.assertEqual(len(block._forward_hooks), 0)
+        for layer, layer_index in self.model.layers_to_use.items():
+            expected = self.model.transformer.ln_f(full.hidden_states[layer_index + 1])
+            torch.testing.assert_close(
+                outputs.logits[(layer, "mean")], masked_mean(expected, self.input_ids, 0)
+            )
+
+    def test_shared_prefix_matches_full_forward(self):
+        variants = torch.tensor(
+            [[1, 5, 6, 7, 8, 9, 2], [1, 5, 6, 7, 11, 9, 2], [1, 5, 6, 7, 12, 2, 0]],
+            dtype=torch.long,
+        )
+        self.model.layers_to_use = {"middle": 1, "last": 2}
+        self.model.reductions = ["mean", "eos"]
+        with torch.no_grad():
+            expected = self.model(variants).logits
+            self.model.set_prefix(variants[:1, :4])
+            outputs = self.model(variants).logits
+
+        self.assertIsNotNone(self.model.prefix_outputs)
+        self.assertEqual(set(outputs), set(expected))
+        for key, embeddings in outputs.items():
+            torch.testing.assert_close(embeddings, expected[key])
+
+
+class TestAttentionBackends(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.input_ids = torch.tensor(
+            [[1, 5, 6, 7, 8, 2], [1, 9, 10, 2, 0, 0]], dtype=torch.long
+        )
+        self.attention_mask = (self.input_ids != 0).long()
+
+    def test_progen_sdpa_matches_eager(self):
+        sdpa = ProGenModel(tiny_progen_config()).eval()
+        eager = copy.deepcopy(sdpa)
+        eager.config.attention_backend = "eager"
+        for block in eager.h:
+            block.attn.attention_backend = "eager"
+
+        with torch.no_grad():
+            for attention_mask in (None, self.attention_mask):
+                expected = eager(self.input_ids, attention_mask=attention_mask)
+                outputs = sdpa(self.input_ids, attention_mask=attention_mask)
+                torch.testing.assert_close(
+                    outputs.last_hidden_state, expected.last_hidden_state
+                )
+
+            # Cached keys and values, with queries offset in the causal mask
+            past = sdpa(self.input_ids[:, :4], use_cache=True).past_key_values
+            expected = eager(self.input_ids[:, 4:], past_key_values=past)
+            outputs = sdpa(self.input_ids[:, 4:], past_key_values=past)
+            torch.testing.assert_close(
+                outputs.last_hidden_state, expected.last_hidden_state
+            )
+
+    def test_protein_bert_sdpa_matches_eager(self):
+        config = ProteinBertConfig(
+            vocab_size=32,
+            hidden_size=64,
+            num_hidden_layers=2,
+            num_attention_heads=8,
+            intermediate_size=128,
+        )
+        sdpa = ProteinBertModel(config).eval()
+        eager = copy.deepcopy(sdpa)
+        for layer in eager.encoder.layer:
+            layer.attention.self.attention_backend = "eager"
+
+        with torch.no_grad():
+            expected = eager(self.input_ids, input_mask=self.attention_mask)[0]
+            outputs = sdpa(self.input_ids, input_mask=self.attention_mask)[0]
+        torch.testing.assert_close(outputs, expected)
+
+
+def reference_rotary_pos_emb(x, seq_len, offset=0):
+    # Original ProGen implementation, recomputing the sin/cos tables on each call
+    dim = x.shape[-1]
+    inv_freq = 1.0 / (10000 ** (torch.arange(0, dim, 2) / dim))
+    sinusoid_inp = torch.einsum("i , j -> i j", torch.arange(seq_len), inv_freq).float()
+    sin, cos = (
+        t[None, offset : x.shape[1] + offset, None, :].repeat_interleave(2, 3)
+        for t in (torch.sin(sinusoid_inp), torch.cos(sinusoid_inp))
+    )
+    rotated = torch.stack((-x[..., 1::2], x[..., ::2]), axis=-1).flatten(-2)
+    return (x * cos) + (rotated * sin)
+
+
+class TestRotaryEmbeddingCache(unittest.TestCase):
+    def test_matches_original_implementation(self):
+        torch.manual_seed(0)
+        cache = RotaryEmbeddingCache()
+        x = torch.randn(2, 5, 4, 8)
+        for offset in (0, 3):
+            sincos = cache.get(5 + offset, 8)
+            torch.testing.assert_close(
+                apply_rotary_pos_emb(x, sincos, offset=offset),
+                reference_rotary_pos_emb(x, 5 + offset, offset=offset),
+            )
+
+    def test_tables_grow_lazily(self):
+        cache = RotaryEmbeddingCache()
+        sin, _ = cache.get(10, 8)
+        self.assertEqual(sin.shape, (1, 10, 1, 8))
+        cache.get(4, 8)
+        self.assertEqual(cache.tables[(8, torch.float32, torch.device("cpu"))][0].shape[1], 10)
+        sin, _ = cache.get(12, 8)
+        self.assertEqual(sin.shape, (1, 12, 1, 8))
+        self.assertEqual(cache.tables[(8, torch.float32, torch.device("cpu"))][0].shape[1], 20)
+
+    def test_layers_share_the_model_cache(self):
+        model = ProGenModel(tiny_progen_config()).eval()
+        self.assertTrue(all(block.attn.rotary_cache is model.rotary_cache for block in model.h))
+        with torch.no_grad():
+            model(torch.tensor([[1, 5, 6, 7, 2]]))
+        self.assertEqual(len(model.rotary_cache.tables), 1)
+
+
+class TestLayerCapture(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.input_ids = torch.tensor(
+            [[0, 5, 6, 7, 8, 2], [0, 9, 10, 2, 1, 1]], dtype=torch.long
+        )
+
+    def test_esm_captured_layers_match_hidden_states(self):
+        config = EsmConfig(
+            vocab_size=33,
+            hidden_size=64,
+            num_hidden_layers=3,
+            num_attention_heads=8,
+            intermediate_size=128,
+            pad_token_id=1,
+        )
+        model = PlmfitEsmForEmbdeddingsExtraction(config).eval()
+        model.layers_to_use = {"first": 0, "last": 2}
+        model.reductions = ["mean", "bos"]
+        with torch.no_grad():
+            outputs = model(self.input_ids)
+            full = model.esm(
+                self.input_ids,
+                attention_mask=self.input_ids != 1,
+                output_hidden_states=True,
+            )
+
+        self.assertIsNone(outputs.hidden_states)
+        norm = model.esm.encoder.emb_layer_norm_after
+        for layer, layer_index in model.layers_to_use.items():
+            expected = norm(full.hidden_states[layer_index + 1])
+            torch.testing.assert_close(
+                outputs.logits[(layer, "mean")], masked_mean(expected, self.input_ids, 1)
+            )
+            torch.testing.assert_close(outputs.logits[(layer, "bos")], expected[:, 0])
+
+    def test_protein_bert_captured_layers_match_hidden_states(self):
+        config = ProteinBertConfig(
+            vocab_size=32,
+            hidden_size=64,
+            num_hidden_layers=3,
+            num_attention_heads=8,
+            intermediate_size=128,
+            output_hidden_states=True,
+        )
+        model = ProteinBertForEmbeddingsExtraction(config).eval()
+        model.layers_to_use = {"middle": 1, "last": 2}
+        model.reductions = ["mean"]
+        with torch.no_grad():
+            outputs = model(self.input_ids)
+
+        for layer, layer_index in model.layers_to_use.items():
+            torch.testing.assert_close(
+                outputs.logits[(layer, "mean")],
+                masked_mean(outputs.hidden_states[layer_index + 1], self.input_ids, 0),
+            )
+
+
+class TestTrunkActivationCache(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, "trunk")
+        self.input_ids = torch.tensor(
+            [[1, 5, 6, 7, 8, 2], [1, 9, 10, 2, 0, 0], [1, 11, 12, 13, 2, 0]],
+            dtype=torch.int8,
+        )
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def assert_cached_outputs_match(self, model, input_ids):
+        with torch.no_grad():
+            expected = model(input_ids).logits
+        cache = TrunkActivationCache.build(model, input_ids, 2, self.path)
+        self.assertEqual(cache.store.array.dtype, "float16")
+        indices = torch.tensor([2, 0, 1])
+        with cache.attach(model), torch.no_grad():
+            outputs = model(indices).logits
+        torch.testing.assert_close(outputs, expected[indices], atol=1e-2, rtol=1e-2)
+        # Once detached, the model runs every block again
+        with torch.no_grad():
+            torch.testing.assert_close(model(input_ids).logits, expected)
+
+    def test_progen_outputs_match_full_forward(self):
+        model = ProGenForSequenceClassification(tiny_progen_config()).eval()
+        model.set_head(torch.nn.Linear(64, 1))
+        self.assert_cached_outputs_match(model, self.input_ids)
+
+    def test_esm_outputs_match_full_forward(self):
+        config = EsmConfig(
+            vocab_size=33,
+            hidden_size=64,
+            num_hidden_layers=3,
+            num_attention_heads=8,
+            intermediate_size=128,
+            pad_token_id=0,
+        )
+        model = PlmfitEsmForSequenceClassification(config).eval()
+        model.set_head(torch.nn.Linear(64, 1))
+        self.assert_cached_outputs_match(model, self.input_ids)
+
+    def test_esm_hidden_states_are_turned_off(self):
+        # As loaded by ESMFamily, with output_hidden_states=True
+        config = EsmConfig(
+            vocab_size=33,
+            hidden_size=64,
+            num_hidden_layers=3,
+            num_attention_heads=8,
+            intermediate_size=128,
+            pad_token_id=0,
+            output_hidden_states=True,
+        )
+        model = PlmfitEsmForSequenceClassification(config).eval()
+        model.set_head(torch.nn.Linear(64, 1))
+        with torch.no_grad():
+            expected = model(self.input_ids)
+        self.assertEqual(len(expected.hidden_states), 4)
+
+        cache = TrunkActivationCache.build(model, self.input_ids, 2, self.path)
+        with cache.attach(model), torch.no_grad():
+            outputs = model(torch.arange(3))
+            self.assertIsNone(outputs.hidden_states)
+            with self.assertRaises(ValueError):
+                model(torch.arange(3), output_hidden_states=True)
+        torch.testing.assert_close(outputs.logits, expected.logits, atol=1e-2, rtol=1e-2)
+        # The hidden states of the uncached path are the same as before attaching the cache
+        self.assertTrue(model.config.output_hidden_states)
+        with torch.no_grad():
+            outputs = model(self.input_ids)
+        for hidden_states, expected_hidden_states in zip(outputs.hidden_states, expected.hidden_states):
+            torch.testing.assert_close(hidden_states, expected_hidden_states)
+
+        # ProGen returns the hidden states by default
+        model = ProGenForSequenceClassification(tiny_progen_config()).eval()
+        model.set_head(torch.nn.Linear(64, 1))
+        cache = TrunkActivationCache.build(model, self.input_ids, 2, self.path + "_progen")
+        with cache.attach(model), torch.no_grad():
+            self.assertIsNone(model(torch.arange(3)).hidden_states)
+        with torch.no_grad():
+            self.assertIsNotNone(model(self.input_ids).hidden_states)
+
+    def test_only_top_blocks_run_and_train(self):
+        model = ProGenForSequenceClassification(tiny_progen_config()).eval()
+        model.set_head(torch.nn.Linear(64, 1))
+        cache = TrunkActivationCache.build(model, self.input_ids, 2, self.path)
+        calls = []
+        for block in model.transformer.h:
+            block.mlp.register_forward_hook(lambda *_: calls.append(1))
+        with cache.attach(model):
+            model(torch.tensor([0, 1])).logits.sum().backward()
+        self.assertEqual(len(calls), 1)
+        self.assertIsNotNone(model.transformer.h[2].mlp.fc_in.weight.grad)
+        self.assertIsNone(model.transformer.h[1].mlp.fc_in.weight.grad)
+
+    def test_store_is_reused(self):
+        model = ProGenForSequenceClassification(tiny_progen_config()).eval()
+        TrunkActivationCache.build(model, self.input_ids, 2, self.path)
+        with patch.object(model, "forward", side_effect=AssertionError("trunk recomputed")):
+            cache = TrunkActivationCache.build(model, self.input_ids, 2, self.path)
+        self.assertEqual(cache.store.shape, (3, 6, 64))
+        self.assertEqual(sorted(os.listdir(self.tmp_dir.name)), ["trunk.json", "trunk.npy"])
+
+
+class TestLayerSelectiveLoading(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.model = ProGenForEmbeddingsExtraction(tiny_progen_config()).eval()
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+
+    def load_first_layers(self, num_layers):
+        return layer_loading.from_pretrained_layers(
+            ProGenForEmbeddingsExtraction,
+            self.tmp_dir.name,
+            num_layers,
+            layer_pattern=layer_loading.PROGEN_LAYER_PATTERN,
+            num_layers_key="n_layer",
+        ).eval()
+
+    def assert_matches_trimmed_model(self, model, num_layers):
+        self.assertEqual(len(model.transformer.h), num_layers)
+        expected = copy.deepcopy(self.model)
+        expected.trim_model(num_layers - 1)
+        input_ids = torch.tensor([[1, 5, 6, 7, 8, 2]])
+        with torch.no_grad():
+            torch.testing.assert_close(model(input_ids).logits, expected(input_ids).logits)
+
+    def test_bin_checkpoint(self):
+        self.model.save_pretrained(self.tmp_dir.name)
+        self.assert_matches_trimmed_model(self.load_first_layers(2), 2)
+
+    def test_sharded_checkpoint_skips_discarded_shards(self):
+        self.model.save_pretrained(
+            self.tmp_dir.name, safe_serialization=True, max_shard_size="100KB"
+        )
+        with open(os.path.join(self.tmp_dir.name, "model.safetensors.index.json")) as f:
+            shards = set(json.load(f)["weight_map"].values())
+
+        with patch.object(
+            layer_loading, "safe_open", wraps=layer_loading.safe_open
+        ) as safe_open:
+            model = self.load_first_layers(1)
+        opened = {os.path.basename(call.args[0]) for call in safe_open.call_args_list}
+        self.assertLess(len(opened), len(shards))
+        self.assert_matches_trimmed_model(model, 1)
+
+
+class TestInferencePrecision(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.model = ProGenForEmbeddingsExtraction(tiny_progen_config()).eval()
+        self.model.layers_to_use = {"middle": 1, "last": 2}
+        self.model.reductions = ["mean"]
+        self.encs = torch.randint(3, 32, (40, 12))
+        self.encs[:, 0], self.encs[:, -1] = 1, 2
+        self.encs[::3, -4:] = 0
+
+    def test_int8_embeddings_stay_close_to_fp32(self):
+        reference = embed_sample(self.model, self.encs, pad_token_id=0)
+        quantize_linear_layers(self.model)
+        self.assertIsInstance(
+            self.model.transformer.h[0].attn.qkv_proj,
+            torch.ao.nn.quantized.dynamic.Linear,
+        )
+        embeddings = embed_sample(self.model, self.encs, pad_token_id=0)
+
+        scores = reference[("last", "mean")][:, 0].double() + 0.01 * torch.randn(40).double()
+        report = fidelity_report(reference, embeddings, scores.numpy())
+        self.assertEqual(set(report), {"middle_mean", "last_mean"})
+        for entry in report.values():
+            self.assertGreater(entry["cosine_similarity_min"], 0.99)
+            self.assertLess(abs(entry["linear_probe_spearman_delta"]), 0.2)
+
+    def test_bf16_autocast(self):
+        reference = embed_sample(self.model, self.encs, pad_token_id=0)
+        embeddings = embed_sample(
+            self.model, self.encs, pad_token_id=0, autocast_dtype=torch.bfloat16
+        )
+        report = fidelity_report(reference, embeddings)
+        self.assertGreater(report["last_mean"]["cosine_similarity_mean"], 0.99)
+
+    def test_trainer_precisions(self):
+        # On CPU, fp32 must run without autocast, like the reference of fidelity_report
+        expected = {"fp32": "32-true", "bf16": "bf16-mixed", "int8": "32-true"}
+        for inference_precision, precision in expected.items():
+            trainer = Trainer(
+                accelerator="cpu",
+                devices=1,
+                precision=get_trainer_precision(inference_precision),
+                logger=False,
+                enable_checkpointing=False,
+            )
+            self.assertEqual(trainer.precision, precision)
+        with patch("torch.cuda.is_available", return_value=True):
+            self.assertEqual(get_trainer_precision("fp32"), "16-mixed")
+            with self.assertRaises(ValueError):
+                get_trainer_precision("int8")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,111 @@
+import os
+import tempfile
+import unittest
+import optuna
+import torch
+from torch.utils.data import TensorDataset
+from optuna.storages import JournalStorage
+from optuna.storages.journal import JournalFileBackend
+import lightning as L
+from lightning import Trainer
+from plmfit.shared_utils import parallel_tuning
+from plmfit.shared_utils.cpu_distributed import (
+    CoreAffinity,
+    cpu_ddp_strategy,
+    process_cores,
+)
+
+
+def quadratic_objective(trial, datasets, target):
+    trial.set_user_attr("pid", os.getpid())
+    trial.set_user_attr("threads", torch.get_num_threads())
+    x = trial.suggest_float("x", -10.0, 10.0)
+    return (x - target) ** 2 + float(datasets["train"].tensors[0].sum())
+
+
+class TestParallelTuning(unittest.TestCase):
+    def test_trials_are_shared_through_the_journal(self):
+        datasets = {
+            name: TensorDataset(torch.zeros(4, 2), torch.zeros(4))
+            for name in ("train", "val", "test")
+        }
+        parallel_tuning.share_datasets_memory(datasets)
+        self.assertTrue(datasets["train"].tensors[0].is_shared())
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            storage_path = os.path.join(tmp_dir, "journal.log")
+            study = optuna.create_study(
+                study_name="test",
+                storage=JournalStorage(JournalFileBackend(storage_path)),
+            )
+            parallel_tuning.optimize_in_processes(
+                storage_path,
+                "test",
+                quadratic_objective,
+                objective_args=(datasets,),
+                objective_kwargs=dict(target=3.0),
+                n_trials=8,
+                n_workers=2,
+            )
+            trials = study.get_trials()
+            best_value = study.best_value
+
+        self.assertGreaterEqual(len(trials), 8)
+        self.assertTrue(all(trial.state.is_finished() for trial in trials))
+        self.assertLess(best_value, 100.0)
+        n_workers = min(2, len(parallel_tuning.get_available_cores()))
+        self.assertEqual(len({trial.user_attrs["pid"] for trial in trials}), n_workers)
+
+
+class TinyRegression(L.LightningModule):
+    def __init__(self):
+        super().__init__()
+        self.linear = torch.nn.Linear(4, 1)
+
+    def training_step(self, batch, batch_idx):
+        x, y = batch
+        return torch.nn.functional.mse_loss(self.linear(x).squeeze(dim=1), y)
+
+    def on_train_end(self):
+        # Data-parallel replicas end up with the same parameters
+        weights = [None] * self.trainer.world_size
+        torch.distributed.all_gather_object(weights, self.linear.weight.detach().tolist())
+        assert all(weight == weights[0] for weight in weights)
+        assert len(os.sched_getaffinity(0)) == torch.get_num_threads()
+
+    def configure_optimizers(self):
+        return torch.optim.SGD(self.parameters(), lr=0.1)
+
+
+class TestCpuDistributed(unittest.TestCase):
+    def test_processes_get_disjoint_cores(self):
+        slices = [process_cores(rank, 2) for rank in range(2)]
+        n_cores = len(parallel_tuning.get_available_cores())
+        self.assertEqual(sum(len(cores) for cores in slices), n_cores if n_cores > 1 else 2)
+        if n_cores > 1:
+            self.assertFalse(set(slices[0]) & set(slices[1]))
+
+    def test_gloo_data_parallel_training(self):
+        strategy = cpu_ddp_strategy(start_method="spawn")
+        self.assertEqual(strategy.process_group_backend, "gloo")
+        dataset = TensorDataset(torch.randn(32, 4), torch.randn(32))
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            trainer = Trainer(
+                default_root_dir=tmp_dir,
+                accelerator="cpu",
+                devices=2,
+                strategy=strategy,
+                max_epochs=1,
+                accumulate_grad_batches=2,
+                callbacks=[CoreAffinity()],
+                logger=False,
+                enable_checkpointing=False,
+                enable_progress_bar=False,
+                enable_model_summary=False,
+            )
+            trainer.fit(TinyRegression(), torch.utils.data.DataLoader(dataset, batch_size=4))
+        self.assertEqual(trainer.state.status, "finished")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,153 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+import numpy as np
+import torch
+from transformers import EsmConfig, EsmTokenizer
+from plmfit.shared_utils import utils
+from plmfit.functions.score import (
+    AMINO_ACIDS,
+    benchmark_scoring,
+    masked_marginals,
+    score_sequences,
+    score_variants,
+    suffix_log_likelihoods,
+)
+from plmfit.language_models.esm.modeling_esm import PlmfitEsmForMaskedLM
+from plmfit.language_models.progen2.models.progen.configuration_progen import (
+    ProGenConfig,
+)
+from plmfit.language_models.progen2.models.progen.modeling_progen import (
+    ProGenForCausalLM,
+)
+
+
+class TestProGenScoring(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.tokenizer = utils.load_tokenizer("progen2-small")
+        config = ProGenConfig(
+            vocab_size=self.tokenizer.get_vocab_size(),
+            n_positions=64,
+            n_ctx=64,
+            n_embd=64,
+            n_layer=2,
+            n_head=8,
+            rotary_dim=4,
+        )
+        self.model = ProGenForCausalLM(config).eval()
+        self.seqs = ["MKTAYIAKQR", "MLV", "GSHMWE", "MKTAYIAKQW"]
+        self.encs = utils.categorical_encode(self.seqs, self.tokenizer, 10)
+
+    def expected_log_likelihood(self, context):
+        # Same as ll() in likelihood.py, one sequence at a time
+        vocab = self.tokenizer.get_vocab()
+        first_token, last_token = vocab["A"], vocab["Z"]
+        target = torch.tensor(self.tokenizer.encode(context).ids)
+        with torch.no_grad():
+            logits = self.model(target.unsqueeze(0)).logits[0]
+        logits, target = logits[:-2, first_token : last_token + 1], target[1:-1]
+        return torch.log_softmax(logits, dim=-1)[torch.arange(len(target)), target - first_token]
+
+    def test_batched_scores_match_single_sequences(self):
+        scores = score_sequences(
+            self.model, self.encs, self.tokenizer, max_tokens=24, reverse=True
+        )
+        for i, seq in enumerate(self.seqs):
+            forward = self.expected_log_likelihood(f"1{seq}2")
+            reverse = self.expected_log_likelihood(f"2{seq[::-1]}1")
+            self.assertAlmostEqual(scores["ll_forward_sum"][i], float(forward.sum()), places=4)
+            self.assertAlmostEqual(scores["ll_forward_mean"][i], float(forward.mean()), places=4)
+            self.assertAlmostEqual(scores["ll_reverse_sum"][i], float(reverse.sum()), places=4)
+            self.assertAlmostEqual(
+                scores["ll_mean"][i], float(forward.mean() + reverse.mean()) / 2, places=4
+            )
+
+    def test_shared_prefix_scores_match_full_sequences(self):
+        # Mutational library: the sequences share the wild type up to the first mutated position
+        seqs = ["MKTAYIAKQR", "MKTAYIWKQR", "MKTAYIAKQ", "MKTAYLAKQRW"]
+        encs = utils.categorical_encode(seqs, self.tokenizer, 11)
+        with patch(
+            "plmfit.functions.score.suffix_log_likelihoods", wraps=suffix_log_likelihoods
+        ) as patched:
+            scores = score_sequences(
+                self.model, encs, self.tokenizer, max_tokens=24, reverse=True, shared_prefix=True
+            )
+            patched.assert_called()
+        expected = score_sequences(
+            self.model, encs, self.tokenizer, max_tokens=24, reverse=True
+        )
+        for column, values in expected.items():
+            np.testing.assert_allclose(scores[column], values, atol=1e-4, err_msg=column)
+        for i, seq in enumerate(seqs):
+            forward = self.expected_log_likelihood(f"1{seq}2")
+            self.assertAlmostEqual(scores["ll_forward_sum"][i], float(forward.sum()), places=4)
+
+    def test_benchmark_reports_throughput(self):
+        report = benchmark_scoring(n_sequences=16, length=24, max_tokens=128)
+        self.assertEqual(report["n_sequences"], 16)
+        self.assertGreater(report["sequences_per_second"], 0)
+
+
+# Vocabulary of the facebook/esm2 tokenizers
+ESM_VOCAB = ["<cls>", "<pad>", "<eos>", "<unk>"] + list("LAGVSERTIDPKQNFYMHWCXBUZO.-") + [
+    "<null_1>",
+    "<mask>",
+]
+
+
+class TestMaskedMarginalScoring(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            vocab_file = os.path.join(tmp_dir, "vocab.txt")
+            with open(vocab_file, "w") as f:
+                f.write("\n".join(ESM_VOCAB))
+            self.tokenizer = EsmTokenizer(vocab_file)
+        config = EsmConfig(
+            vocab_size=len(ESM_VOCAB),
+            hidden_size=32,
+            num_hidden_layers=2,
+            num_attention_heads=4,
+            intermediate_size=64,
+            max_position_embeddings=64,
+            pad_token_id=self.tokenizer.pad_token_id,
+            mask_token_id=self.tokenizer.mask_token_id,
+            position_embedding_type="rotary",
+            token_dropout=True,
+        )
+        self.model = PlmfitEsmForMaskedLM(config).eval()
+        self.wild_type = "MKTAYIAKQR"
+
+    def test_batched_table_matches_single_positions(self):
+        table = masked_marginals(self.model, self.tokenizer, self.wild_type, batch_size=3)
+        self.assertEqual(table.shape, (len(self.wild_type), len(AMINO_ACIDS)))
+        amino_acid_ids = self.tokenizer.convert_tokens_to_ids(list(AMINO_ACIDS))
+        for position in range(len(self.wild_type)):
+            input_ids = torch.tensor([self.tokenizer(self.wild_type)["input_ids"]])
+            input_ids[0, position + 1] = self.tokenizer.mask_token_id
+            with torch.no_grad():
+                logits = self.model(input_ids).logits[0, position + 1]
+            expected = torch.log_softmax(logits, dim=-1)[amino_acid_ids]
+            np.testing.assert_allclose(table[position], expected.numpy(), atol=1e-5)
+
+    def test_variants_sum_substitution_scores(self):
+        table = np.random.default_rng(0).normal(size=(len(self.wild_type), len(AMINO_ACIDS)))
+        index = {amino_acid: i for i, amino_acid in enumerate(AMINO_ACIDS)}
+
+        def delta(position, mutant):
+            wild_type = self.wild_type[position]
+            return table[position, index[mutant]] - table[position, index[wild_type]]
+
+        seqs = [self.wild_type, "MKTAYIAKQW", "AKTAYIAKQW", "MKTAY", "MKTAYIAKQX"]
+        scores = score_variants(table, self.wild_type, seqs)
+        self.assertEqual(scores[0], 0.0)
+        self.assertAlmostEqual(scores[1], delta(9, "W"))
+        self.assertAlmostEqual(scores[2], delta(0, "A") + delta(9, "W"))
+        self.assertTrue(np.isnan(scores[3]))
+        self.assertTrue(np.isnan(scores[4]))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,598 @@
+import datetime
+import json
+import os
+import pickle
+import socket
+import tempfile
+import time
+import unittest
+from unittest.mock import MagicMock, patch
+import numpy as np
+import pandas as pd
+import blosum as bl
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.utils.data import SequentialSampler, TensorDataset
+from lightning import Trainer
+from transformers import EsmTokenizer
+from plmfit.shared_utils import data_explore, utils
+from plmfit.shared_utils.random_state import set_seed
+from plmfit.shared_utils.pooling import (
+    check_reductions,
+    last_token_index,
+    pool,
+    pool_many,
+    token_mask,
+)
+from plmfit.models.lightning_model import (
+    LightningModel,
+    Metrics,
+    PredictionWriter,
+    TensorAccumulator,
+    all_gather_rows,
+)
+
+
+# ESM-2 vocabulary, in token id order
+ESM_VOCAB = ["<cls>", "<pad>", "<eos>", "<unk>", *"LAGVSERTIDPKQNFYMHWCXBUZO.-", "<null_1>", "<mask>"]
+
+
+class SumEmbedder(nn.Module):
+    """Returns the sum of the token ids of each sequence, ignoring padding (id 0)"""
+
+    def forward(self, input_ids):
+        return input_ids.float().sum(dim=-1, keepdim=True)
+
+
+class TestLengthBucketBatching(unittest.TestCase):
+    def setUp(self):
+        self.pad = 0
+        lengths = [3, 10, 1, 7, 7, 2, 9, 4]
+        self.encs = torch.zeros((len(lengths), max(lengths)), dtype=torch.int8)
+        for i, length in enumerate(lengths):
+            self.encs[i, :length] = i + 1
+        self.lengths = torch.tensor(lengths)
+
+    def test_batches_respect_token_budget(self):
+        sampler = utils.LengthBucketBatchSampler(
+            range(len(self.lengths)), self.lengths, max_tokens=16
+        )
+        batches = list(sampler)
+
+        self.assertEqual(sorted(i for batch in batches for i in batch), list(range(8)))
+        for batch in batches:
+            padded_size = len(batch) * int(self.lengths[batch].max())
+            self.assertTrue(len(batch) == 1 or padded_size <= 16)
+        self.assertEqual(len(sampler), len(batches))
+
+    def test_bound_sampler_survives_reinstantiation(self):
+        dataset = TensorDataset(self.encs)
+        batch_sampler = utils.LengthBucketBatchSampler.bind(self.lengths, max_tokens=16)(
+            SequentialSampler(dataset)
+        )
+        # Lightning re-creates custom batch samplers from these attributes when predicting
+        recreated = type(batch_sampler)(
+            SequentialSampler(dataset),
+            batch_size=batch_sampler.batch_size,
+            drop_last=batch_sampler.drop_last,
+        )
+        self.assertEqual(list(recreated), list(batch_sampler))
+        self.assertEqual(list(pickle.loads(pickle.dumps(recreated))), list(batch_sampler))
+        with self.assertRaises(ValueError):
+            utils.LengthBucketBatchSampler(SequentialSampler(dataset))
+
+    def test_collate_pads_to_batch_max_length(self):
+        batch = [(self.encs[0],), (self.encs[5],)]
+        (input,) = utils.pad_collate(batch, pad_token_id=self.pad)
+        self.assertEqual(tuple(input.shape), (2, 3))
+
+    def test_predictions_keep_original_order(self):
+        data_loader = utils.create_predict_data_loader(
+            self.encs, max_tokens=16, pad_token_id=self.pad
+        )
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            logger = MagicMock()
+            logger.base_dir = tmp_dir
+            logger.experiment_name = "test"
+            model = LightningModel(SumEmbedder(), plmfit_logger=logger, train=False)
+            trainer = Trainer(
+                default_root_dir=tmp_dir,
+                logger=False,
+                enable_progress_bar=False,
+                accelerator="cpu",
+                devices=1,
+                callbacks=[PredictionWriter(logger=logger, write_interval="epoch")],
+            )
+            trainer.predict(model=model, dataloaders=data_loader)
+            predictions = torch.load(os.path.join(tmp_dir, "test.pt"))
+
+        expected = self.encs.float().sum(dim=-1, keepdim=True)
+        self.assertTrue(torch.equal(predictions, expected))
+
+    def test_shared_prefix_length(self):
+        encs = torch.tensor([[1, 5, 6, 7, 2, 0], [1, 5, 6, 9, 7, 2], [1, 5, 6, 7, 7, 2]])
+        self.assertEqual(utils.get_shared_prefix_length(encs), 3)
+        self.assertEqual(utils.get_shared_prefix_length(encs[:1]), 5)
+
+
+class TestEmbeddingStore(unittest.TestCase):
+    def setUp(self):
+        set_seed(42)
+
+    def test_streamed_predictions_round_trip(self):
+        lengths = [5, 2, 8, 3, 6, 1]
+        encs = torch.zeros((len(lengths), max(lengths)), dtype=torch.int8)
+        for i, length in enumerate(lengths):
+            encs[i, :length] = i + 1
+        data_loader = utils.create_predict_data_loader(
+            encs, max_tokens=12, pad_token_id=0
+        )
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            logger = MagicMock()
+            logger.base_dir = tmp_dir
+            logger.experiment_name = "test"
+            model = LightningModel(SumEmbedder(), plmfit_logger=logger, train=False)
+            writer = PredictionWriter(
+                logger=logger,
+                write_interval="batch",
+                dtype="float16",
+                metadata={"model": "test", "layer": "last", "reduction": "sum"},
+            )
+            trainer = Trainer(
+                default_root_dir=tmp_dir,
+                logger=False,
+                enable_progress_bar=False,
+                accelerator="cpu",
+                devices=1,
+                callbacks=[writer],
+            )
+            trainer.predict(model=model, dataloaders=data_loader, return_predictions=False)
+
+            embeddings = utils.load_embeddings(emb_path=os.path.join(tmp_dir, "test.npy"))
+            self.assertIsInstance(embeddings, np.memmap)
+            self.assertEqual(embeddings.dtype, np.float16)
+            expected = encs.float().sum(dim=-1, keepdim=True)
+            self.assertTrue(torch.equal(torch.from_numpy(np.array(embeddings)).float(), expected))
+
+            scores = np.arange(len(lengths), dtype=np.float32)
+            split = np.array(["train", "train", "train", "validation", "test", "test"])
+            data_loaders = utils.create_data_loaders(
+                embeddings, scores, split=split, batch_size=2, scaler=True
+            )
+            X_test, y_test, ids = next(iter(data_loaders["test"]))
+            self.assertEqual(tuple(X_test.shape), (2, 1))
+            self.assertEqual(X_test.dtype, torch.float32)
+            self.assertTrue(torch.equal(y_test, torch.tensor([4.0, 5.0])))
+            del embeddings, data_loaders
+
+
+class TestBlosum62Encoding(unittest.TestCase):
+    def setUp(self):
+        self.sequences = ["ACDW", "KX", "MUB"]
+
+    def test_encoding_matches_substitution_scores(self):
+        BLOSUM62 = bl.BLOSUM(62)
+        encs = utils.blosum62_encode(self.sequences, pad_to_length=5, batch_size=2)
+
+        self.assertEqual(tuple(encs.shape), (3, 5, 5))
+        self.assertEqual(encs.dtype, torch.int8)
+        for n, seq in enumerate(self.sequences):
+            expected = torch.zeros((5, 5), dtype=torch.int8)
+            for i, acid in enumerate(seq):
+                for j, aa in enumerate(seq):
+                    expected[i, j] = int(BLOSUM62[acid].get(aa, 0))
+            self.assertTrue(torch.equal(encs[n], expected))
+
+    def test_lazy_dataset_matches_encoding(self):
+        encs = utils.blosum62_encode(self.sequences, pad_to_length=5)
+        indices = utils.blosum62_tokenize(self.sequences, pad_to_length=5)
+        dataset = utils.Blosum62Dataset(indices, torch.arange(3))
+
+        for n in range(3):
+            x, y = dataset[n]
+            self.assertTrue(torch.equal(x, encs[n].flatten()))
+            self.assertEqual(int(y), n)
+
+
+def per_sequence_encode(seqs, tokenizer, max_len, add_bos, add_eos, model_name):
+    # Reference one-sequence-at-a-time encoding that categorical_encode used before batching
+    if "esm" in model_name:
+        seq_tokens = tokenizer.get_vocab()["<pad>"] * torch.ones(
+            (len(seqs), max_len + 2), dtype=int
+        )
+        for itr, seq in enumerate(seqs):
+            tok_seq = torch.tensor(tokenizer.encode(seq))
+            seq_tokens[itr][: tok_seq.shape[0]] = tok_seq
+        return seq_tokens
+
+    if "progen2" in model_name:
+        pad_token, bos_token, eos_token = "<|pad|>", "<|bos|>", "<|eos|>"
+    else:
+        pad_token, bos_token, eos_token = "<pad>", "<cls>", "<sep>"
+    vocab = tokenizer.get_vocab()
+    internal_max_len = max_len + int(add_bos) + int(add_eos)
+    seq_tokens = vocab[pad_token] * torch.ones((len(seqs), internal_max_len), dtype=int)
+    for itr, seq in enumerate(seqs):
+        sequence = [vocab[bos_token]] * add_bos
+        sequence.extend(tokenizer.encode(seq, add_special_tokens=False).ids[:max_len])
+        sequence.extend([vocab[eos_token]] * add_eos)
+        seq_tokens[itr, : len(sequence)] = torch.tensor(sequence[:internal_max_len])
+    return seq_tokens
+
+
+class TestEncodingCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        patcher = patch.object(utils, "data_dir", self.tmp_dir.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.tmp_dir.cleanup)
+
+    def test_dataset_cache_round_trip_and_invalidation(self):
+        os.makedirs(os.path.join(self.tmp_dir.name, "toy"))
+        csv_path = os.path.join(self.tmp_dir.name, "toy", "toy_data_full.csv")
+        data = pd.DataFrame(
+            {
+                "aa_seq": ["ACD", "KLMN", "W"],
+                "len": [3, 4, 1],
+                "score": [0.5, -1.0, 2.0],
+                "validation": ["train", None, "test"],
+            }
+        )
+        data.to_csv(csv_path, index=False)
+
+        parsed = utils.load_dataset("toy")
+        cached = utils.load_dataset("toy")
+        self.assertEqual(
+            len(os.listdir(os.path.join(utils.get_cache_dir(), "datasets"))), 1
+        )
+        pd.testing.assert_frame_equal(cached, parsed)
+
+        # The csv is only hashed again once it has been modified
+        with patch.object(utils, "hash_file") as hash_file:
+            utils.load_dataset("toy")
+            hash_file.assert_not_called()
+
+        # The cached columns can be modified in place, without modifying the cache
+        cached.loc[0, "score"] = 10.0
+        self.assertEqual(cached.loc[0, "score"], 10.0)
+        self.assertEqual(utils.load_dataset("toy").loc[0, "score"], 0.5)
+
+        data.loc[0, "score"] = 3.0
+        data.to_csv(csv_path, index=False)
+        self.assertEqual(utils.load_dataset("toy").loc[0, "score"], 3.0)
+
+    def test_dataset_encoding_cache_key(self):
+        os.makedirs(os.path.join(self.tmp_dir.name, "toy"))
+        csv_path = os.path.join(self.tmp_dir.name, "toy", "toy_data_full.csv")
+        pd.DataFrame({"aa_seq": ["MKTAYIAK", "MLV", "MK"], "len": [8, 3, 2]}).to_csv(
+            csv_path, index=False
+        )
+        data = utils.load_dataset("toy")
+        self.assertIsNotNone(utils.dataset_source_key(data))
+        # Subsets of the dataset are keyed by their sequences
+        self.assertIsNone(utils.dataset_source_key(data[data["len"] > 2]))
+        self.assertIsNone(utils.dataset_source_key(data.iloc[::-1]))
+        # Reordered or edited sequences keep the attrs and the index, but not the key
+        shuffled = data.iloc[[2, 0, 1]].reset_index(drop=True)
+        self.assertNotEqual(utils.dataset_source_key(shuffled), utils.dataset_source_key(data))
+        edited = utils.load_dataset("toy")
+        edited.loc[1, "aa_seq"] = "MLW"
+        self.assertNotEqual(utils.dataset_source_key(edited), utils.dataset_source_key(data))
+        self.assertEqual(
+            utils.dataset_source_key(utils.load_dataset("toy")), utils.dataset_source_key(data)
+        )
+
+        tokenizer = utils.load_tokenizer("progen2-small")
+        encs = utils.categorical_encode(
+            data["aa_seq"].values, tokenizer, 8, source_key=utils.dataset_source_key(data)
+        )
+        with patch.object(utils.Tokenizer, "from_str") as from_str:
+            cached = utils.categorical_encode(
+                utils.load_dataset("toy")["aa_seq"].values,
+                tokenizer,
+                8,
+                source_key=utils.dataset_source_key(utils.load_dataset("toy")),
+            )
+            from_str.assert_not_called()
+        self.assertTrue(torch.equal(cached, encs))
+        self.assertTrue(
+            torch.equal(encs, utils.categorical_encode(data["aa_seq"].values, tokenizer, 8))
+        )
+
+    def test_encoding_cache_is_reused(self):
+        tokenizer = utils.load_tokenizer("progen2-small")
+        seqs = ["MKTAYIAK", "MLV"]
+        encs = utils.categorical_encode(seqs, tokenizer, 8, add_bos=True, add_eos=True)
+        self.assertEqual(
+            len(os.listdir(os.path.join(utils.get_cache_dir(), "encodings"))), 1
+        )
+
+        with patch.object(utils.Tokenizer, "from_str") as from_str:
+            cached = utils.categorical_encode(
+                seqs, tokenizer, 8, add_bos=True, add_eos=True
+            )
+            from_str.assert_not_called()
+        self.assertTrue(torch.equal(cached, encs))
+
+        other = utils.categorical_encode(seqs, tokenizer, 8, add_bos=False, add_eos=True)
+        self.assertEqual(tuple(other.shape), (2, 9))
+
+    def test_batched_encoding_matches_per_sequence(self):
+        seqs = ["MKTAYIAK", "MLV", "", "ACDEFGHIKLMNPQRSTVWY"]
+        with tempfile.TemporaryDirectory() as vocab_dir:
+            vocab_file = os.path.join(vocab_dir, "vocab.txt")
+            with open(vocab_file, "w") as f:
+                f.write("\n".join(ESM_VOCAB))
+            tokenizers = {
+                "progen2": utils.load_tokenizer("progen2-small"),
+                "bert": utils.load_tokenizer("proteinbert"),
+                "esm": EsmTokenizer(vocab_file),
+            }
+
+        cases = [
+            ("progen2", 20, False, False),
+            ("progen2", 20, True, True),
+            ("progen2", 20, True, False),
+            ("progen2", 5, True, True),
+            ("progen2", 5, False, False),
+            ("bert", 20, True, True),
+            ("bert", 5, True, True),
+            ("esm", 20, False, False),
+        ]
+        for model_name, max_len, add_bos, add_eos in cases:
+            with self.subTest(
+                model_name=model_name, max_len=max_len, add_bos=add_bos, add_eos=add_eos
+            ):
+                tokenizer = tokenizers[model_name]
+                encs = utils.categorical_encode(
+                    seqs, tokenizer, max_len, add_bos, add_eos, model_name=model_name
+                )
+                expected = per_sequence_encode(
+                    seqs, tokenizer, max_len, add_bos, add_eos, model_name
+                )
+                self.assertEqual(encs.dtype, torch.int8)
+                self.assertTrue(torch.equal(encs.long(), expected))
+
+
+class TestOneHotDataset(unittest.TestCase):
+    def setUp(self):
+        set_seed(42)
+        self.encs = torch.randint(0, 5, (10, 4), dtype=torch.int8).float()
+        self.scores = torch.arange(10, dtype=torch.float32)
+
+    def test_batched_encoding_matches_per_sample(self):
+        for flatten in (True, False):
+            dataset = utils.OneHotDataset(
+                self.encs, self.scores, num_classes=5, flatten=flatten
+            )
+            for _ in range(2 * dataset.num_buffers):
+                indices = [7, 2, 9]
+                x, y = dataset.__getitems__(indices)
+                expected = torch.stack([dataset[i][0] for i in indices])
+                self.assertTrue(torch.equal(x, expected))
+                self.assertTrue(torch.equal(y, self.scores[indices]))
+            self.assertEqual(x.dim(), 2 if flatten else 3)
+
+    def test_batches_without_buffer_reuse(self):
+        dataset = utils.OneHotDataset(self.encs, self.scores, num_classes=5, reuse_buffers=False)
+        batches = [dataset.__getitems__([i])[0] for i in range(2 * dataset.num_buffers)]
+        for i, x in enumerate(batches):
+            self.assertTrue(torch.equal(x, dataset[i][0].unsqueeze(0)))
+        # With reuse, a batch is overwritten once num_buffers more batches have been fetched
+        dataset.set_reuse_buffers(True)
+        first = dataset.__getitems__([0])[0]
+        for i in range(dataset.num_buffers):
+            dataset.__getitems__([i + 1])
+        self.assertFalse(torch.equal(first, dataset[0][0].unsqueeze(0)))
+
+    def test_dataset_to_tensors_copies_reused_buffers(self):
+        encs = torch.randint(0, 5, (20, 4), dtype=torch.int8).float()
+        dataset = utils.OneHotDataset(encs, torch.arange(20.0), num_classes=5)
+        # More batches than buffers, so the buffers are reused while the batches are collected
+        x, y = utils.dataset_to_tensors(dataset, batch_size=4)
+        expected = F.one_hot(encs.long(), 5).flatten(start_dim=1).float()
+        self.assertTrue(torch.equal(x, expected))
+        self.assertTrue(torch.equal(y, torch.arange(20.0)))
+
+    def test_data_loaders_yield_one_hot_batches(self):
+        data_loaders = utils.create_data_loaders(
+            self.encs,
+            self.scores,
+            split=np.array(["train"] * 8 + ["validation", "test"]),
+            batch_size=4,
+            dataset_type="one_hot",
+            num_classes=5,
+            flatten=False,
+        )
+        x, y = next(iter(data_loaders["train"]))
+        self.assertEqual(tuple(x.shape), (4, 4, 5))
+        self.assertTrue(torch.equal(x.sum(dim=-1), torch.ones(4, 4)))
+        self.assertEqual(tuple(y.shape), (4,))
+
+
+class TestPreparedDatasets(unittest.TestCase):
+    def setUp(self):
+        set_seed(42)
+        self.embeddings = np.random.rand(20, 3).astype(np.float32)
+        self.scores = np.arange(20, dtype=np.float32)
+        self.split = np.array(["train"] * 12 + ["validation"] * 4 + ["test"] * 4)
+
+    def test_shared_datasets_match_create_data_loaders(self):
+        datasets = utils.prepare_datasets(
+            self.embeddings, self.scores, split=self.split, scaler=True
+        )
+        for batch_size in (4, 8):
+            data_loaders = utils.create_data_loaders_from_datasets(
+                datasets, batch_size=batch_size
+            )
+            expected = utils.create_data_loaders(
+                self.embeddings,
+                self.scores,
+                split=self.split,
+                scaler=True,
+                batch_size=batch_size,
+            )
+            self.assertIs(data_loaders["train"].dataset, datasets["train"])
+            self.assertEqual(data_loaders["train"].batch_size, batch_size)
+            for name in ("val", "test"):
+                for batch, expected_batch in zip(data_loaders[name], expected[name]):
+                    for tensor, expected_tensor in zip(batch, expected_batch):
+                        self.assertTrue(torch.equal(tensor, expected_tensor))
+
+
+class TestPooling(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.input_ids = torch.tensor([[1, 5, 6, 7, 2], [1, 8, 2, 0, 0]])
+        self.hidden_states = torch.randn(2, 5, 4)
+        self.mask = token_mask(self.input_ids, 0)
+        self.lengths = [5, 3]
+
+    def test_padded_batch_matches_single_sequences(self):
+        reductions = ["mean", "sum", "max", "weighted_mean", "bos", "eos", "pos1"]
+        pooled = pool_many(self.hidden_states, reductions, self.mask)
+        for row, length in enumerate(self.lengths):
+            # The same sequence without padding
+            single = pool_many(self.hidden_states[row : row + 1, :length], reductions)
+            for reduction in reductions:
+                torch.testing.assert_close(pooled[reduction][row], single[reduction][0])
+
+    def test_reductions(self):
+        states = self.hidden_states[1, :3]
+        torch.testing.assert_close(pool(self.hidden_states, "mean", self.mask)[1], states.mean(dim=0))
+        torch.testing.assert_close(pool(self.hidden_states, "max", self.mask)[1], states.amax(dim=0))
+        torch.testing.assert_close(pool(self.hidden_states, "eos", self.mask)[1], states[-1])
+        torch.testing.assert_close(pool(self.hidden_states, "2", self.mask), self.hidden_states[:, 2])
+        weights = torch.softmax(states.norm(dim=-1), dim=0)
+        torch.testing.assert_close(
+            pool(self.hidden_states, "weighted_mean", self.mask)[1], (states * weights[:, None]).sum(dim=0)
+        )
+        self.assertIs(pool(self.hidden_states, "none"), self.hidden_states)
+        with self.assertRaises(ValueError):
+            pool(self.hidden_states, "median")
+
+    def test_mutation_window(self):
+        pooled = pool(self.hidden_states, "mut_mean", self.mask, positions=[1, 3])
+        torch.testing.assert_close(pooled[0], self.hidden_states[0, [1, 3]].mean(dim=0))
+        # Position 3 is padding in the second sequence
+        torch.testing.assert_close(pooled[1], self.hidden_states[1, 1])
+        with self.assertRaises(ValueError):
+            pool(self.hidden_states, "mut_mean", self.mask)
+        # Not reachable from the command line, where the positions are not known
+        with self.assertRaises(ValueError):
+            check_reductions(["mean", "mut_mean"])
+
+    def test_eos_token_index(self):
+        # Tokens after the eos token (id 2), and a sequence without it
+        input_ids = torch.tensor([[1, 5, 2, 7, 7], [1, 8, 9, 0, 0]])
+        eos_index = last_token_index(input_ids, 2)
+        self.assertEqual(eos_index.tolist(), [2, 4])
+        pooled = pool(self.hidden_states, "eos", token_mask(input_ids, 0), eos_index=eos_index)
+        torch.testing.assert_close(pooled, self.hidden_states[[0, 1], [2, 4]])
+
+
+def gather_shards(rank, world_size, port):
+    torch.distributed.init_process_group(
+        "gloo",
+        init_method=f"tcp://127.0.0.1:{port}",
+        rank=rank,
+        world_size=world_size,
+        timeout=datetime.timedelta(seconds=60),
+    )
+    # Uneven shards, then a rank without rows
+    for n_rows, expected in (([3, 1], [0, 1, 2, 10]), ([3, 0], [0, 1, 2])):
+        shard = torch.arange(n_rows[rank]).float().reshape(-1, 1) + 10 * rank
+        gathered = all_gather_rows(shard, device="cpu")
+        assert torch.equal(gathered, torch.tensor(expected).float().reshape(-1, 1)), gathered
+    # Int64 ids, and a rank without batches whose accumulator is an empty float tensor
+    ids = TensorAccumulator()
+    if rank == 0:
+        ids.append(torch.tensor([4, 2, 7]))
+    ids.gather(device="cpu")
+    assert ids.tensor().dtype == torch.int64 and ids.tolist() == [4, 2, 7], ids.tensor()
+    # The process group is shut down when the process exits: destroy_process_group can deadlock in
+    # gloo when the ranks share a single core, and spawn_with_timeout kills any rank that hangs
+    torch.distributed.barrier()
+
+
+def spawn_with_timeout(fn, args, nprocs, timeout=300):
+    """Runs fn in nprocs spawned processes, and kills them if they have not all finished within timeout seconds."""
+    context = torch.multiprocessing.spawn(fn, args=args, nprocs=nprocs, join=False)
+    deadline = time.monotonic() + timeout
+    while not context.join(timeout=max(deadline - time.monotonic(), 0)):
+        if time.monotonic() >= deadline:
+            for process in context.processes:
+                process.kill()
+                process.join()
+            raise TimeoutError(f"The spawned processes did not finish within {timeout}s")
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.preds = torch.randn(70)
+        self.actual = self.preds + 0.1 * torch.randn(70)
+
+    def test_accumulator_grows(self):
+        accumulator = TensorAccumulator(initial_capacity=4)
+        for start in range(0, 70, 9):
+            accumulator.append(self.preds[start : start + 9])
+        # A single-element batch is squeezed to a 0-d tensor by the test step
+        accumulator.append(torch.tensor(1.5, dtype=torch.float64))
+        self.assertEqual(len(accumulator), 71)
+        self.assertEqual(accumulator.tensor().dtype, torch.float32)
+        torch.testing.assert_close(accumulator.tensor()[:70], self.preds)
+        self.assertEqual(accumulator.tolist()[-1], 1.5)
+
+    def test_metrics_match_full_batch(self):
+        metrics = Metrics("regression")
+        for start in range(0, 70, 16):
+            batch = slice(start, start + 16)
+            metrics.add(self.preds[batch], self.actual[batch], torch.arange(70)[batch])
+        full = Metrics("regression")
+        full.add(self.preds, self.actual, torch.arange(70))
+        self.assertEqual(metrics.get_metrics()["main"], full.get_metrics()["main"])
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "experiment")
+            metrics.save_metrics(path)
+            with open(f"{path}_metrics.json", encoding="utf-8") as f:
+                report = json.load(f)
+            predictions = data_explore.load_predictions(f"{path}_metrics.json")
+            self.assertIsInstance(predictions["preds"], np.memmap)
+            self.assertEqual(predictions["ids"].tolist(), list(range(70)))
+            np.testing.assert_array_equal(predictions["actual"], self.actual.numpy())
+            np.testing.assert_array_equal(predictions["preds"], self.preds.numpy())
+            fig = data_explore.plot_actual_vs_predicted(json_path=f"{path}_metrics.json")
+            self.assertEqual(len(fig.axes[0].collections[0].get_offsets()), 70)
+            del predictions
+        # Only the report is kept in the JSON
+        self.assertEqual(report, metrics.report)
+
+    def test_load_npz(self):
+        columns = {"x": np.arange(10, dtype=np.float32), "y": np.ones((3, 4)), "empty": np.zeros((0, 2))}
+        with tempfile.TemporaryDirectory() as tmp:
+            for save, mapped in ((np.savez, True), (np.savez_compressed, False)):
+                path = os.path.join(tmp, f"{save.__name__}.npz")
+                save(path, **columns)
+                loaded = utils.load_npz(path)
+                self.assertEqual(sorted(loaded), sorted(columns))
+                # Compressed arrays cannot be memory-mapped and are read in full
+                self.assertEqual(isinstance(loaded["x"], np.memmap), mapped)
+                for name, column in columns.items():
+                    np.testing.assert_array_equal(loaded[name], column)
+                    self.assertEqual(loaded[name].dtype, column.dtype)
+                del loaded
+
+    def test_all_gather_uneven_shards(self):
+        with socket.socket() as free_port:
+            free_port.bind(("127.0.0.1", 0))
+            port = free_port.getsockname()[1]
+        spawn_with_timeout(gather_shards, args=(2, port), nprocs=2)
+
+
+if __name__ == "__main__":
+    unittest.main()